@@ -0,0 +1,172 @@
+"""
+Admission Control
+Per-server and per-terminal token buckets in front of host authorizations
+"""
+
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from connections import Deadline, ServerKey, server_key
+
+# Waiters allowed per server before new requests are turned away
+DEFAULT_MAX_QUEUE = 100
+
+# Seconds between sweeps that drop buckets which have refilled to full
+BUCKET_SWEEP_INTERVAL = 60.0
+
+
+class AdmissionRejected(Exception):
+    """The host's queue is full or the wait would outlast the deadline"""
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out tokens on credit: a caller takes a token
+    at once and is told how long to wait until it becomes valid, so waiters
+    are served in arrival order without a condition variable.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self, now: float) -> float:
+        """Take one token; returns seconds until it may be used"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1.0
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1.0)
+
+    def full(self, now: float) -> bool:
+        """Refilled to burst, so no different from a fresh bucket"""
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class AdmissionStats:
+    """Counters for one server"""
+
+    __slots__ = ('queued', 'peak_queued', 'admitted', 'delayed', 'rejected', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.queued = 0
+        self.peak_queued = 0
+        self.admitted = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class AdmissionController:
+    """
+    Rate limits from server_config[...]['rate_limit']:
+        tps           host-wide transactions per second (0 = unlimited)
+        burst         tokens available at once (default: one second of tps)
+        terminal_tps  per-terminal limit toward this host (0 = unlimited)
+        queue         callers allowed to wait for a token at once
+    A caller that would wait longer than its deadline, or would have to wait
+    while the queue is full, is rejected straight away instead of piling up.
+    With a token free, the caller goes ahead whatever the queue limit.
+    Buckets that have refilled are dropped every `sweep_interval` seconds,
+    so terminals that stop sending do not keep one each forever.
+    """
+
+    def __init__(self, sweep_interval: float = BUCKET_SWEEP_INTERVAL):
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._buckets: Dict[tuple, TokenBucket] = {}
+        self._stats: Dict[ServerKey, AdmissionStats] = {}
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def _bucket(self, key: tuple, rate: float, burst: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.rate != rate or bucket.burst != max(1.0, burst):
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def _sweep(self, now: float):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        for key in [key for key, bucket in self._buckets.items() if bucket.full(now)]:
+            del self._buckets[key]
+
+    def admit(self, server_config: Dict, profile_id: str, deadline: Deadline) -> float:
+        """Wait for a token toward this server; returns seconds waited"""
+        limits = server_config.get('rate_limit') or {}
+        tps = float(limits.get('tps') or 0)
+        terminal_tps = float(limits.get('terminal_tps') or 0)
+        if tps <= 0 and terminal_tps <= 0:
+            return 0.0
+
+        key = server_key(server_config)
+        with self._lock:
+            stats = self._stats.setdefault(key, AdmissionStats())
+            now = time.monotonic()
+            self._sweep(now)
+            reserved = []
+            wait = 0.0
+            if tps > 0:
+                bucket = self._bucket(('server', key), tps, float(limits.get('burst') or tps))
+                wait = max(wait, bucket.reserve(now))
+                reserved.append(bucket)
+            if terminal_tps > 0:
+                bucket = self._bucket(('terminal', key, profile_id), terminal_tps, terminal_tps)
+                wait = max(wait, bucket.reserve(now))
+                reserved.append(bucket)
+
+            # Only callers that would have to wait count against the queue
+            rejection = None
+            if wait > deadline.remaining():
+                rejection = f"{key[1]}:{key[2]} rate limited; next slot in {wait:.1f}s"
+            elif wait > 0 and stats.queued >= int(limits.get('queue', DEFAULT_MAX_QUEUE)):
+                rejection = f"{key[1]}:{key[2]} admission queue full ({stats.queued} waiting)"
+            if rejection:
+                for bucket in reserved:
+                    bucket.refund()
+                stats.rejected += 1
+                raise AdmissionRejected(rejection)
+
+            if wait > 0:
+                stats.queued += 1
+                stats.peak_queued = max(stats.peak_queued, stats.queued)
+
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    stats.queued -= 1
+                    stats.delayed += 1
+                    stats.wait_total += wait
+                    stats.wait_max = max(stats.wait_max, wait)
+
+        with self._lock:
+            stats.admitted += 1
+        return wait
+
+    def summary(self, key: Optional[ServerKey] = None) -> Dict[str, Any]:
+        """Queue depth and wait metrics, for one server or all of them"""
+        def describe(stats: AdmissionStats) -> Dict[str, Any]:
+            return {
+                'queued': stats.queued,
+                'peak_queued': stats.peak_queued,
+                'admitted': stats.admitted,
+                'delayed': stats.delayed,
+                'rejected': stats.rejected,
+                'wait_avg': stats.wait_total / stats.delayed if stats.delayed else 0.0,
+                'wait_max': stats.wait_max,
+            }
+
+        with self._lock:
+            if key is not None:
+                return describe(self._stats.get(key, AdmissionStats()))
+            return {key: describe(stats) for key, stats in self._stats.items()}
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Authorization API
+HTTP JSON endpoints for checkouts and kiosks, on the same authorization
+pipeline, profiles and journal as the Streamlit UI
+
+    TERMINAL_STATE_DB=./state/terminal.db TERMINAL_API_KEY=secret python api.py --port 8081
+
+    POST /v1/authorize              {"pan", "expiry", "amount", "approval_code", "merchant_name",
+                                     "terminal"?, "server"?, "chip_data"? (hex)}
+    GET  /v1/transactions/<rrn>     ?terminal=MID:TID
+    GET  /v1/transactions           ?terminal, since, until, stan, approval_code, card_last4,
+                                     response_code, min_amount, max_amount, limit
+    GET  /v1/health
+"""
+
+import argparse
+import hmac
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from authorizer import DEFAULT_AUTHORIZATION_BUDGET, HostClient, authorize_sale, transaction_record
+from connections import ConnectionPool, LatencyTracker, SSLContextCache
+from export import mask_card
+from idempotency import DEFAULT_IDEMPOTENCY_WINDOW, SubmissionCache, idempotency_key
+from journal import JournalQuery
+from profiles import ProfileRegistry
+from reversals import ReversalQueue
+from state_backend import open_state_backend
+
+# Result keys returned to API clients (never the raw message or its fields)
+RESULT_KEYS = ('response_code', 'response_message', 'approval_code', 'full_auth_code', 'rrn', 'stan',
+               'receipt_number', 'batch_number', 'server', 'error', 'connected', 'reversal')
+
+# Largest request body accepted, in bytes
+MAX_BODY = 16384
+
+# Connections allowed to wait for a worker before new ones get 503
+DEFAULT_API_QUEUE = 64
+
+# Sent on connections turned away at accept time
+BUSY_BODY = b'{"error": "Server busy, retry shortly"}'
+BUSY_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n"
+                 b"Retry-After: 1\r\nConnection: close\r\nContent-Length: "
+                 + str(len(BUSY_BODY)).encode() + b"\r\n\r\n" + BUSY_BODY)
+
+
+def validate_sale(body: Dict[str, Any]) -> Tuple[List[str], Dict[str, Any]]:
+    """Same rules as the payment form; returns (errors, cleaned fields)"""
+    errors = []
+    pan = re.sub(r'\D', '', str(body.get('pan', '')))
+    if len(pan) != 16:
+        errors.append("pan must be exactly 16 digits")
+    expiry = re.sub(r'\D', '', str(body.get('expiry', '')))
+    if len(expiry) != 4 or not 1 <= int(expiry[:2] or 0) <= 12:
+        errors.append("expiry must be MMYY")
+    approval_code = re.sub(r'\D', '', str(body.get('approval_code', '')))
+    if len(approval_code) != 4:
+        errors.append("approval_code must be exactly 4 digits")
+    try:
+        amount = round(float(body.get('amount', 0)), 2)
+    except (TypeError, ValueError):
+        amount = 0.0
+    if amount < 0.01:
+        errors.append("amount must be at least 0.01")
+    chip_data = None
+    if body.get('chip_data'):
+        try:
+            chip_data = bytes.fromhex(str(body['chip_data']))
+        except ValueError:
+            errors.append("chip_data must be hex")
+    return errors, {
+        'pan': pan,
+        'expiry': expiry,
+        'approval_code': approval_code,
+        'amount': amount,
+        'merchant_name': str(body.get('merchant_name') or "API"),
+        'chip_data': chip_data,
+    }
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    """ISO date or date-time from a query string"""
+    return datetime.fromisoformat(value) if value else None
+
+
+class TerminalAPI:
+    """
+    Request handling independent of HTTP: authorize, look up and search.
+    Handlers return (status, payload). Sharing `client` and `submissions`
+    with the UI shares its connection pool, admission limits and duplicate
+    protection. Unconfirmed sales go to `reversals` when given.
+    """
+
+    def __init__(self, registry: ProfileRegistry, client: HostClient, submissions: SubmissionCache,
+                 server_configs: Callable[[], Optional[Dict[str, Dict]]], default_profile_id: str,
+                 reversals: Optional[ReversalQueue] = None):
+        self.registry = registry
+        self.client = client
+        self.submissions = submissions
+        self.server_configs = server_configs
+        self.default_profile_id = default_profile_id
+        self.reversals = reversals
+
+    def _profile(self, profile_id: Optional[str]):
+        profile_id = profile_id or self.default_profile_id
+        profile = self.registry.get(profile_id)
+        if profile is None and profile_id == self.default_profile_id:
+            profile = self.registry.get_or_create(*profile_id.split(":", 1))
+        return profile
+
+    def authorize(self, body: Dict[str, Any], key: Optional[str] = None) -> Tuple[int, Dict[str, Any]]:
+        errors, sale = validate_sale(body)
+        if errors:
+            return 400, {"errors": errors}
+        profile = self._profile(body.get('terminal'))
+        if profile is None:
+            return 404, {"error": f"Unknown terminal {body.get('terminal')}"}
+        server_configs = self.server_configs()
+        if not server_configs:
+            return 503, {"error": "No server configuration saved"}
+        server = body.get('server', 'primary')
+        if server not in server_configs:
+            return 400, {"errors": [f"server must be one of {', '.join(server_configs)}"]}
+
+        config = self.registry.config
+        budget = config.get('authorization_budget', DEFAULT_AUTHORIZATION_BUDGET)
+        # A client-chosen Idempotency-Key wins over the card/amount digest
+        # (which also catches the same sale keyed in the UI)
+        key = (f"{profile.profile_id}|{key}" if key else
+               idempotency_key(sale['pan'], sale['amount'], sale['approval_code'], profile.profile_id))
+        result, replayed = self.submissions.run(
+            key,
+            config.get('idempotency_window', DEFAULT_IDEMPOTENCY_WINDOW),
+            lambda: authorize_sale(self.client, profile, server_configs, server, budget=budget,
+                                   on_unconfirmed=self.reversals.enqueue if self.reversals else None, **sale),
+            wait=budget
+        )
+        if not replayed:
+            profile.record_transaction(transaction_record(result, sale['amount'], mask_card(sale['pan'])))
+
+        payload = {name: result[name] for name in RESULT_KEYS if name in result}
+        payload['terminal'] = profile.profile_id
+        payload['approved'] = result.get('response_code') == '00' and 'error' not in result
+        payload['replayed'] = replayed
+        if 'emv' in result:
+            payload['chip_data'] = bytes(result['emv'].raw).hex().upper()
+        if not result.get('connected', True):
+            return 503, payload  # no host saw it; safe to retry
+        if 'error' in result:
+            return 502, payload  # sent, outcome unknown
+        return 200, payload
+
+    def transaction(self, rrn: str, params: Dict[str, str]) -> Tuple[int, Dict[str, Any]]:
+        profile = self._profile(params.get('terminal'))
+        if profile is None:
+            return 404, {"error": f"Unknown terminal {params.get('terminal')}"}
+        matches = self.registry.backend.search_journal(JournalQuery(profile_id=profile.profile_id, rrn=rrn), 1)
+        if not matches:
+            return 404, {"error": f"No transaction with RRN {rrn}"}
+        return 200, matches[0]
+
+    def transactions(self, params: Dict[str, str]) -> Tuple[int, Dict[str, Any]]:
+        try:
+            query = JournalQuery(
+                profile_id=params.get('terminal'),
+                stan=params.get('stan'),
+                approval_code=params.get('approval_code'),
+                card_last4=params.get('card_last4'),
+                response_code=params.get('response_code'),
+                min_amount=float(params['min_amount']) if 'min_amount' in params else None,
+                max_amount=float(params['max_amount']) if 'max_amount' in params else None,
+                since=parse_date(params.get('since')),
+                until=parse_date(params.get('until'))
+            )
+            limit = min(1000, int(params.get('limit', 100)))
+        except ValueError as e:
+            return 400, {"errors": [str(e)]}
+        matches = self.registry.backend.search_journal(query, limit)
+        return 200, {"count": len(matches), "transactions": matches}
+
+    def health(self) -> Tuple[int, Dict[str, Any]]:
+        health = {"status": "ok", "idle_connections": self.client.pool.idle_count()}
+        if self.reversals is not None:
+            health["pending_reversals"] = len(self.reversals.pending())
+        return 200, health
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    """JSON over HTTP/1.1 keep-alive; routes to the server's TerminalAPI"""
+
+    protocol_version = "HTTP/1.1"
+    timeout = 5  # idle keep-alive connections give their worker back quickly
+    # Headers and body go out as two writes; with Nagle on, the body waits
+    # for the client's delayed ACK (~40 ms per response)
+    disable_nagle_algorithm = True
+
+    def _send(self, status: int, payload: Dict[str, Any]):
+        body = json.dumps(payload, default=lambda value: value.isoformat()
+                          if isinstance(value, datetime) else str(value)).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        api_key = self.server.api_key
+        if not api_key:
+            return True
+        supplied = self.headers.get("Authorization", "")
+        return hmac.compare_digest(supplied.encode(), f"Bearer {api_key}".encode())
+
+    def _route(self, method: str) -> Tuple[int, Dict[str, Any]]:
+        if not self._authorized():
+            return 401, {"error": "Missing or wrong API key"}
+        url = urlsplit(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        path = url.path.rstrip("/")
+        api = self.server.api
+
+        if method == "POST" and path == "/v1/authorize":
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_BODY:
+                return 413, {"error": "Request body too large"}
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                return 400, {"error": "Body must be JSON"}
+            if not isinstance(body, dict):
+                return 400, {"error": "Body must be a JSON object"}
+            return api.authorize(body, self.headers.get("Idempotency-Key"))
+        if method == "GET" and path.startswith("/v1/transactions/"):
+            return api.transaction(path.rsplit("/", 1)[1], params)
+        if method == "GET" and path == "/v1/transactions":
+            return api.transactions(params)
+        if method == "GET" and path == "/v1/health":
+            return api.health()
+        return 404, {"error": f"No route for {method} {url.path}"}
+
+    def _handle(self, method: str):
+        try:
+            status, payload = self._route(method)
+        except Exception as e:
+            status, payload = 500, {"error": f"Internal error: {e}"}
+        self._send(status, payload)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class APIServer(HTTPServer):
+    """
+    HTTP server serving each connection on a bounded worker pool. At most
+    `queue` connections wait for a worker; beyond that a connection is
+    answered 503 with Retry-After by a small rejector pool, or just closed
+    when that is busy too.
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, address, api: TerminalAPI, api_key: Optional[str] = None,
+                 workers: int = 32, verbose: bool = False, queue: int = DEFAULT_API_QUEUE):
+        super().__init__(address, APIHandler)
+        self.api = api
+        self.api_key = api_key
+        self.verbose = verbose
+        self.queue = queue
+        self.rejected = 0
+        self._workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api")
+        self._rejectors = ThreadPoolExecutor(max_workers=2, thread_name_prefix="api-busy")
+        self._lock = threading.Lock()
+        self._idle_workers = workers
+        self._waiting = 0
+        self._rejecting = 0
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            if self._idle_workers > self._waiting or self._waiting < self.queue:
+                self._waiting += 1
+                admitted, reject = True, False
+            else:
+                self.rejected += 1
+                admitted, reject = False, self._rejecting < 8
+                self._rejecting += reject
+        if admitted:
+            self._workers.submit(self._serve, request, client_address)
+        elif reject:
+            self._rejectors.submit(self._reject, request)
+        else:
+            self.shutdown_request(request)
+
+    def _serve(self, request, client_address):
+        with self._lock:
+            self._waiting -= 1
+            self._idle_workers -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._lock:
+                self._idle_workers += 1
+
+    def _reject(self, request):
+        """Read the request head, so closing does not reset the connection, then answer 503"""
+        try:
+            request.settimeout(1.0)
+            head = b""
+            while b"\r\n\r\n" not in head and len(head) < MAX_BODY:
+                chunk = request.recv(4096)
+                if not chunk:
+                    break
+                head += chunk
+            request.sendall(BUSY_RESPONSE)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+            with self._lock:
+                self._rejecting -= 1
+
+    def server_close(self):
+        super().server_close()
+        self._workers.shutdown(wait=False)
+        self._rejectors.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP JSON authorization API")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--db", help="State backend (default $TERMINAL_STATE_DB)")
+    parser.add_argument("--terminal", default="000000000009020:72000716",
+                        help="Profile used when a request names none (MID:TID)")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--queue", type=int, default=DEFAULT_API_QUEUE,
+                        help="Connections waiting for a worker before new ones get 503")
+    parser.add_argument("--cert", default="./certs/cad.crt", help="Client certificate for HTTPS hosts")
+    parser.add_argument("--key", default="./certs/client.key", help="Client key for HTTPS hosts")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    registry = ProfileRegistry(open_state_backend(args.db))
+    client = HostClient(SSLContextCache(), ConnectionPool(max_idle_per_server=args.workers),
+                        LatencyTracker(), args.cert, args.key)
+    server_configs = lambda: registry.config.get('server_config') or {}
+    reversals = ReversalQueue(client, registry.config.backend, server_configs)
+    reversals.start()
+    api = TerminalAPI(registry, client, SubmissionCache(),
+                      server_configs=server_configs,
+                      default_profile_id=args.terminal,
+                      reversals=reversals)
+    api_key = os.environ.get('TERMINAL_API_KEY')
+    if not api_key and args.host not in ("127.0.0.1", "localhost", "::1"):
+        parser.error("set TERMINAL_API_KEY before listening beyond localhost")
+
+    server = APIServer((args.host, args.port), api, api_key, args.workers, args.verbose, args.queue)
+    print(f"Authorization API on http://{args.host}:{args.port}/v1 ({args.workers} workers)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
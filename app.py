@@ -5,16 +5,32 @@ Online Authorization with Protocol 101.1
 """
 
 import streamlit as st
-import socket
-import ssl
-import struct
 import os
 import re
-from datetime import datetime
-from typing import Optional, Dict, Any, Tuple
+import sys
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple
 import time
 import hashlib
-import random
+import tempfile
+import threading
+
+from profiles import ProfileRegistry
+from connections import DEFAULT_TIMEOUTS, ConnectionPool, LatencyTracker, SSLContextCache, server_key
+from state_backend import CertificateStore, StateBackend, open_state_backend
+from capture import CaptureWriter
+from authorizer import DEFAULT_AUTHORIZATION_BUDGET, HostClient, authorize_sale, transaction_record
+from heartbeat import Heartbeat
+from api import APIServer, TerminalAPI
+from hostlink import HostLinkClient
+from probes import PROBE_PHASES, HealthProber, parse_endpoints
+from reversals import PENDING, ReversalQueue
+from receipts import Receipt, ReceiptCache, render_receipt
+from admission import DEFAULT_MAX_QUEUE
+from idempotency import DEFAULT_IDEMPOTENCY_WINDOW, SubmissionCache, idempotency_key
+from iso8583 import DEFAULT_DIALECT, DIALECTS
+from export import FORMATS, export_rows, mask_card, write_export
+from journal import JournalQuery
 
 # === PASSWORD PROTECTION === 
 APP_PASSWORD_HASH = "5e884898da28047151d0e56f8dc6292773603d0d6aabbdd62a11ef721d1542d8"  # "password"
@@ -34,65 +50,39 @@ if not st.session_state.authenticated:
     st.stop()
 # === END PASSWORD PROTECTION ===
 
-class ISO8583BaseITerminal:
-    """
-    ISO-8583 Base I Terminal - Protocol 101.1
-    Online Authorization with 4-Digit Approval Codes
-    """
-    
-    def __init__(self):
-        # Session state initialization
-        if 'merchant_id' not in st.session_state:
-            st.session_state.merchant_id = "000000000009020"
-        if 'terminal_id' not in st.session_state:
-            st.session_state.terminal_id = "72000716"
-        if 'stan_counter' not in st.session_state:
-            st.session_state.stan_counter = 100001
-        if 'batch_number' not in st.session_state:
-            st.session_state.batch_number = random.randint(1000, 9999)
-        if 'receipt_counter' not in st.session_state:
-            st.session_state.receipt_counter = 1
-        if 'last_transaction' not in st.session_state:
-            st.session_state.last_transaction = None
-        if 'transaction_history' not in st.session_state:
-            st.session_state.transaction_history = []
-        if 'cert_files_uploaded' not in st.session_state:
-            st.session_state.cert_files_uploaded = False
-        
-        # Server configuration with defaults
-        if 'server_config' not in st.session_state:
-            st.session_state.server_config = {
-                'primary': {
-                    'host': '102.163.40.20',
-                    'port': 8090,
-                    'protocol': 'HTTPS'
-                },
-                'secondary': {
-                    'host': '10.252.251.5', 
-                    'port': 8080,
-                    'protocol': 'HTTPS'
-                }
-            }
-            
-        # Create certs directory if it doesn't exist
-        self.CERT_DIR = "./certs"
-        os.makedirs(self.CERT_DIR, exist_ok=True)
-        
-        self.CLIENT_CERT = f"{self.CERT_DIR}/cad.crt" 
-        self.CLIENT_KEY = f"{self.CERT_DIR}/client.key"  # FIXED: Changed CLIENT_DIR to CERT_DIR
-        self.connection = None
+# === PROCESS-WIDE RESOURCES ===
+# Shared by every browser session in this process
 
-    def setup_page(self):
-        """Configure Streamlit page"""
-        st.set_page_config(
-            page_title="ISO-8583 Base I Terminal",
-            page_icon="💳",
-            layout="wide",
-            initial_sidebar_state="expanded"
-        )
-        
-        # Custom CSS for better styling
-        st.markdown("""
+DEFAULT_MERCHANT_ID = "000000000009020"
+DEFAULT_TERMINAL_ID = "72000716"
+
+DEFAULT_SERVER_CONFIG = {
+    'primary': {
+        'host': '102.163.40.20',
+        'port': 8090,
+        'protocol': 'HTTPS',
+        'keep_alive': False
+    },
+    'secondary': {
+        'host': '10.252.251.5', 
+        'port': 8080,
+        'protocol': 'HTTPS',
+        'keep_alive': False
+    }
+}
+
+CERT_DIR = "./certs"
+
+# Subheader icons for receipt sections
+RECEIPT_SECTION_ICONS = {
+    "Merchant Information": "🏪",
+    "Transaction Details": "📊",
+    "Card Information": "💳",
+    "Authorization Details": "🔐",
+}
+
+# Page styling, injected on every rerun but built once per process
+PAGE_CSS = """
         <style>
         .main-header {
             font-size: 2.5rem;
@@ -122,16 +112,236 @@ class ISO8583BaseITerminal:
             background-color: #fff3cd;
         }
         </style>
-        """, unsafe_allow_html=True)
+        """
+
+# Seconds between 0800 echo tests on keep-alive servers (0 disables)
+DEFAULT_HEARTBEAT_INTERVAL = 30.0
+
+# Seconds between scheduled health probes of every endpoint (0 disables)
+DEFAULT_PROBE_INTERVAL = 60.0
+
+@st.cache_resource
+def get_state_backend() -> StateBackend:
+    """Shared state store ($TERMINAL_STATE_DB selects SQLite for multi-replica setups)"""
+    return open_state_backend()
+
+@st.cache_resource
+def get_profile_registry() -> ProfileRegistry:
+    """Terminal profiles hosted by this process"""
+    return ProfileRegistry(get_state_backend())
+
+@st.cache_resource
+def get_certificate_store() -> CertificateStore:
+    """Client certificates from the backend, mirrored to local files"""
+    os.makedirs(CERT_DIR, exist_ok=True)
+    return CertificateStore(get_profile_registry().config, f"{CERT_DIR}/cad.crt", f"{CERT_DIR}/client.key",
+                            get_ssl_context_cache())
+
+@st.cache_resource
+def get_ssl_context_cache() -> SSLContextCache:
+    """Client SSL contexts shared by all profiles"""
+    return SSLContextCache()
+
+@st.cache_resource
+def get_connection_pool() -> ConnectionPool:
+    """Keep-alive host connections shared by all profiles"""
+    return ConnectionPool()
+
+@st.cache_resource
+def get_latency_tracker() -> LatencyTracker:
+    """Observed host latencies that drive adaptive timeouts"""
+    return LatencyTracker()
+
+@st.cache_resource
+def get_host_client() -> HostClient:
+    """Host I/O (pooling, latency-driven timeouts, capture) shared by all sessions"""
+    return HostClient(
+        ssl_contexts=get_ssl_context_cache(),
+        pool=get_connection_pool(),
+        latency=get_latency_tracker(),
+        cert_file=f"{CERT_DIR}/cad.crt",
+        key_file=f"{CERT_DIR}/client.key",
+        capture=get_capture_writer()
+    )
+
+@st.cache_resource
+def get_submission_cache() -> SubmissionCache:
+    """Recent and in-flight authorizations, so repeats are not sent twice"""
+    return SubmissionCache()
+
+@st.cache_resource
+def get_heartbeat() -> Heartbeat:
+    """Background echo tests keeping pooled host links warm (the daemon's links when one is linked)"""
+    config = get_profile_registry().config
+    heartbeat = Heartbeat(
+        get_host_client(),
+        config.backend,
+        server_configs=lambda: config.get('server_config') or DEFAULT_SERVER_CONFIG,
+        interval=lambda: config.get('heartbeat_interval', DEFAULT_HEARTBEAT_INTERVAL)
+    )
+    if not os.environ.get('TERMINAL_HOSTLINK'):
+        heartbeat.start()
+    return heartbeat
+
+def probe_targets(config) -> Dict[str, Dict]:
+    """Both servers plus the extra endpoints; only the servers get the 0800 echo"""
+    echo = config.get('probe_echo', True)
+    targets = {name: dict(server_config, echo=echo)
+               for name, server_config in (config.get('server_config') or DEFAULT_SERVER_CONFIG).items()}
+    for endpoint in config.get('probe_endpoints') or []:
+        targets[endpoint['name']] = dict(endpoint, echo=False)
+    return targets
+
+@st.cache_resource
+def get_health_prober() -> HealthProber:
+    """Scheduled and on-demand concurrent probes of every endpoint (none when a daemon is linked)"""
+    config = get_profile_registry().config
+    prober = HealthProber(
+        get_host_client(),
+        endpoints=lambda: probe_targets(config),
+        interval=lambda: config.get('probe_interval', DEFAULT_PROBE_INTERVAL),
+        echo=get_heartbeat().echo
+    )
+    if not os.environ.get('TERMINAL_HOSTLINK'):
+        prober.start()
+    return prober
+
+@st.cache_resource
+def get_reversal_queue() -> ReversalQueue:
+    """Reversals of unconfirmed sales, sent in the background (by the daemon when one is linked)"""
+    config = get_profile_registry().config
+    reversals = ReversalQueue(
+        get_host_client(),
+        config.backend,
+        server_configs=lambda: config.get('server_config') or DEFAULT_SERVER_CONFIG
+    )
+    if not os.environ.get('TERMINAL_HOSTLINK'):
+        reversals.start()
+    return reversals
+
+@st.cache_resource
+def get_receipt_cache() -> ReceiptCache:
+    """Receipts rendered at sale time, for redisplay, download and reprint"""
+    return ReceiptCache(directory=os.environ.get('TERMINAL_RECEIPT_DIR', './state/receipts'))
+
+@st.cache_resource
+def get_api_server() -> Optional[APIServer]:
+    """
+    JSON API on $TERMINAL_API_PORT, sharing host connections and duplicate
+    protection with the UI. Off when a daemon is linked: the API would open
+    host connections of its own beside the daemon's.
+    """
+    port = os.environ.get('TERMINAL_API_PORT')
+    if not port or os.environ.get('TERMINAL_HOSTLINK'):
+        return None
+    registry = get_profile_registry()
+    api = TerminalAPI(
+        registry,
+        get_host_client(),
+        get_submission_cache(),
+        server_configs=lambda: registry.config.get('server_config') or DEFAULT_SERVER_CONFIG,
+        default_profile_id=f"{DEFAULT_MERCHANT_ID}:{DEFAULT_TERMINAL_ID}",
+        reversals=get_reversal_queue()
+    )
+    api_key = os.environ.get('TERMINAL_API_KEY')
+    server = APIServer(("0.0.0.0" if api_key else "127.0.0.1", int(port)), api, api_key)
+    threading.Thread(target=server.serve_forever, name="api", daemon=True).start()
+    return server
+
+@st.cache_resource
+def get_hostlink_client() -> Optional[HostLinkClient]:
+    """Link to the host-link daemon at $TERMINAL_HOSTLINK, which then sends every sale"""
+    path = os.environ.get('TERMINAL_HOSTLINK')
+    if not path:
+        return None
+    # The daemon reads server settings from the shared backend
+    config = get_profile_registry().config
+    if config.get('server_config') is None:
+        config.set('server_config', DEFAULT_SERVER_CONFIG)
+    return HostLinkClient(path)
+
+@st.cache_resource
+def get_capture_writer() -> Optional[CaptureWriter]:
+    """Wire capture log, enabled by $TERMINAL_CAPTURE (path of the log file)"""
+    path = os.environ.get('TERMINAL_CAPTURE')
+    if not path:
+        return None
+    token_key = os.environ.get('TERMINAL_CAPTURE_KEY')
+    return CaptureWriter(path, token_key=bytes.fromhex(token_key) if token_key else None)
+
+def escape_markdown(text: str) -> str:
+    """Text shown verbatim by st.markdown (no emphasis, links or LaTeX)"""
+    return re.sub(r'([\\`*_{}\[\]()#+\-.!$|<>~])', r'\\\1', text)
+
+def count_script_run(scope: str):
+    """Tally full reruns ('app') and fragment reruns for the debug footprint"""
+    runs = st.session_state.setdefault('script_runs', {})
+    runs[scope] = runs.get(scope, 0) + 1
+
+# Seconds between refreshes of the Host Health panel (its fragment only)
+HEALTH_REFRESH_INTERVAL = 15
+
+class ISO8583BaseITerminal:
+    """
+    ISO-8583 Base I Terminal - Protocol 101.1
+    Online Authorization with 4-Digit Approval Codes
+    """
+    
+    def __init__(self):
+        # Terminal profiles live process-wide; the session only picks one
+        self.profiles = get_profile_registry()
+        if 'active_profile_id' not in st.session_state:
+            default_profile = self.profiles.get_or_create(DEFAULT_MERCHANT_ID, DEFAULT_TERMINAL_ID)
+            st.session_state.active_profile_id = default_profile.profile_id
+        self.profile = self.profiles.get(st.session_state.active_profile_id)
+        if self.profile is None:
+            self.profile = self.profiles.get_or_create(DEFAULT_MERCHANT_ID, DEFAULT_TERMINAL_ID)
+            st.session_state.active_profile_id = self.profile.profile_id
+
+        # Server configuration from the shared backend (cached, refreshed on change)
+        self.config = self.profiles.config
+        self.server_config = self.config.get('server_config') or DEFAULT_SERVER_CONFIG
+            
+        self.CERT_DIR = CERT_DIR
+        self.CLIENT_CERT = f"{self.CERT_DIR}/cad.crt" 
+        self.CLIENT_KEY = f"{self.CERT_DIR}/client.key"  # FIXED: Changed CLIENT_DIR to CERT_DIR
+        
+        # Certificates uploaded on any replica are mirrored into CERT_DIR
+        self.certificates = get_certificate_store()
+        self.ssl_contexts = get_ssl_context_cache()
+        # New files on disk also drop the cached contexts and validation results
+        self.certificates.sync()
+        
+        # Host I/O and link heartbeat shared by all sessions
+        self.host = get_host_client()
+        self.heartbeat = get_heartbeat()
+        self.prober = get_health_prober()
+        get_api_server()
+        self.submissions = get_submission_cache()
+        self.reversals = get_reversal_queue()
+        self.receipts = get_receipt_cache()
+        self.hostlink = get_hostlink_client()
+
+    def setup_page(self):
+        """Configure Streamlit page"""
+        st.set_page_config(
+            page_title="ISO-8583 Base I Terminal",
+            page_icon="💳",
+            layout="wide",
+            initial_sidebar_state="expanded"
+        )
+        
+        # Custom CSS for better styling (built once per process)
+        st.markdown(PAGE_CSS, unsafe_allow_html=True)
 
     def render_certificate_upload(self):
         """Render certificate upload section"""
         st.sidebar.subheader("🔐 Certificate Setup")
         
-        if st.session_state.cert_files_uploaded:
+        if self.certificates.uploaded and not st.session_state.get('cert_reupload', False):
             st.sidebar.success("✅ Certificates Uploaded")
             if st.sidebar.button("🔄 Re-upload Certificates"):
-                st.session_state.cert_files_uploaded = False
+                st.session_state.cert_reupload = True
                 st.rerun()
             return True
         
@@ -153,14 +363,10 @@ class ISO8583BaseITerminal:
         if cert_file and key_file:
             # Save uploaded files
             try:
-                with open(self.CLIENT_CERT, "wb") as f:
-                    f.write(cert_file.getvalue())
-                
-                with open(self.CLIENT_KEY, "wb") as f:
-                    f.write(key_file.getvalue())
+                self.certificates.save(cert_file.getvalue(), key_file.getvalue())
                 
                 st.sidebar.success("✅ Certificates saved successfully!")
-                st.session_state.cert_files_uploaded = True
+                st.session_state.cert_reupload = False
                 st.rerun()
                 
             except Exception as e:
@@ -174,23 +380,25 @@ class ISO8583BaseITerminal:
             if st.button("Save Certificate Text"):
                 if cert_text and key_text:
                     try:
-                        with open(self.CLIENT_CERT, "w") as f:
-                            f.write(cert_text)
-                        with open(self.CLIENT_KEY, "w") as f:
-                            f.write(key_text)
+                        self.certificates.save(cert_text.encode(), key_text.encode())
                         st.success("Certificates saved!")
-                        st.session_state.cert_files_uploaded = True
+                        st.session_state.cert_reupload = False
                         st.rerun()
                     except Exception as e:
                         st.error(f"Error: {e}")
         
         return False
 
+    @st.fragment
     def render_server_configuration(self):
-        """Render server configuration section"""
-        st.sidebar.subheader("🌐 Server Configuration")
+        """Render server configuration section (reruns on its own)"""
+        count_script_run('servers')
+        st.subheader("🌐 Server Configuration")
         
-        with st.sidebar.expander("🔧 Configure Servers", expanded=True):
+        with st.expander("🔧 Configure Servers", expanded=True):
+            if st.session_state.pop('server_config_saved', False):
+                st.success("✅ Server configuration saved!")
+            
             st.markdown("### Primary Server")
             
             col1, col2 = st.columns(2)
@@ -198,7 +406,7 @@ class ISO8583BaseITerminal:
                 primary_protocol = st.selectbox(
                     "Protocol",
                     ["HTTPS", "HTTP"],
-                    index=0,
+                    index=["HTTPS", "HTTP"].index(self.server_config['primary']['protocol']),
                     key="primary_protocol"
                 )
             
@@ -207,15 +415,58 @@ class ISO8583BaseITerminal:
                     "Port",
                     min_value=1,
                     max_value=65535,
-                    value=8090,
+                    value=int(self.server_config['primary']['port']),
                     key="primary_port"
                 )
             
             primary_host = st.text_input(
                 "Primary Server Host/IP",
-                value="102.163.40.20",
+                value=self.server_config['primary']['host'],
                 key="primary_host"
             )
+
+            primary_keep_alive = st.checkbox(
+                "Keep connections alive (shared pool)",
+                value=self.server_config['primary'].get('keep_alive', False),
+                key="primary_keep_alive",
+                help="Reuse host connections across transactions and terminals, if the acquirer allows it"
+            )
+
+            primary_dialect = st.selectbox(
+                "Message encoding",
+                list(DIALECTS),
+                index=list(DIALECTS).index(self.server_config['primary'].get('dialect', DEFAULT_DIALECT)),
+                format_func=lambda name: DIALECTS[name].label,
+                key="primary_dialect",
+                help="How MTI, bitmap and numeric fields go on the wire for this host"
+            )
+
+            primary_limit = self.server_config['primary'].get('rate_limit') or {}
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                primary_tps = st.number_input(
+                    "Max TPS",
+                    min_value=0.0,
+                    value=float(primary_limit.get('tps', 0)),
+                    key="primary_tps",
+                    help="Contracted transactions per second toward this host (0 = unlimited)"
+                )
+            with col2:
+                primary_terminal_tps = st.number_input(
+                    "Per-terminal TPS",
+                    min_value=0.0,
+                    value=float(primary_limit.get('terminal_tps', 0)),
+                    key="primary_terminal_tps",
+                    help="Limit for each terminal toward this host (0 = unlimited)"
+                )
+            with col3:
+                primary_queue = st.number_input(
+                    "Queue",
+                    min_value=0,
+                    value=int(primary_limit.get('queue', DEFAULT_MAX_QUEUE)),
+                    key="primary_queue",
+                    help="Transactions allowed to wait for a slot; more are rejected"
+                )
             
             st.markdown("### Secondary Server")
             
@@ -224,7 +475,7 @@ class ISO8583BaseITerminal:
                 secondary_protocol = st.selectbox(
                     "Protocol", 
                     ["HTTPS", "HTTP"],
-                    index=0,
+                    index=["HTTPS", "HTTP"].index(self.server_config['secondary']['protocol']),
                     key="secondary_protocol"
                 )
             
@@ -233,86 +484,273 @@ class ISO8583BaseITerminal:
                     "Port",
                     min_value=1,
                     max_value=65535, 
-                    value=8080,
+                    value=int(self.server_config['secondary']['port']),
                     key="secondary_port"
                 )
             
             secondary_host = st.text_input(
                 "Secondary Server Host/IP",
-                value="10.252.251.5",
+                value=self.server_config['secondary']['host'],
                 key="secondary_host"
             )
+
+            secondary_keep_alive = st.checkbox(
+                "Keep connections alive (shared pool)",
+                value=self.server_config['secondary'].get('keep_alive', False),
+                key="secondary_keep_alive",
+                help="Reuse host connections across transactions and terminals, if the acquirer allows it"
+            )
+
+            secondary_dialect = st.selectbox(
+                "Message encoding",
+                list(DIALECTS),
+                index=list(DIALECTS).index(self.server_config['secondary'].get('dialect', DEFAULT_DIALECT)),
+                format_func=lambda name: DIALECTS[name].label,
+                key="secondary_dialect",
+                help="How MTI, bitmap and numeric fields go on the wire for this host"
+            )
+
+            secondary_limit = self.server_config['secondary'].get('rate_limit') or {}
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                secondary_tps = st.number_input(
+                    "Max TPS",
+                    min_value=0.0,
+                    value=float(secondary_limit.get('tps', 0)),
+                    key="secondary_tps",
+                    help="Contracted transactions per second toward this host (0 = unlimited)"
+                )
+            with col2:
+                secondary_terminal_tps = st.number_input(
+                    "Per-terminal TPS",
+                    min_value=0.0,
+                    value=float(secondary_limit.get('terminal_tps', 0)),
+                    key="secondary_terminal_tps",
+                    help="Limit for each terminal toward this host (0 = unlimited)"
+                )
+            with col3:
+                secondary_queue = st.number_input(
+                    "Queue",
+                    min_value=0,
+                    value=int(secondary_limit.get('queue', DEFAULT_MAX_QUEUE)),
+                    key="secondary_queue",
+                    help="Transactions allowed to wait for a slot; more are rejected"
+                )
+            
+            st.markdown("### Timeouts")
+            
+            budget = st.number_input(
+                "Authorization deadline (s)",
+                min_value=1.0,
+                max_value=120.0,
+                value=float(self.config.get('authorization_budget', DEFAULT_AUTHORIZATION_BUDGET)),
+                step=1.0,
+                help="One budget for resolve, connect, handshake, send and receive, including failover"
+            )
+            
+            timeouts = self.server_config['primary'].get('timeouts', DEFAULT_TIMEOUTS)
+            col1, col2 = st.columns(2)
+            with col1:
+                connect_max = st.number_input(
+                    "Max connect (s)",
+                    min_value=0.5,
+                    max_value=60.0,
+                    value=float(timeouts['connect'][1]),
+                    step=0.5
+                )
+            with col2:
+                response_max = st.number_input(
+                    "Max response (s)",
+                    min_value=1.0,
+                    max_value=120.0,
+                    value=float(timeouts['response'][1]),
+                    step=1.0
+                )
+            st.caption("Below these caps, timeouts adapt to 3× each server's observed p99 latency")
+            
+            idempotency_window = st.number_input(
+                "Duplicate window (s, 0 = off)",
+                min_value=0.0,
+                max_value=3600.0,
+                value=float(self.config.get('idempotency_window', DEFAULT_IDEMPOTENCY_WINDOW)),
+                step=10.0,
+                help="Identical card, amount and approval code on this terminal returns the earlier result"
+            )
+            
+            heartbeat_interval = st.number_input(
+                "Heartbeat interval (s, 0 = off)",
+                min_value=0.0,
+                max_value=600.0,
+                value=float(self.config.get('heartbeat_interval', DEFAULT_HEARTBEAT_INTERVAL)),
+                step=5.0,
+                help="0800 echo tests on keep-alive servers; skipped while real traffic keeps the link busy"
+            )
+            
+            st.markdown("### Health Probes")
+            
+            probe_interval = st.number_input(
+                "Probe interval (s, 0 = off)",
+                min_value=0.0,
+                max_value=3600.0,
+                value=float(self.config.get('probe_interval', DEFAULT_PROBE_INTERVAL)),
+                step=10.0,
+                help="Connect, handshake and echo checks of every endpoint, all at once"
+            )
+            probe_echo = st.checkbox(
+                "Include 0800 echo",
+                value=self.config.get('probe_echo', True),
+                help="Send an echo test on each probe connection to the primary and secondary servers"
+            )
+            probe_endpoints = st.text_area(
+                "Extra endpoints",
+                value="\n".join(
+                    f"{'https://' if endpoint['protocol'] == 'HTTPS' else ''}{endpoint['host']}:{endpoint['port']}"
+                    for endpoint in self.config.get('probe_endpoints') or []
+                ),
+                help="One [https://]host:port per line, probed for connect and handshake only"
+            )
             
             # Save server configuration
             if st.button("💾 Save Server Config"):
-                st.session_state.server_config = {
+                try:
+                    extra_endpoints = parse_endpoints(probe_endpoints)
+                except ValueError as e:
+                    st.error(f"❌ Extra endpoints: {e}")
+                    return
+                timeouts = {
+                    'factor': DEFAULT_TIMEOUTS['factor'],
+                    'connect': [min(DEFAULT_TIMEOUTS['connect'][0], connect_max), connect_max],
+                    'response': [min(DEFAULT_TIMEOUTS['response'][0], response_max), response_max]
+                }
+                self.server_config = {
                     'primary': {
                         'host': primary_host,
                         'port': primary_port,
-                        'protocol': primary_protocol
+                        'protocol': primary_protocol,
+                        'keep_alive': primary_keep_alive,
+                        'dialect': primary_dialect,
+                        'rate_limit': {
+                            'tps': primary_tps,
+                            'burst': max(1.0, primary_tps),
+                            'terminal_tps': primary_terminal_tps,
+                            'queue': primary_queue
+                        },
+                        'timeouts': timeouts
                     },
                     'secondary': {
                         'host': secondary_host,
                         'port': secondary_port,
-                        'protocol': secondary_protocol
+                        'protocol': secondary_protocol,
+                        'keep_alive': secondary_keep_alive,
+                        'dialect': secondary_dialect,
+                        'rate_limit': {
+                            'tps': secondary_tps,
+                            'burst': max(1.0, secondary_tps),
+                            'terminal_tps': secondary_terminal_tps,
+                            'queue': secondary_queue
+                        },
+                        'timeouts': timeouts
                     }
                 }
-                st.success("✅ Server configuration saved!")
+                self.config.set('server_config', self.server_config)
+                self.config.set('authorization_budget', budget)
+                self.config.set('heartbeat_interval', heartbeat_interval)
+                self.config.set('idempotency_window', idempotency_window)
+                self.config.set('probe_interval', probe_interval)
+                self.config.set('probe_echo', probe_echo)
+                self.config.set('probe_endpoints', extra_endpoints)
+                self.prober.forget(list(probe_targets(self.config)))
+                # The header and payment section show servers too
+                st.session_state.server_config_saved = True
+                st.rerun()
                 
         # Display current configuration
-        st.sidebar.markdown("### Current Server Config")
-        config = st.session_state.server_config
-        st.sidebar.markdown(f"""
+        st.markdown("### Current Server Config")
+        config = self.server_config
+        st.markdown(f"""
         <div style="border: 1px solid #6f42c1; border-radius: 5px; padding: 15px; margin: 10px 0; background-color: #e9ecef;">
         <strong>Primary:</strong><br>
         {config['primary']['protocol']}://{config['primary']['host']}:{config['primary']['port']}<br>
+        Encoding: {DIALECTS[config['primary'].get('dialect', DEFAULT_DIALECT)].label}<br>
+        {self.describe_timeouts(config['primary'])}<br>
         <strong>Secondary:</strong><br>  
-        {config['secondary']['protocol']}://{config['secondary']['host']}:{config['secondary']['port']}
+        {config['secondary']['protocol']}://{config['secondary']['host']}:{config['secondary']['port']}<br>
+        Encoding: {DIALECTS[config['secondary'].get('dialect', DEFAULT_DIALECT)].label}<br>
+        {self.describe_timeouts(config['secondary'])}
         </div>
         """, unsafe_allow_html=True)
 
+    def describe_timeouts(self, server_config: Dict) -> str:
+        """Current adaptive connect/response timeouts for a server"""
+        key = server_key(server_config)
+        timeouts = server_config.get('timeouts')
+        connect = self.host.latency.adaptive_timeout(key, 'connect', timeouts)
+        response = self.host.latency.adaptive_timeout(key, 'response', timeouts)
+        description = f"<small>Timeouts: connect {connect:.1f}s • response {response:.1f}s"
+        if self.hostlink is not None:
+            description += "<br>Heartbeat: run by the host-link daemon"
+        elif server_config.get('keep_alive', False):
+            echo = self.host.latency.percentile(key, 'echo', 50)
+            rtt = f"{echo * 1000:.0f} ms" if echo is not None else "n/a"
+            status = self.heartbeat.last_round.get(key, "pending")
+            description += f"<br>Heartbeat: {status} • echo RTT {rtt}"
+        limits = server_config.get('rate_limit') or {}
+        if limits.get('tps') or limits.get('terminal_tps'):
+            stats = self.host.admission.summary(key)
+            description += (f"<br>Admission: {stats['queued']} waiting (peak {stats['peak_queued']}) • "
+                            f"avg wait {stats['wait_avg'] * 1000:.0f} ms • {stats['rejected']} rejected")
+        return description + "</small>"
+
+    @st.fragment
     def render_merchant_configuration(self):
-        """Render merchant configuration section"""
-        st.sidebar.subheader("🏪 Merchant Configuration")
+        """Render merchant configuration section (reruns on its own)"""
+        count_script_run('merchant')
+        st.subheader("🏪 Merchant Configuration")
+        
+        # Active terminal for this session
+        profile_ids = self.profiles.profile_ids()
+        active_id = st.selectbox(
+            "Active Terminal",
+            profile_ids,
+            index=profile_ids.index(self.profile.profile_id),
+            format_func=lambda pid: "MID {} • TID {}".format(*pid.split(":", 1)),
+            help=f"{len(profile_ids)} terminal(s) hosted in this process"
+        )
+        if active_id != self.profile.profile_id:
+            st.session_state.active_profile_id = active_id
+            st.rerun()
         
-        with st.sidebar.expander("📝 Configure Merchant", expanded=True):
+        with st.expander("📝 Configure Merchant", expanded=True):
             merchant_id = st.text_input(
                 "Merchant ID",
-                value=st.session_state.merchant_id,
+                value=self.profile.merchant_id,
                 help="Your unique merchant identification number"
             )
             
             terminal_id = st.text_input(
                 "Terminal ID", 
-                value=st.session_state.terminal_id,
+                value=self.profile.terminal_id,
                 help="Your terminal identification number"
             )
             
             if st.button("💾 Save Merchant Config"):
                 if merchant_id and terminal_id:
-                    st.session_state.merchant_id = merchant_id
-                    st.session_state.terminal_id = terminal_id
+                    # Saving new IDs adds (or switches to) that terminal's profile
+                    profile = self.profiles.get_or_create(merchant_id, terminal_id)
+                    st.session_state.active_profile_id = profile.profile_id
                     st.success("✅ Merchant configuration saved!")
+                    st.rerun()
                 else:
                     st.error("❌ Please fill in both Merchant ID and Terminal ID")
+            
+            if len(profile_ids) > 1 and st.button("🗑️ Remove This Terminal"):
+                self.profiles.remove(self.profile.profile_id)
+                del st.session_state.active_profile_id
+                st.rerun()
 
     def check_certificates(self):
-        """Check if certificates exist and are valid"""
-        if not os.path.exists(self.CLIENT_CERT) or not os.path.exists(self.CLIENT_KEY):
-            return False, "Certificate files missing"
-        
-        try:
-            # Check if files are not empty
-            if os.path.getsize(self.CLIENT_CERT) == 0 or os.path.getsize(self.CLIENT_KEY) == 0:
-                return False, "Certificate files are empty"
-            
-            # Try to load certificates to verify they're valid
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            context.load_cert_chain(certfile=self.CLIENT_CERT, keyfile=self.CLIENT_KEY)
-            return True, "Certificates are valid"
-            
-        except Exception as e:
-            return False, f"Certificate error: {e}"
+        """Check if certificates exist and are valid (shared, cached result)"""
+        return self.ssl_contexts.check(self.CLIENT_CERT, self.CLIENT_KEY)
 
     def render_sidebar(self):
         """Render sidebar with merchant info and settings"""
@@ -340,14 +778,32 @@ class ISO8583BaseITerminal:
                 if st.button("🔄 Test Connection"):
                     self.test_connection()
                     
-                if st.button("📋 Transaction History"):
-                    self.show_transaction_history()
+                # Shown in the main area, where it refreshes on its own
+                st.toggle("📋 Transaction History", key="show_history")
                     
                 # Debug toggle
                 st.session_state.debug_mode = st.checkbox("🔧 Debug Mode", value=False)
+                if st.session_state.debug_mode:
+                    self.render_session_footprint()
             else:
                 st.warning("⚠️ Please upload certificates to continue")
 
+    def render_session_footprint(self):
+        """Per-session memory and last rerun CPU, to keep per-session work in check"""
+        state_bytes = sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in st.session_state.items())
+        last_cpu = st.session_state.get('last_rerun_cpu_ms')
+        st.caption(
+            f"Session state: {len(st.session_state)} keys, ~{state_bytes / 1024:.1f} KB • "
+            f"last rerun CPU: {f'{last_cpu:.1f} ms' if last_cpu is not None else 'n/a'}"
+        )
+        # Script executions since the last sale: 'app' is a full rerun, the rest are fragments
+        runs = st.session_state.get('script_runs', {})
+        baseline = st.session_state.get('runs_at_last_sale', {})
+        since_sale = {scope: count - baseline.get(scope, 0) for scope, count in runs.items()}
+        st.caption("Script runs since last sale: " + (
+            " • ".join(f"{scope} {count}" for scope, count in sorted(since_sale.items()) if count) or "none"
+        ))
+
     def render_demo_mode(self):
         """Render demo mode when certificates aren't available"""
         st.warning("🔒 DEMO MODE - Certificates not configured")
@@ -394,10 +850,10 @@ class ISO8583BaseITerminal:
             'approval_code': '1234',
             'full_auth_code': '123456',
             'response_code': '00',
-            'rrn': f"{st.session_state.stan_counter:012d}",
-            'receipt_number': st.session_state.receipt_counter,
-            'stan': str(st.session_state.stan_counter).zfill(6),
-            'batch_number': st.session_state.batch_number
+            'rrn': f"{self.profile.stan_counter:012d}",
+            'receipt_number': self.profile.receipt_counter,
+            'stan': str(self.profile.stan_counter).zfill(6),
+            'batch_number': self.profile.batch_number
         }
         
         # Add to transaction history
@@ -414,10 +870,10 @@ class ISO8583BaseITerminal:
             'batch_number': demo_result['batch_number'],
             'demo': True
         }
-        st.session_state.transaction_history.append(transaction_record)
+        self.profile.record_transaction(transaction_record)
         
-        # Show receipt
-        self.show_receipt(demo_data, demo_result)
+        # Show receipt (not cached: demo numbers are not consumed)
+        self.show_receipt(self.build_receipt(demo_data, demo_result, transaction_record['timestamp']))
 
     def render_main_header(self):
         """Render main header"""
@@ -427,13 +883,13 @@ class ISO8583BaseITerminal:
                    unsafe_allow_html=True)
         
         # Show current configuration
-        config = st.session_state.server_config
+        config = self.server_config
         st.markdown(f"""
         <div style="border: 1px solid #17a2b8; border-radius: 5px; padding: 15px; margin: 10px 0; background-color: #d1ecf1;">
             <strong>🟢 Online Authorization Mode</strong><br>
             • <strong>4-Digit Approval Codes</strong> (Protocol 101.1)<br>
-            • Merchant ID: {st.session_state.merchant_id}<br>
-            • Terminal ID: {st.session_state.terminal_id}<br>
+            • Merchant ID: {self.profile.merchant_id}<br>
+            • Terminal ID: {self.profile.terminal_id}<br>
             • Primary Server: {config['primary']['protocol']}://{config['primary']['host']}:{config['primary']['port']}<br>
             • Secondary Server: {config['secondary']['protocol']}://{config['secondary']['host']}:{config['secondary']['port']}
         </div>
@@ -479,7 +935,7 @@ class ISO8583BaseITerminal:
         return True, clean_code
 
     def render_payment_form(self):
-        """Render payment form"""
+        """Render payment form (inside an st.form, so inputs submit together)"""
         st.header("📝 Payment Details")
         
         col1, col2 = st.columns(2)
@@ -534,7 +990,12 @@ class ISO8583BaseITerminal:
         
         st.session_state.selected_server = server_choice.lower().replace(" ", "_")
         
-        return {
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col2:
+            submitted = st.form_submit_button("🚀 Process Online Authorization", type="primary",
+                                              use_container_width=True)
+        
+        return submitted, {
             'card_input': card_input,
             'expiry_input': expiry_input,
             'amount': amount,
@@ -574,10 +1035,7 @@ class ISO8583BaseITerminal:
 
     def format_card_display(self, pan: str) -> str:
         """Format card for display - show only last 4 digits"""
-        clean_pan = re.sub(r'\D', '', pan)
-        if len(clean_pan) == 16:
-            return f"**** **** **** {clean_pan[12:16]}"
-        return clean_pan
+        return mask_card(pan)
 
     def format_card_receipt(self, pan: str) -> str:
         """Format card for receipt - show only last 4 digits"""
@@ -591,262 +1049,45 @@ class ISO8583BaseITerminal:
         clean_expiry = re.sub(r'\D', '', expiry)
         return f"{clean_expiry[:2]}/{clean_expiry[2:4]}"
 
-    def create_ssl_context(self):
-        """Create SSL context"""
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        
-        try:
-            context.load_cert_chain(certfile=self.CLIENT_CERT, keyfile=self.CLIENT_KEY)
-            return context, True
-        except Exception as e:
-            return f"Certificate error: {e}", False
-
-    def connect_to_server(self, server_type: str = 'primary'):
-        """Connect to payment server with protocol support"""
-        try:
-            server_config = st.session_state.server_config[server_type]
-            
-            # Check if HTTP is selected (no SSL)
-            if server_config['protocol'] == 'HTTP':
-                st.warning("🔓 Using HTTP connection (not secure)")
-                self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.connection.settimeout(10)
-                self.connection.connect((server_config['host'], server_config['port']))
-                return "Connected successfully via HTTP", True
-            else:
-                # HTTPS with SSL
-                raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                raw_socket.settimeout(10)
-                
-                ssl_context, success = self.create_ssl_context()
-                if not success:
-                    return ssl_context, False
-                    
-                self.connection = ssl_context.wrap_socket(
-                    raw_socket,
-                    server_hostname=server_config['host']
-                )
-                
-                self.connection.settimeout(10)
-                self.connection.connect((server_config['host'], server_config['port']))
-                
-                return "Connected successfully via HTTPS", True
-            
-        except Exception as e:
-            return f"Connection failed: {e}", False
-
-    def build_online_sale_message(self, pan: str, amount: float, expiry: str, approval_code: str, merchant_name: str):
-        """Build Online Sale ISO message with 4-digit approval codes"""
-        stan = str(st.session_state.stan_counter).zfill(6)
-        rrn = f"{st.session_state.stan_counter:012d}"  # 12-digit RRN
-        
-        # Store transaction details for receipt
-        st.session_state.current_transaction_details = {
-            'stan': stan,
-            'rrn': rrn,
-            'receipt_number': st.session_state.receipt_counter,
-            'batch_number': st.session_state.batch_number
-        }
-        
-        st.session_state.stan_counter += 1
-        st.session_state.receipt_counter += 1
-        
-        now = datetime.now()
-        transmission_time = now.strftime("%m%d%H%M%S")
-        local_time = now.strftime("%H%M%S")
-        local_date = now.strftime("%m%d")
-        
-        # For online transactions: pad 4-digit code to 6 digits for ISO 8583
-        auth_code = approval_code.ljust(6, '0')
-        
-        # ISO 8583 data elements - ONLINE TRANSACTION
-        data_elements = {
-            2: pan,  # LLVAR field
-            3: "000000",  # Processing Code for Purchase
-            4: str(int(amount * 100)).zfill(12),  # Amount in cents
-            7: transmission_time,  # Transmission date & time
-            11: stan,  # Systems trace audit number
-            12: local_time,  # Local time
-            13: local_date,  # Local date
-            14: expiry,  # Expiration date
-            18: "5999",  # Merchant type
-            22: "012",  # POS entry mode - Manual key entry
-            24: "00",  # Function code - Purchase
-            25: "00",  # POS condition code - Normal presentment
-            32: "00000000001",  # Acquiring institution ID code
-            35: pan + "=" + expiry + "100",  # Track 2 data
-            37: rrn,  # Retrieval Reference Number (12 digits)
-            38: auth_code,  # Approval code (4-digit padded to 6)
-            41: st.session_state.terminal_id,  # Terminal ID
-            42: st.session_state.merchant_id,  # Merchant ID
-            43: merchant_name.ljust(40)[:40],  # Merchant name (40 chars)
-            49: "840",  # Currency code (USD)
-            60: "00108001",  # Additional data
-        }
-
-        # Build bitmap
-        bitmap = bytearray(8)
-        for field_num in data_elements.keys():
-            if 1 <= field_num <= 64:
-                byte_index = (field_num - 1) // 8
-                bit_index = 7 - ((field_num - 1) % 8)
-                bitmap[byte_index] |= (1 << bit_index)
-
-        mti = "0200"  # Financial transaction request
-        bitmap_hex = bitmap.hex().upper()
-
-        # Build data string with proper length prefixes
-        data_str = ""
-        for field_num in sorted(data_elements.keys()):
-            value = data_elements[field_num]
-            
-            # Handle variable length fields
-            if field_num in [2, 35, 32, 60]:  # LLVAR fields (2-digit length)
-                data_str += f"{len(value):02d}{value}"
-            elif field_num in [43]:  # Fixed length field
-                data_str += value.ljust(40)[:40]  # Ensure exactly 40 chars
-            else:  # Fixed length fields
-                data_str += value
-
-        iso_message = mti + bitmap_hex + data_str
-        message_length = len(iso_message)
-        length_prefix = struct.pack('>H', message_length)
-        
-        # Debug output
-        if st.session_state.get('debug_mode', False):
-            selected_server = st.session_state.get('selected_server', 'primary')
-            server_config = st.session_state.server_config[selected_server]
-            st.sidebar.markdown("### 🔧 ISO 8583 Debug Info")
-            st.sidebar.markdown(f"""
-            <div style="border: 1px solid #6c757d; border-radius: 5px; padding: 10px; margin: 5px 0; background-color: #f8f9fa; font-family: monospace; font-size: 0.8em;">
-            <strong>Protocol 101.1 - Online Authorization</strong><br>
-            Server: {selected_server.upper()} ({server_config['protocol']})<br>
-            MTI: {mti}<br>
-            DE 3 (Processing): {data_elements[3]}<br>
-            DE 24 (Function): {data_elements[24]}<br>
-            DE 37 (RRN): {data_elements[37]}<br>
-            DE 38 (Auth): {data_elements[38]}<br>
-            STAN: {stan}<br>
-            Receipt #: {st.session_state.current_transaction_details['receipt_number']}<br>
-            Batch #: {st.session_state.batch_number}
-            </div>
-            """, unsafe_allow_html=True)
-    
-        return length_prefix + iso_message.encode('ascii')
-
-    def parse_visa_response(self, response: bytes) -> Dict[str, Any]:
-        """Parse Visa response"""
-        try:
-            if len(response) < 4:
-                return {"error": "Response too short"}
-                
-            # Parse message length
-            if len(response) > 2:
-                potential_length = struct.unpack('>H', response[:2])[0]
-                if potential_length == len(response) - 2:
-                    response = response[2:]
-            
-            response_str = response.decode('ascii', errors='ignore')
-            
-            result = {
-                "mti": response_str[0:4] if len(response_str) >= 4 else "",
-                "raw_response": response_str,
-                "length": len(response)
-            }
-            
-            # Visa response codes
-            visa_codes = {
-                '00': 'APPROVED - Transaction Completed',
-                '01': 'REFER TO ISSUER', 
-                '05': 'DECLINED - Do Not Honor',
-                '12': 'ERROR - Invalid Transaction',
-                '13': 'ERROR - Invalid Amount',
-                '14': 'ERROR - Invalid Card',
-                '51': 'DECLINED - Insufficient Funds',
-                '54': 'ERROR - Expired Card',
-                '55': 'ERROR - Invalid PIN',
-                '57': 'TRANSACTION NOT PERMITTED',
-                '58': 'TRANSACTION NOT PERMITTED',
-                '61': 'EXCEEDS WITHDRAWAL LIMIT',
-                '62': 'RESTRICTED CARD',
-                '65': 'EXCEEDS WITHDRAWAL FREQUENCY',
-                '75': 'EXCEEDS PIN TRIES',
-                '76': 'INVALID ROUTING',
-                '91': 'UNAVAILABLE - Issuer Unavailable',
-                '96': 'ERROR - System Malfunction'
-            }
-            
-            # Extract response code (DE 39)
-            if "39" in response_str:
-                idx = response_str.find("39")
-                if idx + 2 < len(response_str):
-                    resp_code = response_str[idx+2:idx+4]
-                    result["response_code"] = resp_code
-                    result["response_message"] = visa_codes.get(resp_code, f"UNKNOWN CODE: {resp_code}")
-            
-            # Extract auth code (DE 38)
-            if "38" in response_str:
-                idx = response_str.find("38")
-                if idx + 2 < len(response_str):
-                    # DE 38 is 6 characters fixed length
-                    auth_code = response_str[idx+2:idx+8]
-                    result["auth_code"] = auth_code
-                    
-                    # For online transactions, show only first 4 digits
-                    result["approval_code"] = auth_code[:4]  # First 4 digits only
-                    result["full_auth_code"] = auth_code
-            
-            # Add receipt details
-            if hasattr(st.session_state, 'current_transaction_details'):
-                result.update(st.session_state.current_transaction_details)
-            
-            # If we didn't find structured fields, try to extract basic info
-            if "response_code" not in result and len(response_str) >= 4:
-                if len(response_str) > 20:
-                    result["response_code"] = response_str[20:22] if len(response_str) > 22 else "XX"
-                    result["response_message"] = visa_codes.get(result["response_code"], "UNKNOWN")
-            
-            # Debug output
-            if st.session_state.get('debug_mode', False):
-                st.sidebar.markdown("### 🔧 Response Debug")
-                st.sidebar.markdown(f"""
-                <div style="border: 1px solid #6c757d; border-radius: 5px; padding: 10px; margin: 5px 0; background-color: #f8f9fa; font-family: monospace; font-size: 0.8em;">
-                <strong>Parsed Response:</strong><br>
-                Response Code: {result.get('response_code', 'N/A')}<br>
-                Approval Code: {result.get('approval_code', 'N/A')}<br>
-                RRN: {result.get('rrn', 'N/A')}<br>
-                STAN: {result.get('stan', 'N/A')}<br>
-                Receipt #: {result.get('receipt_number', 'N/A')}<br>
-                Batch #: {result.get('batch_number', 'N/A')}
-                </div>
-                """, unsafe_allow_html=True)
-            
-            return result
-            
-        except Exception as e:
-            return {"error": f"Parse error: {e}"}
+    def render_request_debug(self, server_name: str, mti: str, data_elements: Dict[int, str]):
+        """Show the outgoing ISO 8583 message"""
+        server_config = self.server_config[server_name]
+        st.markdown("### 🔧 ISO 8583 Debug Info")
+        st.markdown(f"""
+        <div style="border: 1px solid #6c757d; border-radius: 5px; padding: 10px; margin: 5px 0; background-color: #f8f9fa; font-family: monospace; font-size: 0.8em;">
+        <strong>Protocol 101.1 - Online Authorization</strong><br>
+        Server: {server_name.upper()} ({server_config['protocol']})<br>
+        Encoding: {DIALECTS[server_config.get('dialect', DEFAULT_DIALECT)].label}<br>
+        MTI: {mti}<br>
+        DE 3 (Processing): {data_elements[3]}<br>
+        DE 24 (Function): {data_elements[24]}<br>
+        DE 37 (RRN): {data_elements[37]}<br>
+        DE 38 (Auth): {data_elements[38]}<br>
+        STAN: {data_elements[11]}
+        </div>
+        """, unsafe_allow_html=True)
 
-    def send_transaction(self, message: bytes):
-        """Send transaction to payment server"""
-        if not self.connection:
-            return {"error": "Not connected"}
-        
-        try:
-            self.connection.send(message)
-            self.connection.settimeout(30)
-            response = self.connection.recv(4096)
-            
-            if response:
-                return self.parse_visa_response(response)
-            else:
-                return {"error": "No response"}
-                
-        except socket.timeout:
-            return {"error": "Connection timeout - no response from server"}
-        except Exception as e:
-            return {"error": f"Send failed: {e}"}
+    def render_response_debug(self, result: Dict[str, Any]):
+        """Show the parsed host response"""
+        st.markdown("### 🔧 Response Debug")
+        st.markdown(f"""
+        <div style="border: 1px solid #6c757d; border-radius: 5px; padding: 10px; margin: 5px 0; background-color: #f8f9fa; font-family: monospace; font-size: 0.8em;">
+        <strong>Parsed Response:</strong><br>
+        Server: {result.get('server', 'N/A').upper()}<br>
+        Response Code: {result.get('response_code', 'N/A')}<br>
+        Approval Code: {result.get('approval_code', 'N/A')}<br>
+        RRN: {result.get('rrn', 'N/A')}<br>
+        STAN: {result.get('stan', 'N/A')}<br>
+        Receipt #: {result.get('receipt_number', 'N/A')}<br>
+        Batch #: {result.get('batch_number', 'N/A')}
+        </div>
+        """, unsafe_allow_html=True)
+        if 'emv' in result:
+            try:
+                st.table([{'Tag': tag, 'Name': name, 'Value': value}
+                          for tag, name, value in result['emv'].describe()])
+            except ValueError as e:
+                st.warning(f"⚠️ DE 55 unreadable: {e}")
 
     def process_payment(self, form_data):
         """Process payment transaction"""
@@ -873,84 +1114,118 @@ class ISO8583BaseITerminal:
             st.error("❌ Invalid input data")
             return
         
-        # Build message
-        with st.spinner("🔄 Building ISO 8583 Message..."):
-            message = self.build_online_sale_message(
-                pan=clean_card,
-                amount=form_data['amount'],
-                expiry=clean_expiry,
-                approval_code=clean_approval,
-                merchant_name=form_data['merchant_name']
-            )
-        
         # Get selected server
         selected_server = st.session_state.get('selected_server', 'primary')
-        server_config = st.session_state.server_config[selected_server]
+        server_config = self.server_config[selected_server]
+        if server_config['protocol'] == 'HTTP':
+            st.warning("🔓 Using HTTP connection (not secure)")
         
-        # Connect and send
-        with st.spinner(f"🔗 Connecting to {selected_server.upper()} server via {server_config['protocol']}..."):
-            connection_result, success = self.connect_to_server(selected_server)
-            if not success:
-                st.error(f"❌ Connection failed: {connection_result}")
-                if st.session_state.get('debug_mode', False):
-                    st.info("💡 Check server configuration and certificate setup")
-                return
+        # One deadline covers resolve, connect, handshake, send and receive;
+        # connect failures fail over to the other server within it
+        debug_mode = st.session_state.get('debug_mode', False)
+        budget = self.config.get('authorization_budget', DEFAULT_AUTHORIZATION_BUDGET)
+        # Same card, amount, approval code and terminal within the window
+        # returns the earlier (or in-flight) result instead of a second 0200
+        submission_key = idempotency_key(clean_card, form_data['amount'], clean_approval, self.profile.profile_id)
+        window = self.config.get('idempotency_window', DEFAULT_IDEMPOTENCY_WINDOW)
+        with st.status("🔄 Building ISO 8583 Message...") as status:
+            if self.hostlink is not None:
+                # The daemon owns connections and counters and keeps the result
+                # under this key, so a rerun or restart mid-sale collects it
+                status.update(label="📡 Sent to host link...")
+                session = st.session_state.setdefault('hostlink_session', os.urandom(8).hex())
+                result, replayed = self.hostlink.authorize(
+                    session,
+                    submission_key,
+                    self.profile.profile_id,
+                    selected_server,
+                    pan=clean_card,
+                    amount=form_data['amount'],
+                    expiry=clean_expiry,
+                    approval_code=clean_approval,
+                    merchant_name=form_data['merchant_name'],
+                    budget=budget
+                )
+            else:
+                result, replayed = self.submissions.run(
+                    submission_key,
+                    window,
+                    lambda: authorize_sale(
+                        self.host,
+                        self.profile,
+                        self.server_config,
+                        selected_server,
+                        pan=clean_card,
+                        amount=form_data['amount'],
+                        expiry=clean_expiry,
+                        approval_code=clean_approval,
+                        merchant_name=form_data['merchant_name'],
+                        budget=budget,
+                        on_step=lambda label: status.update(label=label),
+                        on_message=self.render_request_debug if debug_mode else None,
+                        on_unconfirmed=self.reversals.enqueue
+                    ),
+                    wait=budget
+                )
+            status.update(
+                label="Authorization complete" if 'error' not in result else "Authorization failed",
+                state="complete" if 'error' not in result else "error"
+            )
+        
+        if replayed:
+            st.info("♻️ This transaction was just submitted - showing that result instead of sending it again")
+        
+        if not result.get('connected', True):
+            st.error(f"❌ Connection failed: {result['error']}")
+            if debug_mode:
+                st.info("💡 Check server configuration and certificate setup")
+            return
         
-        # Send transaction
-        with st.spinner("📤 Processing Online Authorization..."):
-            result = self.send_transaction(message)
-            self.disconnect()
+        if debug_mode and 'error' not in result:
+            self.render_response_debug(result)
         
-        # Handle result
-        self.handle_transaction_result(result, form_data)
+        # Handle result (a replayed result is already in the history)
+        self.handle_transaction_result(result, form_data, record=not replayed)
 
-    def handle_transaction_result(self, result, form_data):
+    def handle_transaction_result(self, result, form_data, record: bool = True):
         """Handle transaction result"""
+        entry = transaction_record(result, form_data['amount'], self.format_card_display(form_data['card_input']))
+        if record:
+            # Add to transaction history (failed ones too)
+            self.profile.record_transaction(entry)
+        
         if 'error' in result:
             st.error(f"❌ Transaction failed: {result['error']}")
-            
-            # Add failed transaction to history
-            transaction_record = {
-                'timestamp': datetime.now(),
-                'amount': form_data['amount'],
-                'card': self.format_card_display(form_data['card_input']),
-                'status': f"FAILED: {result['error']}",
-                'approval_code': 'N/A',
-                'response_code': 'ER',
-                'receipt_number': result.get('receipt_number', 'N/A'),
-                'rrn': result.get('rrn', 'N/A'),
-                'stan': result.get('stan', 'N/A'),
-                'batch_number': result.get('batch_number', 'N/A'),
-                'demo': False
-            }
-            st.session_state.transaction_history.append(transaction_record)
         else:
             if result.get('response_code') == '00':
                 st.success("✅ Online Authorization Approved!")
             else:
                 st.warning(f"⚠️ {result.get('response_message', 'Transaction completed with warning')}")
             
-            # Add to transaction history
-            transaction_record = {
-                'timestamp': datetime.now(),
-                'amount': form_data['amount'],
-                'card': self.format_card_display(form_data['card_input']),
-                'status': result.get('response_message', 'Unknown'),
-                'approval_code': result.get('approval_code', 'N/A'),
-                'response_code': result.get('response_code', 'N/A'),
-                'receipt_number': result.get('receipt_number', 'N/A'),
-                'rrn': result.get('rrn', 'N/A'),
-                'stan': result.get('stan', 'N/A'),
-                'batch_number': result.get('batch_number', 'N/A'),
-                'demo': False
-            }
-            st.session_state.transaction_history.append(transaction_record)
-            
-            # Show receipt
-            self.show_receipt(form_data, result)
+            # Rendered once at sale time; a replayed sale shows the receipt
+            # already printed for it. Reruns look it up by receipt number.
+            receipt = None if record else self.receipts.get(self.profile.profile_id, result.get('receipt_number'))
+            if receipt is None:
+                receipt = self.receipts.put(self.build_receipt(form_data, result, entry['timestamp']))
+            st.session_state.last_receipt = (receipt.profile_id, receipt.receipt_number)
+            self.show_receipt(receipt)
+
+    def build_receipt(self, form_data, result, issued: datetime) -> Receipt:
+        """Render the receipt for a sale at the time it was recorded"""
+        return render_receipt(
+            self.profile.profile_id,
+            self.profile.terminal_id,
+            self.profile.merchant_id,
+            merchant_name=form_data['merchant_name'],
+            amount=form_data['amount'],
+            card=self.format_card_receipt(form_data['card_input']),
+            expiry=self.format_expiry_display(form_data['expiry_input']),
+            result=result,
+            issued=issued
+        )
 
-    def show_receipt(self, form_data, result):
-        """Show payment receipt using pure Streamlit components"""
+    def show_receipt(self, receipt: Receipt):
+        """Show a rendered payment receipt using pure Streamlit components"""
         st.markdown("---")
         st.header("🧾 Payment Receipt")
         
@@ -962,50 +1237,14 @@ class ISO8583BaseITerminal:
             st.markdown("---")
             
             # Status
-            if result.get('response_code') == '00':
+            if receipt.approved:
                 st.success("✅ **PAYMENT APPROVED**")
             else:
                 st.warning("⚠️ **PAYMENT PROCESSED**")
             
-            # Merchant Information
-            st.subheader("🏪 Merchant Information")
-            col1, col2 = st.columns(2)
-            with col1:
-                st.text_input("Merchant Name", form_data['merchant_name'], disabled=True, key="merchant_name_rec")
-                st.text_input("Terminal ID", st.session_state.terminal_id, disabled=True, key="terminal_id_rec")
-            with col2:
-                st.text_input("Merchant ID", st.session_state.merchant_id, disabled=True, key="merchant_id_rec")
-                st.text_input("Transaction Type", "Online Authorization", disabled=True, key="trans_type_rec")
-            
-            # Transaction Details
-            st.subheader("📊 Transaction Details")
-            col1, col2 = st.columns(2)
-            with col1:
-                st.text_input("Receipt Number", str(result.get('receipt_number', 'N/A')), disabled=True, key="receipt_num")
-                st.text_input("Batch Number", str(result.get('batch_number', 'N/A')), disabled=True, key="batch_num")
-                st.text_input("Amount", f"${form_data['amount']:.2f}", disabled=True, key="amount_rec")
-            with col2:
-                st.text_input("RRN", result.get('rrn', 'N/A'), disabled=True, key="rrn_rec")
-                st.text_input("STAN", result.get('stan', 'N/A'), disabled=True, key="stan_rec")
-                st.text_input("Date/Time", datetime.now().strftime('%Y-%m-%d %H:%M:%S'), disabled=True, key="datetime_rec")
-            
-            # Card Information
-            st.subheader("💳 Card Information")
-            col1, col2 = st.columns(2)
-            with col1:
-                st.text_input("Card Number", self.format_card_receipt(form_data['card_input']), disabled=True, key="card_num_rec")
-            with col2:
-                st.text_input("Expiry Date", self.format_expiry_display(form_data['expiry_input']), disabled=True, key="expiry_rec")
-            
-            # Authorization Details
-            st.subheader("🔐 Authorization Details")
-            col1, col2 = st.columns(2)
-            with col1:
-                st.text_input("Status", result.get('response_message', 'Unknown'), disabled=True, key="status_rec")
-                st.text_input("Approval Code", result.get('approval_code', 'N/A'), disabled=True, key="approval_rec")
-            with col2:
-                st.text_input("Response Code", result.get('response_code', 'N/A'), disabled=True, key="response_rec")
-                st.text_input("Auth Code", result.get('full_auth_code', 'N/A'), disabled=True, key="auth_rec")
+            for title, fields in receipt.sections:
+                st.subheader(f"{RECEIPT_SECTION_ICONS.get(title, '')} {title}")
+                self.render_receipt_fields(fields)
             
             # Footer
             st.markdown("---")
@@ -1019,11 +1258,10 @@ class ISO8583BaseITerminal:
             col_a, col_b = st.columns(2)
             
             with col_a:
-                receipt_text = self.generate_receipt_text(form_data, result)
                 st.download_button(
                     label="📄 Download TXT Receipt",
-                    data=receipt_text,
-                    file_name=f"receipt_{result.get('receipt_number', 'unknown')}.txt",
+                    data=receipt.text,
+                    file_name=f"receipt_{receipt.receipt_number}.txt",
                     mime="text/plain",
                     use_container_width=True
                 )
@@ -1032,80 +1270,96 @@ class ISO8583BaseITerminal:
                 if st.button("🖨️ Print Receipt", use_container_width=True):
                     st.info("Use your browser's print function (Ctrl+P) to print this receipt")
 
-    def generate_receipt_text(self, form_data, result):
-        """Generate formatted receipt text for download"""
-        return f"""
-{'=' * 50}
-         PAYMENT RECEIPT
-        ISO-8583 Base I Terminal
-{'=' * 50}
-
-MERCHANT INFORMATION:
-{'-' * 50}
-Merchant: {form_data['merchant_name']}
-Terminal ID: {st.session_state.terminal_id}
-Merchant ID: {st.session_state.merchant_id}
-Transaction: Online Authorization (Protocol 101.1)
-
-TRANSACTION DETAILS:
-{'-' * 50}
-Receipt Number: {result.get('receipt_number', 'N/A')}
-Batch Number: {result.get('batch_number', 'N/A')}
-RRN: {result.get('rrn', 'N/A')}
-STAN: {result.get('stan', 'N/A')}
-Card: {self.format_card_receipt(form_data['card_input'])}
-Expiry: {self.format_expiry_display(form_data['expiry_input'])}
-Amount: ${form_data['amount']:.2f}
-Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-
-AUTHORIZATION INFORMATION:
-{'-' * 50}
-Status: {result.get('response_message', 'Unknown')}
-Approval Code: {result.get('approval_code', 'N/A')}
-Auth Code: {result.get('full_auth_code', 'N/A')}
-Response Code: {result.get('response_code', 'N/A')}
-
-{'-' * 50}
-      THANK YOU FOR YOUR BUSINESS
-{'=' * 50}
-"""
-
-    def disconnect(self):
-        """Close connection"""
-        if self.connection:
-            try:
-                self.connection.close()
-            except:
-                pass
-            self.connection = None
+    def render_receipt_fields(self, fields: List[Tuple[str, str]]):
+        """Label/value pairs in two columns, as plain text instead of disabled inputs"""
+        half = (len(fields) + 1) // 2
+        for column, chunk in zip(st.columns(2), (fields[:half], fields[half:])):
+            column.markdown("  \n".join(f"**{label}:** {escape_markdown(str(value))}" for label, value in chunk))
 
     def test_connection(self):
-        """Test server connection"""
+        """Probe every endpoint at once; the slowest one bounds the wait"""
         cert_valid, cert_message = self.check_certificates()
         if not cert_valid:
             st.error(f"❌ {cert_message}")
             return
         
-        # Test both servers
-        for server_name in ['primary', 'secondary']:
-            st.write(f"Testing {server_name} server...")
-            with st.spinner(f"Connecting to {server_name} server..."):
-                result, success = self.connect_to_server(server_name)
-                if success:
-                    st.success(f"✅ {server_name.upper()} Server: Connected successfully!")
-                    self.disconnect()
-                else:
-                    st.error(f"❌ {server_name.upper()} Server: {result}")
+        if self.hostlink is not None:
+            # The daemon owns the host connections; probing from here would open more
+            try:
+                status = self.hostlink.status()
+            except Exception as e:
+                st.error(f"❌ Host-link daemon unreachable: {e}")
+                return
+            st.success(f"✅ Host-link daemon: {status['in_flight']} in flight • {status['served']} served • "
+                       f"{status['idle_connections']} idle connection(s) • "
+                       f"{status['pending_reversals']} reversal(s) pending")
+            return
+        
+        with st.spinner("Probing all endpoints..."):
+            results = self.prober.probe_all()
+        for name, result in results.items():
+            if result.ok:
+                st.success(f"✅ {name.upper()}: {self.describe_probe(result)}")
+            else:
+                st.error(f"❌ {name.upper()}: {result.error}")
+
+    def describe_probe(self, result) -> str:
+        """Phase latencies of one probe, e.g. 'connect 12 ms • handshake 40 ms'"""
+        return " • ".join(f"{phase} {result.phases[phase] * 1000:.0f} ms"
+                          for phase in PROBE_PHASES if phase in result.phases) or "no phases timed"
+
+    @st.fragment(run_every=HEALTH_REFRESH_INTERVAL)
+    def render_health_dashboard(self):
+        """Current and recent per-phase latency for every probed endpoint"""
+        count_script_run('health')
+        with st.expander("📡 Host Health"):
+            if self.hostlink is not None:
+                st.info("Probes are off - the host-link daemon owns the host connections")
+                return
+            latest = self.prober.latest()
+            if not latest:
+                st.info("No probes yet - use Test Connection or set a probe interval")
+                return
+            
+            rows = []
+            chart = []
+            now = time.time()
+            for name, result in latest.items():
+                recent = self.prober.recent(name)
+                row = {
+                    'Endpoint': name,
+                    'Status': "✅ up" if result.ok else f"❌ {result.error}",
+                    'Probed': f"{now - result.at:.0f}s ago",
+                    'Up (recent)': f"{sum(r.ok for r in recent)}/{len(recent)}",
+                }
+                for phase in PROBE_PHASES:
+                    samples = sorted(r.phases[phase] for r in recent if phase in r.phases)
+                    if phase in result.phases:
+                        row[f"{phase} ms"] = round(result.phases[phase] * 1000, 1)
+                    if samples:
+                        row[f"{phase} p50/max"] = (f"{samples[len(samples) // 2] * 1000:.0f}/"
+                                                   f"{samples[-1] * 1000:.0f}")
+                rows.append(row)
+                chart.extend({'time': datetime.fromtimestamp(r.at), 'endpoint': name,
+                              'ms': sum(r.phases.values()) * 1000} for r in recent if r.ok)
+            
+            st.dataframe(rows, hide_index=True, use_container_width=True)
+            if chart:
+                st.caption("Total probe latency (ms)")
+                st.line_chart(chart, x='time', y='ms', color='endpoint')
 
     def show_transaction_history(self):
         """Show transaction history"""
         st.header("📋 Transaction History")
+        # Sales rerun only the payment section; this picks them up
+        st.button("🔄 Refresh", key="refresh_history")
         
-        if not st.session_state.transaction_history:
+        recent = self.profile.recent_transactions(10)
+        if not recent:
             st.info("No transactions yet")
             return
             
-        for i, transaction in enumerate(reversed(st.session_state.transaction_history[-10:]), 1):
+        for i, transaction in enumerate(reversed(recent), 1):
             demo_indicator = " (Demo)" if transaction.get('demo', False) else ""
             status_color = "✅" if transaction['status'].startswith('APPROVED') else "❌" if transaction['status'].startswith('FAILED') else "⚠️"
             
@@ -1120,11 +1374,160 @@ Response Code: {result.get('response_code', 'N/A')}
                 st.write(f"**STAN:** {transaction.get('stan', 'N/A')}")
                 st.write(f"**Batch #:** {transaction.get('batch_number', 'N/A')}")
                 st.write(f"**Time:** {transaction['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}")
+                receipt = self.receipts.get(self.profile.profile_id, transaction.get('receipt_number'),
+                                            transaction.get('rrn'))
+                if receipt is not None:
+                    st.download_button(
+                        label="🧾 Reprint Receipt",
+                        data=receipt.text,
+                        file_name=f"receipt_{receipt.receipt_number}.txt",
+                        mime="text/plain",
+                        key=f"reprint_{i}"
+                    )
                 
+        self.render_history_search()
+        self.render_history_export()
+        self.render_reversals()
+        
         # Clear history button
         if st.button("🗑️ Clear History"):
-            st.session_state.transaction_history = []
-            st.rerun()
+            self.profile.clear_history()
+            st.rerun(scope="fragment")
+
+    def render_reversals(self):
+        """Automatic 0400s for sales that timed out or got an unreadable reply"""
+        records = self.reversals.records()
+        pending = sum(record['status'] == PENDING for record in records)
+        with st.expander(f"↩️ Reversals ({pending} pending)" if pending else "↩️ Reversals"):
+            if not records:
+                st.info("No reversals - every sale got a usable answer")
+                return
+            now = time.time()
+            st.dataframe([{
+                'Queued': datetime.fromtimestamp(record['created']).strftime('%Y-%m-%d %H:%M:%S'),
+                'Terminal': record['profile_id'],
+                'Card': record['card'],
+                'Amount': f"${record['amount']:.2f}",
+                'RRN': record['rrn'],
+                'STAN': record['stan'],
+                'Status': record['status'],
+                'Attempts': record['attempts'],
+                'Next try': (f"in {max(0, int(record['next_attempt'] - now))}s"
+                             if record['status'] == PENDING else ""),
+                'Host reply': record['response_code'],
+                'Last error': record['last_error'],
+            } for record in records], use_container_width=True, hide_index=True)
+            if pending and st.button("↩️ Send pending now", key="send_reversals"):
+                self.reversals.retry_now()
+                st.toast("Pending reversals are due now")
+
+    def render_history_search(self):
+        """Indexed lookup of past transactions (disputes, support)"""
+        with st.expander("🔎 Search History"):
+            # Criteria are sent together, so typing them does not rerun the section
+            with st.form("history_search"):
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    rrn = st.text_input("RRN", key="search_rrn")
+                    stan = st.text_input("STAN", key="search_stan")
+                    approval = st.text_input("Approval Code", key="search_approval")
+                with col2:
+                    last4 = st.text_input("Card last 4", max_chars=4, key="search_last4")
+                    response_code = st.text_input("Response Code", max_chars=2, key="search_response")
+                    dates = st.date_input("Dates", value=(), key="search_dates")
+                with col3:
+                    min_amount = st.number_input("Min amount ($)", min_value=0.0, value=0.0, key="search_min")
+                    max_amount = st.number_input("Max amount ($)", min_value=0.0, value=0.0, key="search_max",
+                                                 help="0 = no upper limit")
+                    all_terminals = st.checkbox("All terminals", value=False, key="search_all")
+                searched = st.form_submit_button("🔎 Search")
+            
+            if not searched:
+                return
+            
+            since = until = None
+            if len(dates) >= 1:
+                since = datetime.combine(dates[0], datetime.min.time())
+                until = datetime.combine(dates[-1], datetime.min.time()) + timedelta(days=1)
+            query = JournalQuery(
+                profile_id=None if all_terminals else self.profile.profile_id,
+                rrn=rrn.strip() or None,
+                stan=stan.strip() or None,
+                approval_code=approval.strip() or None,
+                card_last4=last4.strip() or None,
+                response_code=response_code.strip() or None,
+                min_amount=min_amount or None,
+                max_amount=max_amount or None,
+                since=since,
+                until=until
+            )
+            start = time.perf_counter()
+            matches = get_state_backend().search_journal(query, limit=200)
+            elapsed = (time.perf_counter() - start) * 1000
+            
+            if not matches:
+                st.info(f"No matching transactions ({elapsed:.1f} ms)")
+                return
+            st.caption(f"{len(matches)} match(es), newest first • {elapsed:.1f} ms")
+            st.dataframe([
+                {
+                    'Time': match['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
+                    'Terminal': match.get('profile_id', ''),
+                    'Amount': f"${match['amount']:.2f}",
+                    'Card': match['card'],
+                    'Status': match['status'],
+                    'Approval': match['approval_code'],
+                    'Code': match['response_code'],
+                    'RRN': match.get('rrn', 'N/A'),
+                    'STAN': match.get('stan', 'N/A'),
+                    'Receipt #': match.get('receipt_number', 'N/A'),
+                    'Batch #': match.get('batch_number', 'N/A'),
+                }
+                for match in matches
+            ], use_container_width=True)
+
+    def render_history_export(self):
+        """Filtered history download, streamed from the journal into a temp file"""
+        with st.expander("📥 Export History"):
+            with st.form("history_export"):
+                col1, col2 = st.columns(2)
+                with col1:
+                    fmt = st.selectbox("Format", list(FORMATS), format_func=lambda name: FORMATS[name][0])
+                    all_terminals = st.checkbox("All terminals", value=False)
+                with col2:
+                    dates = st.date_input("Dates", value=(), help="Leave empty for all dates")
+                    batch = st.text_input("Batch #", value="", help="Leave empty for all batches")
+                prepared = st.form_submit_button("📦 Prepare Export")
+            
+            if not prepared:
+                return
+            
+            since = until = None
+            if len(dates) >= 1:
+                since = datetime.combine(dates[0], datetime.min.time())
+                until = datetime.combine(dates[-1], datetime.min.time()) + timedelta(days=1)
+            rows = export_rows(
+                get_state_backend(),
+                profile_id=None if all_terminals else self.profile.profile_id,
+                since=since,
+                until=until,
+                batch_number=batch.strip() or None
+            )
+            
+            # Rows stream to disk; only the finished file is handed to Streamlit
+            with tempfile.NamedTemporaryFile(suffix=f".{FORMATS[fmt][2]}", delete=False) as out:
+                write_export(rows, fmt, out)
+                path = out.name
+            try:
+                with open(path, 'rb') as f:
+                    st.download_button(
+                        "⬇️ Download",
+                        data=f,
+                        file_name=f"transactions-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{FORMATS[fmt][2]}",
+                        mime=FORMATS[fmt][1]
+                    )
+            finally:
+                os.remove(path)
 
     def run(self):
         """Main application runner"""
@@ -1135,22 +1538,50 @@ Response Code: {result.get('response_code', 'N/A')}
         # Check if certificates are ready
         cert_valid, _ = self.check_certificates()
         
-        if not cert_valid and not st.session_state.cert_files_uploaded:
+        if not cert_valid and not self.certificates.uploaded:
             self.render_demo_mode()
         else:
-            # Payment form
-            form_data = self.render_payment_form()
-            
-            # Process payment button
-            col1, col2, col3 = st.columns([1, 2, 1])
-            with col2:
-                if st.button("🚀 Process Online Authorization", type="primary", use_container_width=True):
-                    self.process_payment(form_data)
+            self.render_payment_section()
+            if st.session_state.get('show_history', False):
+                self.render_history_section()
+            self.render_health_dashboard()
+
+    @st.fragment
+    def render_payment_section(self):
+        """Payment form, processing and the latest receipt; reruns on its own"""
+        count_script_run('payment')
+        # Server settings may have been saved since the last full run
+        self.server_config = self.config.get('server_config') or DEFAULT_SERVER_CONFIG
+        
+        with st.form("payment_form"):
+            submitted, form_data = self.render_payment_form()
+        
+        if submitted:
+            st.session_state.pop('last_receipt', None)
+            self.process_payment(form_data)
+            st.session_state.runs_at_last_sale = dict(st.session_state.get('script_runs', {}))
+        elif 'last_receipt' in st.session_state:
+            # Receipt buttons rerun only this fragment; keep the receipt up
+            receipt = self.receipts.get(*st.session_state.last_receipt)
+            if receipt is not None:
+                self.show_receipt(receipt)
+
+    @st.fragment
+    def render_history_section(self):
+        """Transaction history, search and export; reruns on its own"""
+        count_script_run('history')
+        self.show_transaction_history()
 
 def main():
     """Main function"""
-    terminal = ISO8583BaseITerminal()
-    terminal.run()
+    # CPU time of this session's script thread, shown in debug mode next run
+    start = time.thread_time()
+    try:
+        count_script_run('app')
+        terminal = ISO8583BaseITerminal()
+        terminal.run()
+    finally:
+        st.session_state.last_rerun_cpu_ms = (time.thread_time() - start) * 1000
 
 if __name__ == "__main__":
     main()
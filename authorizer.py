@@ -0,0 +1,266 @@
+"""
+Authorization Pipeline
+Build, send and parse an Online Sale under one deadline, with failover,
+independent of the Streamlit UI
+"""
+
+import socket
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from admission import AdmissionController, AdmissionRejected
+from capture import REQUEST, RESPONSE, CaptureWriter
+from connections import (
+    ConnectionPool, Deadline, DeadlineExceeded, LatencyTracker, ServerKey, SSLContextCache,
+    recv_response, resolve, server_key
+)
+from iso8583 import build_sale_fields, encode_message, match_response, parse_response
+from profiles import TerminalProfile
+
+# Seconds from "Process" click to an answer, across resolve/connect/send/receive
+DEFAULT_AUTHORIZATION_BUDGET = 15.0
+
+
+class HostClient:
+    """
+    Host I/O shared by every session and profile in the process: cached SSL
+    contexts, pooled keep-alive sockets, per-phase latency tracking,
+    admission control and deadline-bounded connect/send/receive.
+    """
+
+    def __init__(self, ssl_contexts: SSLContextCache, pool: ConnectionPool,
+                 latency: LatencyTracker, cert_file: str, key_file: str,
+                 capture: Optional[CaptureWriter] = None,
+                 admission: Optional[AdmissionController] = None):
+        self.ssl_contexts = ssl_contexts
+        self.pool = pool
+        self.latency = latency
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.capture = capture
+        self.admission = admission or AdmissionController()
+        # Last time real traffic completed on each server (heartbeats back off)
+        self.last_traffic: Dict[ServerKey, float] = {}
+
+    def connect(self, server_config: Dict, deadline: Deadline, pooled: bool = True,
+                timings: Optional[Dict[str, float]] = None) -> Tuple[socket.socket, bool]:
+        """
+        Open a connection (or take a pooled one); returns (conn, reused).
+        Seconds spent in each phase are also stored in `timings` if given.
+        """
+        timings = {} if timings is None else timings
+        key = server_key(server_config)
+        if pooled and server_config.get('keep_alive', False):
+            conn = self.pool.acquire(key)
+            if conn is not None:
+                return conn, True
+
+        host, port = server_config['host'], int(server_config['port'])
+        timeouts = server_config.get('timeouts')
+
+        start = time.perf_counter()
+        addresses = resolve(host, port, deadline)
+        timings['resolve'] = time.perf_counter() - start
+        self.latency.record(key, 'resolve', timings['resolve'])
+
+        connect_timeout = self.latency.adaptive_timeout(key, 'connect', timeouts)
+        conn = None
+        last_error: Optional[Exception] = None
+        for family, sockaddr in addresses:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(deadline.timeout(connect_timeout))
+                start = time.perf_counter()
+                sock.connect(sockaddr)
+                timings['connect'] = time.perf_counter() - start
+                self.latency.record(key, 'connect', timings['connect'])
+                conn = sock
+                break
+            except DeadlineExceeded:
+                sock.close()
+                raise
+            except OSError as e:
+                sock.close()
+                last_error = e
+        if conn is None:
+            raise last_error or OSError(f"No address for {host}")
+
+        if server_config['protocol'] == 'HTTPS':
+            try:
+                context = self.ssl_contexts.get(self.cert_file, self.key_file)
+                conn = context.wrap_socket(conn, server_hostname=host, do_handshake_on_connect=False)
+                conn.settimeout(deadline.timeout(self.latency.adaptive_timeout(key, 'handshake', timeouts)))
+                start = time.perf_counter()
+                conn.do_handshake()
+                timings['handshake'] = time.perf_counter() - start
+                self.latency.record(key, 'handshake', timings['handshake'])
+            except Exception:
+                conn.close()
+                raise
+
+        return conn, False
+
+    def exchange(self, conn: socket.socket, server_config: Dict, frame: bytes,
+                 deadline: Deadline, pan: Optional[str] = None, phase: str = 'response') -> bytes:
+        """
+        Send one frame and read the response within the deadline.
+        `phase` names the latency series: 'response' for authorizations,
+        'echo' for network-management heartbeats. DeadlineExceeded is only
+        raised before any byte of the frame is written.
+        """
+        key = server_key(server_config)
+        response_timeout = self.latency.adaptive_timeout(key, phase, server_config.get('timeouts'))
+        conn.settimeout(deadline.timeout(response_timeout))
+
+        # Optional wire capture (PAN tokenized before it reaches the log)
+        exchange_id = None
+        if self.capture:
+            exchange_id = self.capture.next_exchange_id()
+            self.capture.write(REQUEST, exchange_id, frame, pan)
+
+        try:
+            start = time.perf_counter()
+            conn.sendall(frame)
+            response = recv_response(conn)
+            if not response:
+                raise ConnectionError("No response")
+            self.latency.record(key, phase, time.perf_counter() - start)
+        except Exception as e:
+            if self.capture:
+                self.capture.record_error(exchange_id, str(e) or type(e).__name__)
+            raise
+
+        if self.capture:
+            self.capture.write(RESPONSE, exchange_id, response, pan)
+        if phase == 'response':
+            self.last_traffic[key] = time.monotonic()
+        return response
+
+    def release(self, server_config: Dict, conn: socket.socket, reusable: bool):
+        """Return a connection to the pool (keep-alive servers) or close it"""
+        reusable = reusable and server_config.get('keep_alive', False)
+        self.pool.release(server_key(server_config), conn, reusable)
+
+
+def failover_order(server_configs: Dict[str, Dict], preferred: str) -> list:
+    """Preferred server first, then the others in config order"""
+    return [preferred] + [name for name in server_configs if name != preferred]
+
+
+def authorize_sale(client: HostClient, profile: TerminalProfile, server_configs: Dict[str, Dict],
+                   server_type: str, pan: str, amount: float, expiry: str, approval_code: str,
+                   merchant_name: str, budget: float = DEFAULT_AUTHORIZATION_BUDGET,
+                   chip_data: Optional[bytes] = None,
+                   on_step: Optional[Callable[[str], None]] = None,
+                   on_message: Optional[Callable[[str, str, Dict[int, str]], None]] = None,
+                   on_unconfirmed: Optional[Callable[[str, str, Dict[int, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    Run one Online Sale end to end and return the result dict used for
+    receipts and history. Connect failures and admission rejections fail
+    over to the next server while budget remains; once a request has been
+    sent it is never resent. A result with connected=False means no host
+    ever saw the request. A sale that may have reached the host but got no
+    usable answer (timeout, dropped link, unreadable or mismatched reply)
+    is handed to `on_unconfirmed(profile_id, server, fields)`, e.g. to
+    queue a reversal.
+    """
+    deadline = Deadline(budget)
+    details = profile.next_sequence()
+    fields = build_sale_fields(
+        pan=pan,
+        amount=amount,
+        expiry=expiry,
+        approval_code=approval_code,
+        merchant_name=merchant_name,
+        terminal_id=profile.terminal_id,
+        merchant_id=profile.merchant_id,
+        stan=details['stan'],
+        rrn=details['rrn'],
+        chip_data=chip_data
+    )
+    mti = "0200"  # Financial transaction request
+    frames: Dict[str, bytes] = {}  # one encoding per dialect in use
+
+    last_error = "No server configured"
+    for name in failover_order(server_configs, server_type):
+        server_config = server_configs[name]
+        try:
+            # Respect the host's contracted TPS before opening anything
+            if client.admission.admit(server_config, profile.profile_id, deadline) > 0 and on_step:
+                on_step(f"⏳ Waited for a {name.upper()} server slot")
+        except AdmissionRejected as e:
+            last_error = f"{name}: {e}"
+            continue
+
+        if on_step:
+            on_step(f"🔗 Connecting to {name.upper()} server via {server_config['protocol']}...")
+        try:
+            conn, _ = client.connect(server_config, deadline)
+        except DeadlineExceeded as e:
+            last_error = str(e)
+            break
+        except Exception as e:
+            last_error = f"{name}: {e}"
+            continue
+
+        if on_message:
+            on_message(name, mti, fields)
+        if on_step:
+            on_step("📤 Processing Online Authorization...")
+
+        dialect = server_config.get('dialect')
+        if dialect not in frames:
+            frames[dialect] = encode_message(mti, fields, dialect)
+
+        reusable = False
+        try:
+            response = client.exchange(conn, server_config, frames[dialect], deadline, pan)
+            result = match_response(parse_response(response, dialect), mti, fields)
+            reusable = 'error' not in result
+        except DeadlineExceeded as e:
+            # Out of budget before the frame was written: no host saw the sale
+            reusable = True
+            last_error = str(e)
+            break
+        except socket.timeout:
+            result = {"error": "Connection timeout - no response from server"}
+        except Exception as e:
+            result = {"error": f"Send failed: {e}"}
+        finally:
+            client.release(server_config, conn, reusable)
+
+        result.update(details)
+        result['server'] = name
+        result['connected'] = True
+        if 'error' in result and on_unconfirmed:
+            # The host may have approved it; reverse rather than guess
+            try:
+                on_unconfirmed(profile.profile_id, name, fields)
+                result['reversal'] = "queued"
+            except Exception as e:
+                result['reversal'] = f"not queued: {e}"
+        return result
+
+    result = {"error": last_error, "connected": False}
+    result.update(details)
+    return result
+
+
+def transaction_record(result: Dict[str, Any], amount: float, card: str) -> Dict[str, Any]:
+    """History entry for an authorization result; `card` must already be masked"""
+    failed = 'error' in result
+    return {
+        'timestamp': datetime.now(),
+        'amount': amount,
+        'card': card,
+        'status': (f"FAILED: {result['error']}" + (f" (reversal {result['reversal']})" if 'reversal' in result else ""))
+                  if failed else result.get('response_message', 'Unknown'),
+        'approval_code': 'N/A' if failed else result.get('approval_code', 'N/A'),
+        'response_code': 'ER' if failed else result.get('response_code', 'N/A'),
+        'receipt_number': result.get('receipt_number', 'N/A'),
+        'rrn': result.get('rrn', 'N/A'),
+        'stan': result.get('stan', 'N/A'),
+        'batch_number': result.get('batch_number', 'N/A'),
+        'demo': False
+    }
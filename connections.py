@@ -0,0 +1,331 @@
+"""
+Host Connections
+SSL contexts and pooled host sockets shared across terminal profiles
+"""
+
+import math
+import os
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Deque, Dict, Optional, Tuple
+
+ServerKey = Tuple[str, str, int]
+
+
+def server_key(server_config: Dict) -> ServerKey:
+    """Pool key for a server config entry"""
+    return (server_config['protocol'], server_config['host'], int(server_config['port']))
+
+
+class SSLContextCache:
+    """
+    Client SSL contexts keyed by certificate/key files.
+    Loading a cert chain is expensive, so one context is built per file pair
+    and rebuilt only when either file changes on disk.
+    """
+
+    def __init__(self):
+        self._contexts: Dict[Tuple[str, str], Tuple[Tuple[int, int], ssl.SSLContext]] = {}
+        self._status: Dict[Tuple[str, str], Tuple[bool, str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, certfile: str, keyfile: str) -> ssl.SSLContext:
+        """Return a context for these files; raises if they cannot be loaded"""
+        key = (certfile, keyfile)
+        stamp = (os.stat(certfile).st_mtime_ns, os.stat(keyfile).st_mtime_ns)
+
+        cached = self._contexts.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        with self._lock:
+            cached = self._contexts.get(key)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+            self._contexts[key] = (stamp, context)
+            return context
+
+    def check(self, certfile: str, keyfile: str) -> Tuple[bool, str]:
+        """
+        Whether the pair loads, as (ok, message). The answer is kept until
+        invalidate(), so UI reruns in every session share one validation.
+        """
+        key = (certfile, keyfile)
+        status = self._status.get(key)
+        if status is not None:
+            return status
+
+        if not os.path.exists(certfile) or not os.path.exists(keyfile):
+            status = (False, "Certificate files missing")
+        elif os.path.getsize(certfile) == 0 or os.path.getsize(keyfile) == 0:
+            status = (False, "Certificate files are empty")
+        else:
+            try:
+                self.get(certfile, keyfile)
+                status = (True, "Certificates are valid")
+            except Exception as e:
+                status = (False, f"Certificate error: {e}")
+        self._status[key] = status
+        return status
+
+    def invalidate(self):
+        """Forget all contexts (e.g. after certificates are replaced)"""
+        with self._lock:
+            self._contexts.clear()
+            self._status.clear()
+
+
+class ConnectionPool:
+    """
+    Idle host connections shared by every terminal profile in the process.
+    Only used for servers whose config allows keep-alive; everything else
+    keeps the connect/send/close cycle.
+    """
+
+    def __init__(self, max_idle_per_server: int = 4, idle_timeout: float = 60.0):
+        self.max_idle_per_server = max_idle_per_server
+        self.idle_timeout = idle_timeout
+        self._idle: Dict[ServerKey, Deque[Tuple[float, socket.socket]]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: ServerKey) -> Optional[socket.socket]:
+        """Take an idle connection for this server, or None"""
+        now = time.monotonic()
+        stale = []
+        conn = None
+
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                released_at, candidate = idle.pop()
+                if now - released_at <= self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+
+        for old in stale:
+            _close_quietly(old)
+        return conn
+
+    def release(self, key: ServerKey, conn: socket.socket, reusable: bool = True):
+        """Return a connection to the pool, or close it"""
+        if not reusable:
+            _close_quietly(conn)
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(key, deque())
+            if len(idle) < self.max_idle_per_server:
+                idle.append((time.monotonic(), conn))
+                return
+
+        _close_quietly(conn)
+
+    def idle_count(self, key: Optional[ServerKey] = None) -> int:
+        """Number of idle connections (for one server or all)"""
+        with self._lock:
+            if key is not None:
+                return len(self._idle.get(key, ()))
+            return sum(len(idle) for idle in self._idle.values())
+
+    def close_all(self):
+        """Close every idle connection"""
+        with self._lock:
+            conns = [conn for idle in self._idle.values() for _, conn in idle]
+            self._idle.clear()
+        for conn in conns:
+            _close_quietly(conn)
+
+
+def _close_quietly(conn: socket.socket):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def recv_exact(conn: socket.socket, size: int) -> bytes:
+    """Read exactly `size` bytes; raises ConnectionError if the peer closes first"""
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = conn.recv(remaining)
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_frame(conn: socket.socket) -> bytes:
+    """Read one length-prefixed frame (prefix included in the result)"""
+    prefix = recv_exact(conn, 2)
+    length = int.from_bytes(prefix, 'big')
+    return prefix + recv_exact(conn, length)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The authorization's time budget ran out"""
+
+
+class Deadline:
+    """
+    One time budget shared by every step of an authorization (resolve,
+    connect, handshake, send, receive). Each step takes the smaller of its
+    own timeout and whatever budget is left.
+    """
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: Optional[float] = None) -> float:
+        """Socket timeout for the next step; raises once the budget is spent"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Authorization deadline of {self.budget:g}s exceeded")
+        return remaining if cap is None else min(remaining, cap)
+
+
+# Adaptive timeout bounds used when a server config does not set its own:
+# each phase waits p99 × factor of recent latency, clamped to [min, max]
+DEFAULT_TIMEOUTS = {
+    'factor': 3.0,
+    'connect': [0.5, 5.0],
+    'response': [2.0, 20.0],
+}
+
+
+class LatencyTracker:
+    """
+    Recent per-server, per-phase latencies and the timeouts derived from them.
+    Keeps a fixed window of samples per (server, phase); until a window has
+    `min_samples`, timeouts fall back to the configured upper bound.
+    """
+
+    PHASES = ('resolve', 'connect', 'handshake', 'response', 'echo')
+
+    def __init__(self, window: int = 512, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[Tuple[ServerKey, str], Deque[float]] = {}
+        self._p99_cache: Dict[Tuple[ServerKey, str], Tuple[int, float]] = {}
+        self._recorded: Dict[Tuple[ServerKey, str], int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: ServerKey, phase: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get((key, phase))
+            if samples is None:
+                samples = self._samples[(key, phase)] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self._recorded[(key, phase)] = self._recorded.get((key, phase), 0) + 1
+
+    def samples(self, key: ServerKey, phase: str) -> list:
+        with self._lock:
+            return list(self._samples.get((key, phase), ()))
+
+    def percentile(self, key: ServerKey, phase: str, pct: float) -> Optional[float]:
+        values = sorted(self.samples(key, phase))
+        if not values:
+            return None
+        rank = min(len(values) - 1, max(0, math.ceil(len(values) * pct / 100.0) - 1))
+        return values[rank]
+
+    def _p99(self, key: ServerKey, phase: str) -> Optional[float]:
+        """p99, recomputed only after new samples arrive"""
+        recorded = self._recorded.get((key, phase), 0)
+        if recorded < self.min_samples:
+            return None
+        cached = self._p99_cache.get((key, phase))
+        if cached is not None and cached[0] == recorded:
+            return cached[1]
+        value = self.percentile(key, phase, 99)
+        self._p99_cache[(key, phase)] = (recorded, value)
+        return value
+
+    def adaptive_timeout(self, key: ServerKey, phase: str, timeouts: Optional[Dict] = None) -> float:
+        """Timeout for a phase: p99 × factor within the configured bounds"""
+        timeouts = timeouts or DEFAULT_TIMEOUTS
+        bounds = timeouts.get('connect' if phase in ('resolve', 'connect', 'handshake') else 'response')
+        low, high = bounds
+        p99 = self._p99(key, phase)
+        if p99 is None:
+            return high
+        return max(low, min(high, p99 * timeouts.get('factor', DEFAULT_TIMEOUTS['factor'])))
+
+    def summary(self) -> Dict[ServerKey, Dict[str, Dict[str, float]]]:
+        """p50/p99 and sample count per server and phase (for display)"""
+        with self._lock:
+            keys = list(self._samples)
+        summary: Dict[ServerKey, Dict[str, Dict[str, float]]] = {}
+        for key, phase in keys:
+            summary.setdefault(key, {})[phase] = {
+                'p50': self.percentile(key, phase, 50),
+                'p99': self.percentile(key, phase, 99),
+                'count': self._recorded.get((key, phase), 0),
+            }
+        return summary
+
+
+_resolver = ThreadPoolExecutor(max_workers=4, thread_name_prefix="resolve")
+_resolved: Dict[Tuple[str, int], Tuple[float, list]] = {}
+RESOLVE_TTL = 300.0
+
+
+def resolve(host: str, port: int, deadline: Deadline) -> list:
+    """
+    getaddrinfo bounded by the deadline (it has no timeout of its own),
+    with results cached for RESOLVE_TTL seconds.
+    """
+    cached = _resolved.get((host, port))
+    now = time.monotonic()
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    future = _resolver.submit(socket.getaddrinfo, host, port, 0, socket.SOCK_STREAM)
+    try:
+        infos = future.result(timeout=deadline.timeout())
+    except FutureTimeout:
+        raise DeadlineExceeded(f"Resolving {host} exceeded the authorization deadline")
+    addresses = [(family, sockaddr) for family, _, _, _, sockaddr in infos]
+    _resolved[(host, port)] = (now + RESOLVE_TTL, addresses)
+    return addresses
+
+
+# Frames larger than this are not length-prefixed; the prefix bytes are data
+MAX_FRAME = 8192
+
+
+def recv_response(conn: socket.socket) -> bytes:
+    """
+    Read one host response. If it starts with a plausible 2-byte length
+    prefix, keep reading until that many bytes arrived; otherwise return
+    what the first read delivered (unprefixed hosts).
+    """
+    response = conn.recv(4096)
+    if len(response) < 2:
+        return response
+    declared = int.from_bytes(response[:2], 'big')
+    if declared > MAX_FRAME:
+        return response
+    missing = declared + 2 - len(response)
+    if missing > 0:
+        response += recv_exact(conn, missing)
+    return response
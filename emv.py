@@ -0,0 +1,174 @@
+"""
+EMV Chip Data
+BER-TLV encoding and lazy, zero-copy decoding of DE 55 (ICC data)
+"""
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# Tags the terminal sends or the host answers with
+EMV_TAGS = {
+    0x5F2A: "Transaction Currency Code",
+    0x5F34: "PAN Sequence Number",
+    0x71: "Issuer Script Template 1",
+    0x72: "Issuer Script Template 2",
+    0x82: "Application Interchange Profile",
+    0x84: "Dedicated File Name",
+    0x86: "Issuer Script Command",
+    0x8A: "Authorization Response Code",
+    0x91: "Issuer Authentication Data",
+    0x95: "Terminal Verification Results",
+    0x9A: "Transaction Date",
+    0x9C: "Transaction Type",
+    0x9F02: "Amount, Authorised",
+    0x9F03: "Amount, Other",
+    0x9F09: "Application Version Number",
+    0x9F10: "Issuer Application Data",
+    0x9F18: "Issuer Script Identifier",
+    0x9F1A: "Terminal Country Code",
+    0x9F1E: "IFD Serial Number",
+    0x9F26: "Application Cryptogram",
+    0x9F27: "Cryptogram Information Data",
+    0x9F33: "Terminal Capabilities",
+    0x9F34: "CVM Results",
+    0x9F35: "Terminal Type",
+    0x9F36: "Application Transaction Counter",
+    0x9F37: "Unpredictable Number",
+    0x9F41: "Transaction Sequence Counter",
+}
+
+
+def tag_hex(tag: int) -> str:
+    """Tag as it is usually written, e.g. 9F26"""
+    return f"{tag:X}".rjust(2 * ((tag.bit_length() + 7) // 8 or 1), "0")
+
+
+def is_constructed(tag: int) -> bool:
+    """Bit 6 of the first tag byte marks a template holding more TLVs"""
+    first = tag >> (8 * ((tag.bit_length() - 1) // 8)) if tag else 0
+    return bool(first & 0x20)
+
+
+def iter_tlv(data: Buffer) -> Iterator[Tuple[int, memoryview]]:
+    """
+    Walk one level of BER-TLV, yielding (tag, value) where value is a
+    memoryview slice of `data` - nothing is copied or decoded here.
+    Raises ValueError on truncated or malformed input.
+    """
+    view = data if isinstance(data, memoryview) else memoryview(data)
+    end = len(view)
+    pos = 0
+    while pos < end:
+        first = view[pos]
+        # 00 and FF are padding between objects
+        if first in (0x00, 0xFF):
+            pos += 1
+            continue
+
+        # Tag: low five bits all set means more bytes follow while b8 is set
+        tag = first
+        pos += 1
+        if first & 0x1F == 0x1F:
+            while True:
+                if pos >= end:
+                    raise ValueError("TLV tag truncated")
+                byte = view[pos]
+                pos += 1
+                tag = (tag << 8) | byte
+                if not byte & 0x80:
+                    break
+
+        # Length: short form below 0x80, else 0x81..0x84 give the byte count
+        if pos >= end:
+            raise ValueError(f"TLV length missing for tag {tag_hex(tag)}")
+        length = view[pos]
+        pos += 1
+        if length & 0x80:
+            count = length & 0x7F
+            if count == 0 or count > 4 or pos + count > end:
+                raise ValueError(f"Bad TLV length for tag {tag_hex(tag)}")
+            length = int.from_bytes(view[pos:pos + count], 'big')
+            pos += count
+
+        if pos + length > end:
+            raise ValueError(f"TLV value truncated for tag {tag_hex(tag)}")
+        yield tag, view[pos:pos + length]
+        pos += length
+
+
+def _encode_tag(tag: int) -> bytes:
+    return tag.to_bytes(max(1, (tag.bit_length() + 7) // 8), 'big')
+
+
+def _encode_length(length: int) -> bytes:
+    if length < 0x80:
+        return bytes((length,))
+    size = (length.bit_length() + 7) // 8
+    return bytes((0x80 | size,)) + length.to_bytes(size, 'big')
+
+
+def encode_tlv(items: Iterable[Tuple[int, Buffer]]) -> bytes:
+    """BER-TLV for (tag, value) pairs, in the order given"""
+    parts = []
+    for tag, value in items:
+        parts.append(_encode_tag(tag))
+        parts.append(_encode_length(len(value)))
+        parts.append(bytes(value))
+    return b"".join(parts)
+
+
+class ChipData:
+    """
+    DE 55 contents. Holds the raw bytes and indexes the top-level tags on
+    first lookup; values stay memoryview slices until asked for, so a
+    response nobody inspects costs one reference.
+    """
+
+    __slots__ = ('raw', '_index')
+
+    def __init__(self, raw: Buffer):
+        self.raw = bytes(raw) if not isinstance(raw, (bytes, memoryview)) else raw
+        self._index: Optional[Dict[int, memoryview]] = None
+
+    def _tags(self) -> Dict[int, memoryview]:
+        if self._index is None:
+            self._index = dict(iter_tlv(self.raw))
+        return self._index
+
+    def __contains__(self, tag: int) -> bool:
+        return tag in self._tags()
+
+    def __iter__(self) -> Iterator[Tuple[int, memoryview]]:
+        return iter_tlv(self.raw)
+
+    def __len__(self) -> int:
+        return len(self._tags())
+
+    def get(self, tag: int) -> Optional[bytes]:
+        value = self._tags().get(tag)
+        return bytes(value) if value is not None else None
+
+    def hex(self, tag: int) -> Optional[str]:
+        value = self._tags().get(tag)
+        return value.hex().upper() if value is not None else None
+
+    def find_all(self, tag: int) -> List[memoryview]:
+        """Every value with this tag, descending into templates (e.g. 86 in 71/72)"""
+        found = []
+        stack = [memoryview(self.raw)]
+        while stack:
+            for item_tag, value in iter_tlv(stack.pop()):
+                if item_tag == tag:
+                    found.append(value)
+                if is_constructed(item_tag):
+                    stack.append(value)
+        return found
+
+    def issuer_scripts(self) -> List[bytes]:
+        """Issuer script templates (71 before, 72 after final GENERATE AC), as raw TLV"""
+        return [encode_tlv([(tag, value)]) for tag, value in self if tag in (0x71, 0x72)]
+
+    def describe(self) -> List[Tuple[str, str, str]]:
+        """(tag, name, value hex) rows for display"""
+        return [(tag_hex(tag), EMV_TAGS.get(tag, "Unknown"), value.hex().upper()) for tag, value in self]
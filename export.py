@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+History Export
+Stream the transaction journal as CSV, JSON lines or Parquet with
+date/batch/terminal filters applied while reading
+
+    python export.py --db ./state/terminal.db --format csv --since 2026-10-01 --batch 4321 -o history.csv
+"""
+
+import argparse
+import csv
+import io
+import json
+import re
+import sys
+from datetime import datetime, timedelta
+from typing import Any, BinaryIO, Dict, Iterator, Optional
+
+from state_backend import SQLiteStateBackend, StateBackend, open_state_backend
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:  # Parquet is offered only where pyarrow is installed
+    pyarrow = None
+    parquet = None
+
+EXPORT_COLUMNS = ('timestamp', 'profile_id', 'amount', 'card', 'status', 'approval_code',
+                  'response_code', 'receipt_number', 'rrn', 'stan', 'batch_number', 'demo')
+
+# Rows per chunk yielded by the text writers and per Parquet row group
+CHUNK_ROWS = 1000
+
+# name: (label, MIME type, file extension)
+FORMATS = {
+    'csv': ("CSV", "text/csv", "csv"),
+    'jsonl': ("JSON lines", "application/x-ndjson", "jsonl"),
+}
+if parquet is not None:
+    FORMATS['parquet'] = ("Parquet", "application/vnd.apache.parquet", "parquet")
+
+
+def mask_card(pan: str) -> str:
+    """Format card for display - show only last 4 digits"""
+    clean_pan = re.sub(r'\D', '', pan)
+    if len(clean_pan) == 16:
+        return f"**** **** **** {clean_pan[12:16]}"
+    return clean_pan
+
+
+def export_rows(backend: StateBackend, profile_id: Optional[str] = None,
+                since: Optional[datetime] = None, until: Optional[datetime] = None,
+                batch_number: Any = None) -> Iterator[Dict[str, Any]]:
+    """Filtered journal records as flat export rows, one at a time"""
+    for record in backend.iter_journal(profile_id, since, until, batch_number):
+        card = record.get('card', '')
+        yield {
+            'timestamp': record['timestamp'].isoformat(timespec='seconds'),
+            'profile_id': record.get('profile_id', ''),
+            'amount': f"{float(record.get('amount', 0)):.2f}",
+            # Already masked when recorded; masking again keeps old records safe
+            'card': card if '*' in card else mask_card(card),
+            'status': record.get('status', ''),
+            'approval_code': record.get('approval_code', ''),
+            'response_code': record.get('response_code', ''),
+            'receipt_number': str(record.get('receipt_number', '')),
+            'rrn': str(record.get('rrn', '')),
+            'stan': str(record.get('stan', '')),
+            'batch_number': str(record.get('batch_number', '')),
+            'demo': bool(record.get('demo', False)),
+        }
+
+
+def iter_csv(rows: Iterator[Dict[str, Any]]) -> Iterator[str]:
+    """CSV text in chunks of CHUNK_ROWS rows, header first"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_jsonl(rows: Iterator[Dict[str, Any]]) -> Iterator[str]:
+    """JSON lines in chunks of CHUNK_ROWS rows"""
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row, separators=(',', ':')))
+        if len(chunk) == CHUNK_ROWS:
+            yield "\n".join(chunk) + "\n"
+            chunk = []
+    if chunk:
+        yield "\n".join(chunk) + "\n"
+
+
+def write_parquet(rows: Iterator[Dict[str, Any]], out: BinaryIO):
+    """Parquet with one row group per CHUNK_ROWS rows"""
+    schema = pyarrow.schema([(name, pyarrow.bool_() if name == 'demo' else pyarrow.string())
+                             for name in EXPORT_COLUMNS])
+    with parquet.ParquetWriter(out, schema) as writer:
+        columns = {name: [] for name in EXPORT_COLUMNS}
+        pending = 0
+        for row in rows:
+            for name in EXPORT_COLUMNS:
+                columns[name].append(row[name])
+            pending += 1
+            if pending == CHUNK_ROWS:
+                writer.write_table(pyarrow.table(columns, schema=schema))
+                columns = {name: [] for name in EXPORT_COLUMNS}
+                pending = 0
+        if pending:
+            writer.write_table(pyarrow.table(columns, schema=schema))
+
+
+def write_export(rows: Iterator[Dict[str, Any]], fmt: str, out: BinaryIO):
+    """Stream rows to a binary file object in the given format"""
+    if fmt == 'parquet':
+        if parquet is None:
+            raise ValueError("Parquet export needs pyarrow")
+        write_parquet(rows, out)
+        return
+    chunks = iter_csv(rows) if fmt == 'csv' else iter_jsonl(rows)
+    for chunk in chunks:
+        out.write(chunk.encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export transaction history")
+    parser.add_argument("--db", help="State backend (default $TERMINAL_STATE_DB)")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+    parser.add_argument("--terminal", help="Profile ID (merchant:terminal)")
+    parser.add_argument("--since", help="First day, YYYY-MM-DD")
+    parser.add_argument("--until", help="Last day, YYYY-MM-DD (inclusive)")
+    parser.add_argument("--batch", help="Batch number")
+    parser.add_argument("-o", "--output", help="Output file (default stdout)")
+    args = parser.parse_args()
+
+    # A memory backend opened here would be a new, empty store
+    backend = open_state_backend(args.db)
+    if not isinstance(backend, SQLiteStateBackend):
+        parser.error("needs the SQLite state the terminal writes: pass --db or set TERMINAL_STATE_DB")
+
+    since = datetime.strptime(args.since, "%Y-%m-%d") if args.since else None
+    until = datetime.strptime(args.until, "%Y-%m-%d") + timedelta(days=1) if args.until else None
+    rows = export_rows(backend, args.terminal, since, until, args.batch)
+
+    if args.output:
+        with open(args.output, 'wb') as out:
+            write_export(rows, args.format, out)
+    else:
+        write_export(rows, args.format, sys.stdout.buffer)
+
+
+if __name__ == "__main__":
+    main()
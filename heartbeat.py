@@ -0,0 +1,133 @@
+"""
+Network-Management Heartbeat
+Background 0800/0810 echo tests that keep pooled host links warm
+"""
+
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from authorizer import HostClient
+from connections import Deadline, server_key
+from iso8583 import build_echo_fields, encode_message, parse_response
+from state_backend import CounterBlock, StateBackend
+
+# Longest wait between reconnect attempts to a host that keeps failing
+MAX_BACKOFF = 300.0
+
+
+class Heartbeat:
+    """
+    Periodic echo test on every keep-alive server.
+
+    Each round takes the idle pooled connections for a server, sends an 0800
+    on each and puts back the ones that answer 0810, recording the round
+    trip as the server's 'echo' latency. Dead connections are closed and, if
+    the pool would otherwise be empty, a fresh one is opened so the next
+    sale does not pay for connection setup. A server that carried real
+    traffic within the interval is skipped, and one that keeps failing is
+    retried with exponential backoff.
+    """
+
+    def __init__(self, client: HostClient, backend: StateBackend,
+                 server_configs: Callable[[], Dict[str, Dict]],
+                 interval: Callable[[], float], min_idle: int = 1):
+        self.client = client
+        self.server_configs = server_configs
+        self.interval = interval
+        self.min_idle = min_idle
+        self._stan = CounterBlock(backend, "stan:network", start=1)
+        self._failures: Dict[tuple, int] = {}
+        self._retry_at: Dict[tuple, float] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_round: Dict[tuple, str] = {}
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="heartbeat", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            interval = self.interval()
+            if interval > 0:
+                try:
+                    self.run_once(interval)
+                except Exception:
+                    pass  # never let one bad round kill the thread
+            self._stop.wait(interval if interval > 0 else 5.0)
+
+    def run_once(self, interval: float):
+        """One heartbeat round over all keep-alive servers"""
+        now = time.monotonic()
+        for server_config in self.server_configs().values():
+            if not server_config.get('keep_alive', False):
+                continue
+            key = server_key(server_config)
+
+            # Real traffic already keeps this link alive
+            if now - self.client.last_traffic.get(key, 0.0) < interval:
+                self.last_round[key] = "skipped (recent traffic)"
+                continue
+            if now < self._retry_at.get(key, 0.0):
+                self.last_round[key] = "backing off"
+                continue
+
+            alive = self._echo_idle(server_config, interval)
+            if alive < self.min_idle:
+                alive += self._open_warm(server_config, interval)
+
+            if alive:
+                self._failures.pop(key, None)
+                self._retry_at.pop(key, None)
+                self.last_round[key] = f"{alive} connection(s) alive"
+            else:
+                failures = self._failures.get(key, 0) + 1
+                self._failures[key] = failures
+                self._retry_at[key] = now + min(MAX_BACKOFF, interval * (2 ** (failures - 1)))
+                self.last_round[key] = f"unreachable ({failures} failed round(s))"
+
+    def _echo_idle(self, server_config: Dict, interval: float) -> int:
+        """Echo every idle pooled connection; returns how many answered"""
+        key = server_key(server_config)
+        idle = []
+        for _ in range(self.client.pool.idle_count(key)):
+            conn = self.client.pool.acquire(key)
+            if conn is None:
+                break
+            idle.append(conn)
+
+        alive = 0
+        for conn in idle:
+            ok = self.echo(conn, server_config, interval)
+            self.client.pool.release(key, conn, reusable=ok)
+            alive += ok
+        return alive
+
+    def _open_warm(self, server_config: Dict, interval: float) -> int:
+        """Open, verify and pool a fresh connection; returns 1 on success"""
+        try:
+            conn, _ = self.client.connect(server_config, Deadline(min(10.0, interval)), pooled=False)
+        except Exception:
+            return 0
+        ok = self.echo(conn, server_config, interval)
+        self.client.pool.release(server_key(server_config), conn, reusable=ok)
+        return int(ok)
+
+    def echo(self, conn, server_config: Dict, interval: float) -> bool:
+        """Send one 0800 echo test; True if the host answered 0810"""
+        stan = str(self._stan.next() % 1000000).zfill(6)
+        dialect = server_config.get('dialect')
+        frame = encode_message("0800", build_echo_fields(stan), dialect)
+        try:
+            response = self.client.exchange(conn, server_config, frame,
+                                            Deadline(min(10.0, interval)), phase='echo')
+        except Exception:
+            return False
+        result = parse_response(response, dialect)
+        return result.get('mti') == "0810" and result.get('response_code', '00') == '00'
@@ -0,0 +1,556 @@
+#!/usr/bin/env python3
+"""
+Host-Link Daemon
+One long-running process owns the host connections and sequence counters;
+UI processes send it authorizations over a Unix socket
+
+    TERMINAL_STATE_DB=./state/terminal.db python hostlink.py --socket ./state/hostlink.sock --connections 4
+    TERMINAL_HOSTLINK=./state/hostlink.sock streamlit run app.py
+
+Frames are a 4-byte big-endian length and a body starting with
+(version, type, request id) as !BBI. Strings are a 2-byte length and
+UTF-8 bytes, with 0xFFFF marking an absent value.
+"""
+
+import argparse
+import os
+import signal
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from authorizer import DEFAULT_AUTHORIZATION_BUDGET, HostClient, authorize_sale
+from connections import ConnectionPool, LatencyTracker, SSLContextCache, recv_exact
+from emv import ChipData
+from idempotency import DEFAULT_IDEMPOTENCY_WINDOW, SubmissionCache
+from profiles import ProfileRegistry
+from reversals import ReversalQueue
+from state_backend import CertificateStore, open_state_backend
+
+PROTOCOL_VERSION = 1
+
+# Message types; replies have the high bit set
+AUTHORIZE = 0x01
+STATUS = 0x02
+RESULT = 0x81
+STATUS_REPLY = 0x82
+ERROR = 0xFF
+
+HEADER = struct.Struct("!BBI")
+AUTHORIZE_FIXED = struct.Struct("!Qd")   # amount in cents, budget seconds
+RESULT_FIXED = struct.Struct("!BB")      # replayed, connected
+STATUS_FIXED = struct.Struct("!IQII")    # in flight, served, idle connections, pending reversals
+ABSENT = 0xFFFF
+
+# Result keys carried back to the UI, in wire order
+RESULT_FIELDS = ('response_code', 'response_message', 'approval_code', 'full_auth_code', 'rrn', 'stan',
+                 'receipt_number', 'batch_number', 'server', 'error', 'reversal')
+
+# Queued requests allowed per UI session
+DEFAULT_SESSION_QUEUE = 100
+
+# Queue the daemon's own reversal rounds wait in for a worker
+REVERSAL_SESSION = "reversals"
+
+MAX_MESSAGE = 65536
+
+
+class HostLinkError(Exception):
+    """The daemon refused a request or sent something unreadable"""
+
+
+def _put(parts: List[bytes], value: Optional[Any]):
+    if value is None:
+        parts.append(struct.pack("!H", ABSENT))
+        return
+    data = value if isinstance(value, bytes) else str(value).encode('utf-8')
+    if len(data) >= ABSENT:
+        raise ValueError("Field too long for the host-link protocol")
+    parts.append(struct.pack("!H", len(data)))
+    parts.append(data)
+
+
+def _get(view: memoryview, pos: int) -> Tuple[Optional[bytes], int]:
+    if pos + 2 > len(view):
+        raise HostLinkError("Message truncated")
+    (length,) = struct.unpack_from("!H", view, pos)
+    pos += 2
+    if length == ABSENT:
+        return None, pos
+    if pos + length > len(view):
+        raise HostLinkError("Message truncated")
+    return bytes(view[pos:pos + length]), pos + length
+
+
+def _text(value: Optional[bytes]) -> Optional[str]:
+    return value.decode('utf-8') if value is not None else None
+
+
+def frame(message_type: int, request_id: int, body: bytes = b"") -> bytes:
+    payload = HEADER.pack(PROTOCOL_VERSION, message_type, request_id) + body
+    return struct.pack("!I", len(payload)) + payload
+
+
+def read_frame(conn: socket.socket) -> Tuple[int, int, memoryview]:
+    """(type, request id, body) of the next message; ConnectionError at EOF"""
+    (length,) = struct.unpack("!I", recv_exact(conn, 4))
+    if not HEADER.size <= length <= MAX_MESSAGE:
+        raise HostLinkError(f"Bad message length {length}")
+    payload = memoryview(recv_exact(conn, length))
+    version, message_type, request_id = HEADER.unpack_from(payload)
+    if version != PROTOCOL_VERSION:
+        raise HostLinkError(f"Unsupported protocol version {version}")
+    return message_type, request_id, payload[HEADER.size:]
+
+
+def encode_authorize(request: Dict[str, Any]) -> bytes:
+    parts = [AUTHORIZE_FIXED.pack(int(round(request['amount'] * 100)), request['budget'])]
+    for name in ('session', 'key', 'profile_id', 'server', 'pan', 'expiry', 'approval_code', 'merchant_name'):
+        _put(parts, request[name])
+    _put(parts, request.get('chip_data'))
+    return b"".join(parts)
+
+
+def decode_authorize(body: memoryview) -> Dict[str, Any]:
+    cents, budget = AUTHORIZE_FIXED.unpack_from(body)
+    request: Dict[str, Any] = {'amount': cents / 100.0, 'budget': budget}
+    pos = AUTHORIZE_FIXED.size
+    for name in ('session', 'key', 'profile_id', 'server', 'pan', 'expiry', 'approval_code', 'merchant_name'):
+        value, pos = _get(body, pos)
+        request[name] = _text(value)
+    request['chip_data'], pos = _get(body, pos)
+    return request
+
+
+def encode_result(result: Dict[str, Any], replayed: bool) -> bytes:
+    parts = [RESULT_FIXED.pack(int(replayed), int(result.get('connected', True)))]
+    for name in RESULT_FIELDS:
+        _put(parts, result.get(name))
+    emv = result.get('emv')
+    _put(parts, bytes(emv.raw) if emv is not None else None)
+    return b"".join(parts)
+
+
+def decode_result(body: memoryview) -> Tuple[Dict[str, Any], bool]:
+    replayed, connected = RESULT_FIXED.unpack_from(body)
+    result: Dict[str, Any] = {'connected': bool(connected)}
+    pos = RESULT_FIXED.size
+    for name in RESULT_FIELDS:
+        value, pos = _get(body, pos)
+        if value is not None:
+            result[name] = _text(value)
+    for name in ('receipt_number', 'batch_number'):
+        if name in result and result[name].isdigit():
+            result[name] = int(result[name])
+    emv, pos = _get(body, pos)
+    if emv is not None:
+        result['emv'] = ChipData(emv)
+    return result, bool(replayed)
+
+
+def encode_status(status: Dict[str, Any]) -> bytes:
+    parts = [STATUS_FIXED.pack(status['in_flight'], status['served'], status['idle_connections'],
+                               status['pending_reversals']),
+             struct.pack("!H", len(status['queued']))]
+    for session, depth in status['queued'].items():
+        _put(parts, session)
+        parts.append(struct.pack("!I", depth))
+    return b"".join(parts)
+
+
+def decode_status(body: memoryview) -> Dict[str, Any]:
+    in_flight, served, idle, pending = STATUS_FIXED.unpack_from(body)
+    (count,) = struct.unpack_from("!H", body, STATUS_FIXED.size)
+    pos = STATUS_FIXED.size + 2
+    queued: Dict[str, int] = {}
+    for _ in range(count):
+        session, pos = _get(body, pos)
+        (queued[_text(session) or ""],) = struct.unpack_from("!I", body, pos)
+        pos += 4
+    return {'queued': queued, 'in_flight': in_flight, 'served': served,
+            'idle_connections': idle, 'pending_reversals': pending}
+
+
+class QueueFull(Exception):
+    """A session already has as many requests queued as it may"""
+
+
+class FairQueue:
+    """
+    Requests queued per UI session and served round-robin across sessions,
+    so a session firing many requests cannot starve one with a single
+    sale. Each session's own requests stay in order.
+    """
+
+    def __init__(self, max_per_session: int = DEFAULT_SESSION_QUEUE):
+        self.max_per_session = max_per_session
+        self._cond = threading.Condition()
+        self._queues: "OrderedDict[str, Deque[Any]]" = OrderedDict()
+
+    def put(self, session: str, item: Any):
+        with self._cond:
+            queue = self._queues.get(session)
+            if queue is None:
+                queue = self._queues[session] = deque()
+            if len(queue) >= self.max_per_session:
+                raise QueueFull(f"Session has {len(queue)} requests queued")
+            queue.append(item)
+            self._cond.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        with self._cond:
+            if not self._queues and not self._cond.wait_for(lambda: self._queues, timeout):
+                return None
+            session, queue = next(iter(self._queues.items()))
+            item = queue.popleft()
+            # Served sessions go to the back of the rotation
+            del self._queues[session]
+            if queue:
+                self._queues[session] = queue
+            return item
+
+    def depths(self) -> Dict[str, int]:
+        with self._cond:
+            return {session: len(queue) for session, queue in self._queues.items()}
+
+
+class _Job:
+    __slots__ = ('request', 'reply', 'received')
+
+    def __init__(self, request: Dict[str, Any], reply):
+        self.request = request
+        self.reply = reply
+        self.received = time.monotonic()
+
+
+class _Task:
+    """Daemon work, such as a reversal round, run on a worker slot like a sale"""
+    __slots__ = ('fn', 'future')
+
+    def __init__(self, fn: Callable[[], Any]):
+        self.fn = fn
+        self.future: Future = Future()
+
+    def run(self):
+        try:
+            self.future.set_result(self.fn())
+        except Exception as e:
+            self.future.set_exception(e)
+
+
+class HostLinkServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Accepts UI connections and feeds a fixed set of workers. At most
+    `connections` authorizations run at once, and servers are forced to
+    keep-alive with a pool of that size, so the host never sees more than
+    `connections` sockets from this terminal however many UI sessions are
+    open. Reversals take a worker slot for each round, so they count
+    against the same limit. Results are kept by idempotency key for the configured
+    idempotency window: a UI that restarts or loses its link mid-sale
+    resends the same key and gets the in-flight or stored result instead of
+    a second 0200. With the window at 0 nothing is kept and a resend is a
+    new sale.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, registry: ProfileRegistry, client: HostClient, connections: int = 4,
+                 max_per_session: int = DEFAULT_SESSION_QUEUE, reversals: Optional[ReversalQueue] = None,
+                 certificates: Optional[CertificateStore] = None):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, HostLinkHandler)
+        os.chmod(path, 0o660)
+        self.registry = registry
+        self.client = client
+        self.reversals = reversals
+        if reversals is not None:
+            reversals.dispatch = self.run_in_worker
+        self.certificates = certificates
+        self.queue = FairQueue(max_per_session)
+        self.results = SubmissionCache()
+        self.in_flight = 0
+        self.served = 0
+        self._lock = threading.Lock()
+        self._certificate_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._workers = [threading.Thread(target=self._work, name=f"hostlink-{i}", daemon=True)
+                         for i in range(connections)]
+        for worker in self._workers:
+            worker.start()
+
+    def sync_certificates(self):
+        """Mirror certificates uploaded through any UI replica, as the app does"""
+        if self.certificates is None:
+            return
+        with self._certificate_lock:
+            self.certificates.sync()
+
+    def server_configs(self) -> Dict[str, Dict]:
+        configs = self.registry.config.get('server_config') or {}
+        return {name: dict(config, keep_alive=True) for name, config in configs.items()}
+
+    def _work(self):
+        while not self._stopping.is_set() or self.queue.depths():
+            job = self.queue.get(timeout=0.5)
+            if job is None:
+                continue
+            with self._lock:
+                self.in_flight += 1
+            if isinstance(job, _Task):
+                try:
+                    job.run()
+                finally:
+                    with self._lock:
+                        self.in_flight -= 1
+                continue
+            try:
+                result, replayed = self.authorize(job)
+            except Exception as e:
+                result, replayed = {"error": f"Host link failure: {e}", "connected": False}, False
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                    self.served += 1
+            try:
+                job.reply(RESULT, encode_result(result, replayed))
+            except OSError:
+                pass  # the UI went away; the result waits under its key
+
+    def run_in_worker(self, fn: Callable[[], Any]) -> Any:
+        """Run `fn` on a worker once one is free, queued fairly with the UI sessions"""
+        if self._stopping.is_set():
+            raise HostLinkError("Host link is shutting down")
+        task = _Task(fn)
+        self.queue.put(REVERSAL_SESSION, task)
+        return task.future.result()
+
+    def authorize(self, job: _Job) -> Tuple[Dict[str, Any], bool]:
+        request = job.request
+        # Time spent queued comes out of the sale's budget
+        budget = request['budget'] - (time.monotonic() - job.received)
+        if budget <= 0:
+            return {"error": "Queued past the authorization deadline", "connected": False}, False
+        server_configs = self.server_configs()
+        if request['server'] not in server_configs:
+            return {"error": f"No server '{request['server']}' configured", "connected": False}, False
+        profile = self.registry.get_or_create(*request['profile_id'].split(":", 1))
+        self.sync_certificates()
+
+        config = self.registry.config
+        return self.results.run(
+            request['key'],
+            config.get('idempotency_window', DEFAULT_IDEMPOTENCY_WINDOW),
+            lambda: authorize_sale(
+                self.client, profile, server_configs, request['server'],
+                pan=request['pan'],
+                amount=request['amount'],
+                expiry=request['expiry'],
+                approval_code=request['approval_code'],
+                merchant_name=request['merchant_name'],
+                budget=budget,
+                chip_data=request['chip_data'],
+                on_unconfirmed=self.reversals.enqueue if self.reversals else None
+            ),
+            wait=budget
+        )
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'queued': self.queue.depths(),
+            'in_flight': self.in_flight,
+            'served': self.served,
+            'idle_connections': self.client.pool.idle_count(),
+            'pending_reversals': len(self.reversals.pending()) if self.reversals else 0,
+        }
+
+    def drain(self, timeout: float = DEFAULT_AUTHORIZATION_BUDGET * 2):
+        """Stop taking work and let queued and in-flight sales finish"""
+        self._stopping.set()
+        for worker in self._workers:
+            worker.join(timeout)
+
+
+class HostLinkHandler(socketserver.BaseRequestHandler):
+    """One UI process; its requests are answered as they complete, in any order"""
+
+    def setup(self):
+        self._write_lock = threading.Lock()
+
+    def reply(self, message_type: int, request_id: int, body: bytes):
+        data = frame(message_type, request_id, body)
+        with self._write_lock:
+            self.request.sendall(data)
+
+    def handle(self):
+        while True:
+            try:
+                message_type, request_id, body = read_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+            except HostLinkError as e:
+                self.reply(ERROR, 0, str(e).encode('utf-8'))
+                return
+
+            try:
+                if message_type == AUTHORIZE:
+                    request = decode_authorize(body)
+                    job = _Job(request, lambda kind, data, rid=request_id: self.reply(kind, rid, data))
+                    self.server.queue.put(request['session'] or "", job)
+                elif message_type == STATUS:
+                    status = self.server.status()
+                    self.reply(STATUS_REPLY, request_id, encode_status(status))
+                else:
+                    self.reply(ERROR, request_id, f"Unknown message type {message_type}".encode('utf-8'))
+            except (QueueFull, HostLinkError, struct.error, UnicodeDecodeError) as e:
+                self.reply(ERROR, request_id, str(e).encode('utf-8'))
+
+
+class HostLinkClient:
+    """
+    UI side of the link: one Unix socket per process, shared by every
+    session, with replies matched to callers by request id. If the link
+    drops, pending sales are resent with the same idempotency key, which
+    the daemon resolves to the sale already under way.
+    """
+
+    def __init__(self, path: str, connect_timeout: float = 2.0):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self._lock = threading.Lock()
+        self._conn: Optional[socket.socket] = None
+        self._pending: Dict[int, Future] = {}
+        self._next_id = 0
+
+    def _connection(self) -> socket.socket:
+        with self._lock:
+            if self._conn is None:
+                conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                conn.settimeout(self.connect_timeout)
+                conn.connect(self.path)
+                conn.settimeout(None)
+                self._conn = conn
+                threading.Thread(target=self._read, args=(conn,), name="hostlink-reader", daemon=True).start()
+            return self._conn
+
+    def _read(self, conn: socket.socket):
+        try:
+            while True:
+                message_type, request_id, body = read_frame(conn)
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if message_type == ERROR:
+                    future.set_exception(HostLinkError(bytes(body).decode('utf-8', 'replace')))
+                else:
+                    future.set_result((message_type, body))
+        except (ConnectionError, OSError, HostLinkError) as e:
+            with self._lock:
+                if self._conn is conn:
+                    self._conn = None
+                pending, self._pending = self._pending, {}
+            conn.close()
+            for future in pending.values():
+                future.set_exception(ConnectionError(f"Host link lost: {e}"))
+
+    def _call(self, message_type: int, body: bytes, timeout: float) -> Tuple[int, memoryview]:
+        conn = self._connection()
+        future: Future = Future()
+        with self._lock:
+            self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+            request_id = self._next_id
+            self._pending[request_id] = future
+        try:
+            conn.sendall(frame(message_type, request_id, body))
+            return future.result(timeout)
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+    def authorize(self, session: str, key: str, profile_id: str, server: str, pan: str, amount: float,
+                  expiry: str, approval_code: str, merchant_name: str,
+                  budget: float = DEFAULT_AUTHORIZATION_BUDGET,
+                  chip_data: Optional[bytes] = None) -> Tuple[Dict[str, Any], bool]:
+        """Run one sale through the daemon; returns (result, replayed) like SubmissionCache.run"""
+        body = encode_authorize({
+            'session': session, 'key': key, 'profile_id': profile_id, 'server': server,
+            'pan': pan, 'amount': amount, 'expiry': expiry, 'approval_code': approval_code,
+            'merchant_name': merchant_name, 'budget': budget, 'chip_data': chip_data,
+        })
+        deadline = time.monotonic() + budget + 5.0
+        last_error = "Host link unavailable"
+        while time.monotonic() < deadline:
+            try:
+                _, reply = self._call(AUTHORIZE, body, max(0.1, deadline - time.monotonic()))
+                return decode_result(reply)
+            except HostLinkError as e:
+                return {"error": f"Host link refused the sale: {e}", "connected": False}, False
+            except FutureTimeout:
+                # Before OSError: it is the builtin TimeoutError, an OSError subclass
+                last_error = "No reply from host link"
+                break
+            except (ConnectionError, OSError) as e:
+                # The daemon matches the key to the sale it already has, so a
+                # resend is only a second 0200 when the idempotency window is 0
+                last_error = f"Host link: {e}"
+                time.sleep(0.2)
+        # The daemon may still complete it; the same key collects that result later
+        return {"error": last_error, "connected": False}, False
+
+    def status(self) -> Dict[str, Any]:
+        """Queue depths per session, in-flight and served sales, idle connections and pending reversals"""
+        _, reply = self._call(STATUS, b"", 5.0)
+        return decode_status(reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Host-link daemon owning the host connections")
+    parser.add_argument("--socket", default="./state/hostlink.sock", help="Unix socket path")
+    parser.add_argument("--db", help="State backend (default $TERMINAL_STATE_DB); must be shared with the UI")
+    parser.add_argument("--connections", type=int, default=4, help="Host connections per server")
+    parser.add_argument("--session-queue", type=int, default=DEFAULT_SESSION_QUEUE)
+    parser.add_argument("--cert-dir", default="./state/hostlink-certs",
+                        help="Where the daemon mirrors the client certificates uploaded through the UI")
+    args = parser.parse_args()
+
+    backend = open_state_backend(args.db)
+    registry = ProfileRegistry(backend)
+    cert_file, key_file = f"{args.cert_dir}/cad.crt", f"{args.cert_dir}/client.key"
+    ssl_contexts = SSLContextCache()
+    certificates = CertificateStore(registry.config, cert_file, key_file, ssl_contexts)
+    client = HostClient(ssl_contexts, ConnectionPool(max_idle_per_server=args.connections, idle_timeout=300.0),
+                        LatencyTracker(), cert_file, key_file)
+    os.makedirs(os.path.dirname(os.path.abspath(args.socket)), exist_ok=True)
+    # Reversals of unconfirmed sales share the daemon's connection pool and workers
+    reversals = ReversalQueue(client, backend, lambda: server.server_configs())
+    server = HostLinkServer(args.socket, registry, client, args.connections, args.session_queue, reversals,
+                            certificates)
+    reversals.start()
+    server.sync_certificates()
+    if not certificates.uploaded:
+        print("No client certificates uploaded yet; HTTPS hosts will fail until one is saved in the UI")
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Host link on {args.socket}: {args.connections} connection(s) per server")
+    try:
+        server.serve_forever()
+    finally:
+        server.drain()
+        server.server_close()
+        client.pool.close_all()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
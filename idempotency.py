@@ -0,0 +1,113 @@
+"""
+Idempotent Submission
+Collapse repeated authorizations (double clicks, reruns) onto one host request
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Seconds a completed authorization is returned for identical submissions
+DEFAULT_IDEMPOTENCY_WINDOW = 120.0
+
+
+def idempotency_key(pan: str, amount: float, approval_code: str, profile_id: str) -> str:
+    """Digest of what makes two submissions the same sale (no PAN is kept)"""
+    material = f"{profile_id}|{pan}|{int(round(amount * 100))}|{approval_code}"
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def is_definitive(result: Dict[str, Any]) -> bool:
+    """The host answered with a response code (DE 39), approval or decline"""
+    return 'error' not in result and bool(result.get('response_code'))
+
+
+class _Submission:
+    __slots__ = ('done', 'result', 'expires')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+        self.expires = float('inf')  # in flight until the result is in
+
+
+class SubmissionCache:
+    """
+    Results by idempotency key, shared by every session in the process.
+    The first submission runs; identical ones while it is in flight wait for
+    its result, and ones within `window` seconds after it get the stored
+    result. Only definitive host answers (a response code and no error) are
+    kept. After a connect failure, timeout or unreadable reply, a retry goes
+    out as a new sale; the unconfirmed one is reversed separately. Entries
+    expire after the window and the oldest are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Submission]" = OrderedDict()
+        self.replayed = 0
+
+    def _purge(self, now: float):
+        # Completed entries are in completion order, so expired ones come
+        # first; in-flight entries keep their arrival slot and are skipped
+        excess = len(self._entries) - self.max_entries
+        stale = []
+        for key, entry in self._entries.items():
+            if not entry.done.is_set():
+                continue
+            if entry.expires > now and excess <= 0:
+                break
+            stale.append(key)
+            excess -= 1
+        for key in stale:
+            del self._entries[key]
+
+    def run(self, key: str, window: float, submit: Callable[[], Dict[str, Any]],
+            wait: float = 60.0) -> Tuple[Dict[str, Any], bool]:
+        """Run `submit` unless an identical one is stored or in flight; returns (result, replayed)"""
+        if window <= 0:
+            return submit(), False
+
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= now:
+                del self._entries[key]
+                entry = None
+            owner = entry is None
+            if owner:
+                entry = self._entries[key] = _Submission()
+            self._purge(now)
+
+        if not owner:
+            if entry.done.wait(wait) and entry.result is not None:
+                with self._lock:
+                    self.replayed += 1
+                return entry.result, True
+            return {"error": "Identical transaction still in progress", "connected": False}, True
+
+        try:
+            result = submit()
+        except BaseException:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            entry.done.set()
+            raise
+
+        entry.result = result
+        with self._lock:
+            if self._entries.get(key) is entry:
+                if is_definitive(result):
+                    entry.expires = time.monotonic() + window
+                    self._entries.move_to_end(key)
+                else:
+                    del self._entries[key]
+        entry.done.set()
+        return result, False
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,644 @@
+"""
+ISO-8583 Message Codec
+Building and parsing Base I messages, independent of the Streamlit UI
+"""
+
+import re
+import struct
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from emv import ChipData
+
+# Visa response codes
+VISA_RESPONSE_CODES = {
+    '00': 'APPROVED - Transaction Completed',
+    '01': 'REFER TO ISSUER',
+    '05': 'DECLINED - Do Not Honor',
+    '12': 'ERROR - Invalid Transaction',
+    '13': 'ERROR - Invalid Amount',
+    '14': 'ERROR - Invalid Card',
+    '51': 'DECLINED - Insufficient Funds',
+    '54': 'ERROR - Expired Card',
+    '55': 'ERROR - Invalid PIN',
+    '57': 'TRANSACTION NOT PERMITTED',
+    '58': 'TRANSACTION NOT PERMITTED',
+    '61': 'EXCEEDS WITHDRAWAL LIMIT',
+    '62': 'RESTRICTED CARD',
+    '65': 'EXCEEDS WITHDRAWAL FREQUENCY',
+    '75': 'EXCEEDS PIN TRIES',
+    '76': 'INVALID ROUTING',
+    '91': 'UNAVAILABLE - Issuer Unavailable',
+    '96': 'ERROR - System Malfunction'
+}
+
+# DE 39 is two alphanumeric characters
+RESPONSE_CODE = re.compile(r"[0-9A-Za-z]{2}")
+
+# Data element formats as this terminal exchanges them: (kind, length, type).
+# 'fixed' fields are sent at their exact length, 'llvar'/'lllvar' fields
+# carry a 2/3-digit length prefix. Type is 'n' (numeric), 'z' (track data),
+# 'ans' (text) or 'b' (binary, held as bytes); it decides how a dialect packs
+# the field. Lengths count digits, characters or bytes respectively. DE 24
+# is 2 digits and DE 60 is LLVAR here, matching what the host has always
+# received.
+FIELD_SPECS = {
+    2: ('llvar', 19, 'n'),     # Primary account number
+    3: ('fixed', 6, 'n'),      # Processing code
+    4: ('fixed', 12, 'n'),     # Amount, transaction
+    5: ('fixed', 12, 'n'),     # Amount, settlement
+    6: ('fixed', 12, 'n'),     # Amount, cardholder billing
+    7: ('fixed', 10, 'n'),     # Transmission date & time
+    8: ('fixed', 8, 'n'),      # Amount, cardholder billing fee
+    9: ('fixed', 8, 'n'),      # Conversion rate, settlement
+    10: ('fixed', 8, 'n'),     # Conversion rate, cardholder billing
+    11: ('fixed', 6, 'n'),     # Systems trace audit number
+    12: ('fixed', 6, 'n'),     # Local time
+    13: ('fixed', 4, 'n'),     # Local date
+    14: ('fixed', 4, 'n'),     # Expiration date
+    15: ('fixed', 4, 'n'),     # Settlement date
+    16: ('fixed', 4, 'n'),     # Currency conversion date
+    17: ('fixed', 4, 'n'),     # Capture date
+    18: ('fixed', 4, 'n'),     # Merchant type
+    19: ('fixed', 3, 'n'),     # Acquiring institution country code
+    20: ('fixed', 3, 'n'),     # PAN extended country code
+    21: ('fixed', 3, 'n'),     # Forwarding institution country code
+    22: ('fixed', 3, 'n'),     # POS entry mode
+    23: ('fixed', 3, 'n'),     # Card sequence number
+    24: ('fixed', 2, 'n'),     # Function code
+    25: ('fixed', 2, 'n'),     # POS condition code
+    26: ('fixed', 2, 'n'),     # POS capture code
+    27: ('fixed', 1, 'n'),     # Authorizing identification response length
+    28: ('fixed', 9, 'ans'),   # Amount, transaction fee (x+n8)
+    29: ('fixed', 9, 'ans'),   # Amount, settlement fee
+    30: ('fixed', 9, 'ans'),   # Amount, transaction processing fee
+    31: ('fixed', 9, 'ans'),   # Amount, settlement processing fee
+    32: ('llvar', 11, 'n'),    # Acquiring institution ID code
+    33: ('llvar', 11, 'n'),    # Forwarding institution ID code
+    34: ('llvar', 28, 'ans'),  # Primary account number, extended
+    35: ('llvar', 37, 'z'),    # Track 2 data
+    36: ('lllvar', 104, 'ans'),  # Track 3 data
+    37: ('fixed', 12, 'ans'),  # Retrieval reference number
+    38: ('fixed', 6, 'ans'),   # Approval code
+    39: ('fixed', 2, 'ans'),   # Response code
+    40: ('fixed', 3, 'ans'),   # Service restriction code
+    41: ('fixed', 8, 'ans'),   # Terminal ID
+    42: ('fixed', 15, 'ans'),  # Merchant ID
+    43: ('fixed', 40, 'ans'),  # Merchant name/location
+    44: ('llvar', 25, 'ans'),  # Additional response data
+    45: ('llvar', 76, 'ans'),  # Track 1 data
+    46: ('lllvar', 999, 'ans'),  # Additional data (ISO)
+    47: ('lllvar', 999, 'ans'),  # Additional data (national)
+    48: ('lllvar', 999, 'ans'),  # Additional data (private)
+    49: ('fixed', 3, 'n'),     # Currency code
+    50: ('fixed', 3, 'ans'),   # Currency code, settlement
+    51: ('fixed', 3, 'ans'),   # Currency code, cardholder billing
+    52: ('fixed', 8, 'b'),     # PIN data
+    53: ('fixed', 16, 'n'),    # Security related control information
+    54: ('lllvar', 120, 'ans'),  # Additional amounts
+    55: ('lllvar', 255, 'b'),  # ICC (EMV chip) data, BER-TLV
+    56: ('lllvar', 999, 'ans'),  # Reserved (ISO)
+    57: ('lllvar', 999, 'ans'),  # Reserved (national)
+    58: ('lllvar', 999, 'ans'),  # Reserved (national)
+    59: ('lllvar', 999, 'ans'),  # Reserved (national)
+    60: ('llvar', 99, 'ans'),  # Additional data
+    61: ('lllvar', 999, 'ans'),  # Reserved (private)
+    62: ('lllvar', 999, 'ans'),  # Reserved (private)
+    63: ('lllvar', 999, 'ans'),  # Reserved (private)
+    64: ('fixed', 8, 'b'),     # Message authentication code
+    65: ('fixed', 8, 'b'),     # Extended bitmap (tertiary)
+    66: ('fixed', 1, 'n'),     # Settlement code
+    67: ('fixed', 2, 'n'),     # Extended payment code
+    68: ('fixed', 3, 'n'),     # Receiving institution country code
+    69: ('fixed', 3, 'n'),     # Settlement institution country code
+    70: ('fixed', 3, 'n'),     # Network management information code
+    71: ('fixed', 4, 'n'),     # Message number
+    72: ('fixed', 4, 'n'),     # Message number, last
+    73: ('fixed', 6, 'n'),     # Date, action
+    74: ('fixed', 10, 'n'),    # Credits, number
+    75: ('fixed', 10, 'n'),    # Credits, reversal number
+    76: ('fixed', 10, 'n'),    # Debits, number
+    77: ('fixed', 10, 'n'),    # Debits, reversal number
+    78: ('fixed', 10, 'n'),    # Transfer, number
+    79: ('fixed', 10, 'n'),    # Transfer, reversal number
+    80: ('fixed', 10, 'n'),    # Inquiries, number
+    81: ('fixed', 10, 'n'),    # Authorizations, number
+    82: ('fixed', 12, 'n'),    # Credits, processing fee amount
+    83: ('fixed', 12, 'n'),    # Credits, transaction fee amount
+    84: ('fixed', 12, 'n'),    # Debits, processing fee amount
+    85: ('fixed', 12, 'n'),    # Debits, transaction fee amount
+    86: ('fixed', 16, 'n'),    # Credits, amount
+    87: ('fixed', 16, 'n'),    # Credits, reversal amount
+    88: ('fixed', 16, 'n'),    # Debits, amount
+    89: ('fixed', 16, 'n'),    # Debits, reversal amount
+    90: ('fixed', 42, 'n'),    # Original data elements
+    91: ('fixed', 1, 'ans'),   # File update code
+    92: ('fixed', 2, 'ans'),   # File security code
+    93: ('fixed', 5, 'ans'),   # Response indicator
+    94: ('fixed', 7, 'ans'),   # Service indicator
+    95: ('fixed', 42, 'ans'),  # Replacement amounts
+    96: ('fixed', 8, 'b'),     # Message security code
+    97: ('fixed', 17, 'ans'),  # Amount, net settlement (x+n16)
+    98: ('fixed', 25, 'ans'),  # Payee
+    99: ('llvar', 11, 'n'),    # Settlement institution ID code
+    100: ('llvar', 11, 'n'),   # Receiving institution ID code
+    101: ('llvar', 17, 'ans'), # File name
+    102: ('llvar', 28, 'ans'), # Account identification 1
+    103: ('llvar', 28, 'ans'), # Account identification 2
+    104: ('lllvar', 100, 'ans'),  # Transaction description
+    # 105-127 are reserved for ISO, national and private use; all LLLVAR
+    **{num: ('lllvar', 999, 'ans') for num in range(105, 128)},
+    128: ('fixed', 8, 'b'),    # Message authentication code
+}
+
+# Length-prefix digits of each variable-length kind
+LENGTH_DIGITS = {'llvar': 2, 'lllvar': 3}
+
+# Bit 1 of the primary bitmap announces a secondary bitmap (DE 65-128)
+SECONDARY_BITMAP = 1 << 127
+
+LENGTH_PREFIX = struct.Struct('>H')
+
+
+def build_sale_fields(pan: str, amount: float, expiry: str, approval_code: str,
+                      merchant_name: str, terminal_id: str, merchant_id: str,
+                      stan: str, rrn: str, now: Optional[datetime] = None,
+                      chip_data: Optional[bytes] = None) -> Dict[int, Any]:
+    """
+    Data elements for an Online Sale (0200) with a 4-digit approval code.
+    With chip_data (BER-TLV from the card's GENERATE AC) the sale goes as a
+    chip read with the data in DE 55.
+    """
+    now = now or datetime.now()
+    transmission_time = now.strftime("%m%d%H%M%S")
+    local_time = now.strftime("%H%M%S")
+    local_date = now.strftime("%m%d")
+
+    # For online transactions: pad 4-digit code to 6 digits for ISO 8583
+    auth_code = approval_code.ljust(6, '0')
+
+    # ISO 8583 data elements - ONLINE TRANSACTION
+    fields = {
+        2: pan,  # LLVAR field
+        3: "000000",  # Processing Code for Purchase
+        4: str(int(amount * 100)).zfill(12),  # Amount in cents
+        7: transmission_time,  # Transmission date & time
+        11: stan,  # Systems trace audit number
+        12: local_time,  # Local time
+        13: local_date,  # Local date
+        14: expiry,  # Expiration date
+        18: "5999",  # Merchant type
+        22: "012",  # POS entry mode - Manual key entry
+        24: "00",  # Function code - Purchase
+        25: "00",  # POS condition code - Normal presentment
+        32: "00000000001",  # Acquiring institution ID code
+        35: pan + "=" + expiry + "100",  # Track 2 data
+        37: rrn,  # Retrieval Reference Number (12 digits)
+        38: auth_code,  # Approval code (4-digit padded to 6)
+        41: terminal_id,  # Terminal ID
+        42: merchant_id,  # Merchant ID
+        43: merchant_name.ljust(40)[:40],  # Merchant name (40 chars)
+        49: "840",  # Currency code (USD)
+        60: "00108001",  # Additional data
+    }
+    if chip_data:
+        fields[22] = "051"  # POS entry mode - Chip read, PIN capable
+        fields[55] = bytes(chip_data)  # ICC data
+    return fields
+
+
+# Sale fields a reversal repeats so the host can match it to the original.
+# The host matches on DE 90 (original STAN and time), RRN and terminal, so
+# PAN and expiry (DE 2, 14) are left out and need never be stored for it.
+REVERSAL_FIELDS = (3, 4, 22, 32, 37, 41, 42, 49)
+
+
+def build_reversal_fields(original: Dict[int, Any], stan: str, now: Optional[datetime] = None) -> Dict[int, Any]:
+    """
+    Data elements for a reversal (0400) of a sale whose outcome is unknown.
+    DE 90 identifies the original: MTI, STAN, transmission time and
+    acquiring institution, then an empty forwarding institution.
+    """
+    now = now or datetime.now()
+    fields = {num: original[num] for num in REVERSAL_FIELDS if num in original}
+    fields[7] = now.strftime("%m%d%H%M%S")  # Transmission date & time
+    fields[11] = stan  # This message's own trace number
+    fields[12] = now.strftime("%H%M%S")
+    fields[13] = now.strftime("%m%d")
+    fields[25] = "00"  # POS condition code - Normal presentment
+    fields[90] = "0200" + original[11] + original[7] + str(original.get(32, "")).zfill(11) + "0" * 11
+    return fields
+
+
+def build_echo_fields(stan: str, now: Optional[datetime] = None) -> Dict[int, str]:
+    """Data elements for a network-management echo test (0800)"""
+    now = now or datetime.now()
+    return {
+        7: now.strftime("%m%d%H%M%S"),  # Transmission date & time
+        11: stan,  # Systems trace audit number
+        70: "301",  # Network management code - Echo test
+    }
+
+
+def _fit(value: Any, length: int, field_type: str) -> Any:
+    """Pad or trim a fixed-length value: numerics zero-left, text space-right, binary zero-right"""
+    if len(value) == length:
+        return value
+    if field_type == 'b':
+        return bytes(value).ljust(length, b"\0")[:length]
+    if field_type == 'n':
+        return value.zfill(length)[-length:]
+    return value.ljust(length)[:length]
+
+
+class FieldError(ValueError):
+    """A data element after a readable bitmap is missing or malformed"""
+
+
+class Dialect:
+    """
+    Wire encoding of MTI, bitmap and data elements.
+    Subclasses only say how one piece is turned into bytes and back; every
+    conversion works on a whole field at once (bytes.fromhex, .hex(),
+    codecs) rather than per character.
+    """
+
+    name = ""
+    label = ""
+
+    def encode(self, mti: str, data_elements: Dict[int, str]) -> bytes:
+        """Encode a message body (no length prefix)"""
+        # Build bitmap: 128 bits as one integer, bit 1 is the most significant
+        bitmap = 0
+        for field_num in data_elements.keys():
+            if 2 <= field_num <= 128 and field_num != 65:
+                bitmap |= 1 << (128 - field_num)
+        if bitmap & ((1 << 64) - 1):
+            bitmap |= SECONDARY_BITMAP
+            bitmap_bytes = bitmap.to_bytes(16, 'big')
+        else:
+            bitmap_bytes = (bitmap >> 64).to_bytes(8, 'big')
+
+        parts = [self.pack_mti(mti), self.pack_bitmap(bitmap_bytes)]
+        for field_num in sorted(data_elements.keys()):
+            if field_num in (1, 65):
+                continue
+            value = data_elements[field_num]
+            kind, length, field_type = FIELD_SPECS.get(field_num, ('fixed', len(value), 'ans'))
+
+            # Handle variable length fields
+            if kind in LENGTH_DIGITS:
+                parts.append(self.pack_length(len(value), LENGTH_DIGITS[kind]))
+            else:
+                value = _fit(value, length, field_type)
+            parts.append(self.pack_field(value, field_type))
+
+        return b"".join(parts)
+
+    def decode(self, data: bytes) -> Tuple[str, Dict[int, str]]:
+        """Decode a message body; raises ValueError on malformed input"""
+        view = memoryview(data)
+        mti, pos = self.unpack_mti(view)
+        bitmap_bytes, pos = self.unpack_bitmap(view, pos)
+        if bitmap_bytes[0] & 0x80:
+            secondary, pos = self.unpack_bitmap(view, pos)
+            bitmap_bytes += secondary
+        bits = len(bitmap_bytes) * 8
+        # Bit 1 only flags the secondary bitmap; it is not a data element
+        bitmap = int.from_bytes(bitmap_bytes, 'big') & ~(1 << (bits - 1))
+        fields: Dict[int, str] = {}
+
+        # Walk set bits from the most significant down (ascending DE order)
+        while bitmap:
+            top = bitmap.bit_length() - 1
+            bitmap ^= 1 << top
+            field_num = bits - top
+            spec = FIELD_SPECS.get(field_num)
+            if spec is None:
+                raise FieldError(f"No format known for DE {field_num}")
+            kind, length, field_type = spec
+            try:
+                if kind in LENGTH_DIGITS:
+                    length, pos = self.unpack_length(view, pos, LENGTH_DIGITS[kind])
+                size = self.packed_size(length, field_type)
+                if pos + size > len(view):
+                    raise ValueError("truncated")
+                fields[field_num] = self.unpack_field(view[pos:pos + size], length, field_type)
+            except (ValueError, UnicodeDecodeError, IndexError) as e:
+                raise FieldError(f"DE {field_num} {e}")
+            pos += size
+
+        return mti, fields
+
+    # --- per-dialect primitives ---
+
+    def pack_mti(self, mti: str) -> bytes:
+        raise NotImplementedError
+
+    def unpack_mti(self, view: memoryview) -> Tuple[str, int]:
+        raise NotImplementedError
+
+    def pack_bitmap(self, bitmap: bytes) -> bytes:
+        return bitmap
+
+    def unpack_bitmap(self, view: memoryview, pos: int) -> Tuple[bytes, int]:
+        if pos + 8 > len(view):
+            raise ValueError("Bitmap truncated")
+        return bytes(view[pos:pos + 8]), pos + 8
+
+    def pack_length(self, length: int, digits: int) -> bytes:
+        raise NotImplementedError
+
+    def unpack_length(self, view: memoryview, pos: int, digits: int) -> Tuple[int, int]:
+        raise NotImplementedError
+
+    def packed_size(self, length: int, field_type: str) -> int:
+        return length
+
+    def pack_field(self, value: Any, field_type: str) -> bytes:
+        raise NotImplementedError
+
+    def unpack_field(self, view: memoryview, length: int, field_type: str) -> Any:
+        raise NotImplementedError
+
+    def describe(self, body: bytes) -> str:
+        """Printable form of a body for debug output"""
+        return body.hex().upper()
+
+
+class AsciiDialect(Dialect):
+    """Everything as ASCII characters, bitmap as 16 hex digits (the original format)"""
+
+    name = "ascii"
+    label = "ASCII"
+
+    def pack_mti(self, mti: str) -> bytes:
+        return mti.encode('ascii')
+
+    def unpack_mti(self, view: memoryview) -> Tuple[str, int]:
+        if len(view) < 20:
+            raise ValueError("Message too short")
+        return bytes(view[0:4]).decode('ascii'), 4
+
+    def pack_bitmap(self, bitmap: bytes) -> bytes:
+        return bitmap.hex().upper().encode('ascii')
+
+    def unpack_bitmap(self, view: memoryview, pos: int) -> Tuple[bytes, int]:
+        if pos + 16 > len(view):
+            raise ValueError("Bitmap truncated")
+        return bytes.fromhex(bytes(view[pos:pos + 16]).decode('ascii')), pos + 16
+
+    def pack_length(self, length: int, digits: int) -> bytes:
+        return f"{length:0{digits}d}".encode('ascii')
+
+    def unpack_length(self, view: memoryview, pos: int, digits: int) -> Tuple[int, int]:
+        return int(bytes(view[pos:pos + digits])), pos + digits
+
+    def packed_size(self, length: int, field_type: str) -> int:
+        # Binary fields travel as hex characters
+        return length * 2 if field_type == 'b' else length
+
+    def pack_field(self, value: Any, field_type: str) -> bytes:
+        if field_type == 'b':
+            return bytes(value).hex().upper().encode('ascii')
+        return value.encode('ascii')
+
+    def unpack_field(self, view: memoryview, length: int, field_type: str) -> Any:
+        if field_type == 'b':
+            return bytes.fromhex(bytes(view).decode('ascii'))
+        return bytes(view).decode('ascii')
+
+    def describe(self, body: bytes) -> str:
+        return body.decode('ascii', errors='ignore')
+
+
+class BinaryBCDDialect(Dialect):
+    """
+    Binary bitmap, MTI and numeric fields packed two digits per byte (BCD),
+    LLVAR/LLLVAR lengths as one/two BCD bytes, text fields in ASCII, binary
+    fields as raw bytes. Track 2 packs its '=' separator as the nibble D.
+    """
+
+    name = "binary"
+    label = "Binary bitmap + BCD"
+
+    def pack_mti(self, mti: str) -> bytes:
+        return bytes.fromhex(mti)
+
+    def unpack_mti(self, view: memoryview) -> Tuple[str, int]:
+        if len(view) < 10:
+            raise ValueError("Message too short")
+        return view[0:2].hex(), 2
+
+    def pack_length(self, length: int, digits: int) -> bytes:
+        size = (digits + 1) // 2
+        return bytes.fromhex(f"{length:0{size * 2}d}")
+
+    def unpack_length(self, view: memoryview, pos: int, digits: int) -> Tuple[int, int]:
+        size = (digits + 1) // 2
+        if pos + size > len(view):
+            raise ValueError("Length prefix truncated")
+        return int(view[pos:pos + size].hex()), pos + size
+
+    def packed_size(self, length: int, field_type: str) -> int:
+        if field_type in ('n', 'z'):
+            return (length + 1) // 2
+        return length
+
+    def pack_field(self, value: Any, field_type: str) -> bytes:
+        if field_type == 'n':
+            # Odd-length numerics are right-aligned (leading zero nibble)
+            return bytes.fromhex(value if len(value) % 2 == 0 else "0" + value)
+        if field_type == 'z':
+            # Track data is left-aligned with a trailing F pad nibble
+            digits = value.replace('=', 'D')
+            return bytes.fromhex(digits if len(digits) % 2 == 0 else digits + "F")
+        if field_type == 'b':
+            return bytes(value)
+        return value.encode('ascii')
+
+    def unpack_field(self, view: memoryview, length: int, field_type: str) -> Any:
+        if field_type == 'n':
+            return view.hex()[-length:] if length else ""
+        if field_type == 'z':
+            return view.hex().upper()[:length].replace('D', '=')
+        if field_type == 'b':
+            return bytes(view)
+        return bytes(view).decode('ascii')
+
+
+class EbcdicDialect(Dialect):
+    """MTI, lengths and text fields as EBCDIC (code page 037); binary bitmap and binary fields"""
+
+    name = "ebcdic"
+    label = "EBCDIC text"
+    codec = 'cp037'
+
+    def pack_mti(self, mti: str) -> bytes:
+        return mti.encode(self.codec)
+
+    def unpack_mti(self, view: memoryview) -> Tuple[str, int]:
+        if len(view) < 12:
+            raise ValueError("Message too short")
+        return bytes(view[0:4]).decode(self.codec), 4
+
+    def pack_length(self, length: int, digits: int) -> bytes:
+        return f"{length:0{digits}d}".encode(self.codec)
+
+    def unpack_length(self, view: memoryview, pos: int, digits: int) -> Tuple[int, int]:
+        return int(bytes(view[pos:pos + digits]).decode(self.codec)), pos + digits
+
+    def pack_field(self, value: Any, field_type: str) -> bytes:
+        if field_type == 'b':
+            return bytes(value)
+        return value.encode(self.codec)
+
+    def unpack_field(self, view: memoryview, length: int, field_type: str) -> Any:
+        if field_type == 'b':
+            return bytes(view)
+        return bytes(view).decode(self.codec)
+
+    def describe(self, body: bytes) -> str:
+        end = 20 if len(body) > 4 and body[4] & 0x80 else 12
+        return body[:4].decode(self.codec) + " " + body[4:end].hex().upper() + " " + body[end:].decode(self.codec, errors='ignore')
+
+
+DIALECTS: Dict[str, Dialect] = {
+    dialect.name: dialect for dialect in (AsciiDialect(), BinaryBCDDialect(), EbcdicDialect())
+}
+DEFAULT_DIALECT = "ascii"
+
+
+def get_dialect(name: Optional[str]) -> Dialect:
+    """Dialect by name (server_config['dialect']); ASCII if unset"""
+    return DIALECTS[name or DEFAULT_DIALECT]
+
+
+def detect_dialect(body: bytes) -> Dialect:
+    """Guess the dialect of a message body from how its MTI is written"""
+    head = body[:4]
+    if len(head) == 4 and all(0x30 <= b <= 0x39 for b in head):
+        return DIALECTS["ascii"]
+    if len(head) == 4 and all(0xF0 <= b <= 0xF9 for b in head):
+        return DIALECTS["ebcdic"]
+    return DIALECTS["binary"]
+
+
+def encode_message(mti: str, data_elements: Dict[int, str], dialect: Optional[str] = None) -> bytes:
+    """Encode a message in the given dialect with a 2-byte length prefix"""
+    body = get_dialect(dialect).encode(mti, data_elements)
+    return LENGTH_PREFIX.pack(len(body)) + body
+
+
+def strip_length_prefix(frame: bytes) -> bytes:
+    """Drop the 2-byte length prefix if it matches the frame size"""
+    if len(frame) > 2:
+        potential_length = LENGTH_PREFIX.unpack(frame[:2])[0]
+        if potential_length == len(frame) - 2:
+            return frame[2:]
+    return frame
+
+
+def decode_message(frame: bytes, dialect: Optional[str] = None) -> Tuple[str, Dict[int, str]]:
+    """
+    Decode a message (length prefix optional). Without a dialect name the
+    dialect is detected from the MTI. Raises ValueError if a field is
+    unknown or the frame is truncated.
+    """
+    body = strip_length_prefix(frame)
+    codec = get_dialect(dialect) if dialect else detect_dialect(body)
+    try:
+        return codec.decode(body)
+    except (UnicodeDecodeError, IndexError) as e:
+        raise ValueError(f"Malformed {codec.label} message: {e}")
+
+
+def parse_response(response: bytes, dialect: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Parse a host response into the result dict used for receipts and history.
+    Decodes with the named dialect, or the one detected from the MTI.
+    """
+    try:
+        if len(response) < 4:
+            return {"error": "Response too short"}
+
+        response = strip_length_prefix(response)
+        codec = get_dialect(dialect) if dialect else detect_dialect(response)
+
+        # Guessing at a reply that does not decode could turn a decline into
+        # an approval; report it as unreadable so the sale is reversed
+        try:
+            mti, fields = codec.decode(response)
+        except FieldError as e:
+            return {
+                "error": f"Malformed {codec.label} response: {e}",
+                "raw_response": codec.describe(response),
+                "length": len(response)
+            }
+        except (ValueError, UnicodeDecodeError, IndexError) as e:
+            return {
+                "error": f"Unreadable {codec.label} response: {e}",
+                "raw_response": codec.describe(response),
+                "length": len(response)
+            }
+
+        result = {
+            "mti": mti,
+            "raw_response": codec.describe(response),
+            "length": len(response),
+            "dialect": codec.name,
+            "fields": fields
+        }
+        resp_code = fields.get(39)
+        if resp_code is None:
+            result["error"] = f"No response code (DE 39) in {mti} response"
+        elif not RESPONSE_CODE.fullmatch(resp_code):
+            result["error"] = f"Invalid response code (DE 39) {resp_code!r} in {mti} response"
+        else:
+            result["response_code"] = resp_code
+            result["response_message"] = VISA_RESPONSE_CODES.get(resp_code, f"UNKNOWN CODE: {resp_code}")
+        if 38 in fields:
+            _set_auth_code(result, fields[38])
+        if 55 in fields:
+            # Tags are indexed only when something looks at them
+            result["emv"] = ChipData(fields[55])
+        return result
+
+    except Exception as e:
+        return {"error": f"Parse error: {e}"}
+
+
+def match_response(result: Dict[str, Any], request_mti: str, request_fields: Dict[int, Any]) -> Dict[str, Any]:
+    """
+    Mark a parsed reply as an error unless it answers this request: the
+    response MTI, with the request's STAN (DE 11) and RRN (DE 37) echoed.
+    A late reply to an earlier message on a reused socket fails the check.
+    """
+    if 'error' in result:
+        return result
+    expected = response_mti(request_mti)
+    if result['mti'] != expected:
+        result["error"] = f"Unexpected reply {result['mti']} to {request_mti} (expected {expected})"
+    else:
+        for num, name in ((11, "STAN"), (37, "RRN")):
+            if num in request_fields and result['fields'].get(num) != request_fields[num]:
+                result["error"] = (f"Reply {name} (DE {num}) {result['fields'].get(num)!r} does not match "
+                                   f"request {request_fields[num]!r}")
+                break
+    if 'error' in result:
+        # Not this request's answer: none of its codes may be used
+        for key in ("response_code", "response_message", "auth_code", "approval_code", "full_auth_code", "emv"):
+            result.pop(key, None)
+    return result
+
+
+def _set_auth_code(result: Dict[str, Any], auth_code: str):
+    result["auth_code"] = auth_code
+    # For online transactions, show only first 4 digits
+    result["approval_code"] = auth_code[:4]  # First 4 digits only
+    result["full_auth_code"] = auth_code
+
+
+def response_mti(request_mti: str) -> str:
+    """Response MTI for a request (0200 -> 0210, 0800 -> 0810)"""
+    return request_mti[:2] + str(int(request_mti[2]) + 1) + request_mti[3]
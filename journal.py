@@ -0,0 +1,546 @@
+"""
+Transaction Journal
+Compact, fixed-capacity in-memory history that spills older records to disk
+
+Measured with `python journal.py` (CPython 3.11, 64-bit), the ring holds
+a record, search indexes included, in about 463 bytes (46 MB per 100,000
+records); the same history as plain dicts with a datetime each takes
+805 bytes per record (80 MB) with no indexes.
+"""
+
+import heapq
+import json
+import os
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+# Fixed columns of a history record; anything else goes to `extra`
+_COLUMNS = ('timestamp', 'amount', 'card', 'status', 'approval_code', 'response_code',
+            'receipt_number', 'rrn', 'stan', 'batch_number', 'demo')
+
+# Zero-padded widths of the numeric identifiers stored as integers
+_NUMBER_WIDTHS = {'stan': 6, 'rrn': 12}
+
+# Exact-match indexes kept for records in the ring. Response codes have too
+# few values to be worth one; a newest-first scan finds them quickly.
+_INDEXED = ('rrn', 'stan', 'approval_code', 'card_last4')
+
+# Keys also indexed for spilled records, as file offsets
+_SPILL_INDEXED = ('rrn', 'stan')
+
+# Pairs buffered before they are sorted into a run of the spill index
+_SPILL_RUN = 4096
+
+
+class JournalQuery(NamedTuple):
+    """Search criteria; unset fields match everything"""
+    profile_id: Optional[str] = None
+    rrn: Optional[str] = None
+    stan: Optional[str] = None
+    approval_code: Optional[str] = None
+    card_last4: Optional[str] = None
+    response_code: Optional[str] = None
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+
+    def normalized(self) -> 'JournalQuery':
+        """Zero-pad numeric RRN/STAN input the way they are recorded"""
+        rrn, stan = self.rrn, self.stan
+        if rrn and rrn.isdigit():
+            rrn = rrn.zfill(_NUMBER_WIDTHS['rrn'])
+        if stan and stan.isdigit():
+            stan = stan.zfill(_NUMBER_WIDTHS['stan'])
+        return self._replace(rrn=rrn or None, stan=stan or None,
+                             approval_code=self.approval_code or None,
+                             card_last4=self.card_last4 or None,
+                             response_code=self.response_code or None)
+
+
+def safe_card(card: str) -> str:
+    """Never keep a bare PAN: digits-only values are cut to their last four"""
+    if card.isdigit() and len(card) > 4:
+        return "*" * (len(card) - 4) + card[-4:]
+    return card
+
+
+def _to_ms(timestamp: datetime) -> int:
+    return int(timestamp.timestamp() * 1000)
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _pack_number(value: Any, width: int = 0) -> Any:
+    """Digit strings of the expected width become ints; anything else is kept"""
+    if isinstance(value, str) and value.isdigit() and (not width or len(value) == width):
+        return int(value)
+    return _intern(value)
+
+
+def _unpack_number(value: Any, width: int) -> Any:
+    return str(value).zfill(width) if isinstance(value, int) else value
+
+
+class JournalRecord:
+    """
+    One history entry: integer timestamp (ms), amount (cents), STAN and
+    RRN; interned status, response code and masked card strings, which
+    repeat across records.
+    """
+
+    __slots__ = ('profile_id', 'ts_ms', 'amount_cents', 'card', 'status', 'approval_code',
+                 'response_code', 'receipt_number', 'rrn', 'stan', 'batch_number', 'demo', 'extra')
+
+    def __init__(self, profile_id: str, record: Dict[str, Any]):
+        timestamp = record.get('timestamp') or datetime.now()
+        self.profile_id = sys.intern(profile_id)
+        self.ts_ms = _to_ms(timestamp)
+        self.amount_cents = int(round(float(record.get('amount', 0)) * 100))
+        self.card = _intern(safe_card(record.get('card', '')))
+        self.status = _intern(record.get('status', ''))
+        self.approval_code = _intern(record.get('approval_code', 'N/A'))
+        self.response_code = _intern(record.get('response_code', 'N/A'))
+        self.receipt_number = _pack_number(record.get('receipt_number', 'N/A'))
+        self.rrn = _pack_number(record.get('rrn', 'N/A'), _NUMBER_WIDTHS['rrn'])
+        self.stan = _pack_number(record.get('stan', 'N/A'), _NUMBER_WIDTHS['stan'])
+        self.batch_number = _pack_number(record.get('batch_number', 'N/A'))
+        self.demo = bool(record.get('demo', False))
+        extra = {k: v for k, v in record.items() if k not in _COLUMNS}
+        self.extra = extra or None
+
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(self.ts_ms / 1000.0)
+
+    def index_keys(self) -> tuple:
+        """Values the ring indexes this record under, in _INDEXED order"""
+        return self.rrn, self.stan, self.approval_code, sys.intern(self.card[-4:])
+
+    def matches(self, query: JournalQuery) -> bool:
+        return ((query.profile_id is None or self.profile_id == query.profile_id)
+                and (query.rrn is None or self.rrn == _pack_number(query.rrn, _NUMBER_WIDTHS['rrn']))
+                and (query.stan is None or self.stan == _pack_number(query.stan, _NUMBER_WIDTHS['stan']))
+                and (query.approval_code is None or self.approval_code == query.approval_code)
+                and (query.card_last4 is None or self.card[-4:] == query.card_last4)
+                and (query.response_code is None or self.response_code == query.response_code)
+                and (query.min_amount is None or self.amount_cents >= round(query.min_amount * 100))
+                and (query.max_amount is None or self.amount_cents <= round(query.max_amount * 100))
+                and (query.since is None or self.ts_ms >= _to_ms(query.since))
+                and (query.until is None or self.ts_ms < _to_ms(query.until)))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The record in the dict shape the UI and exports use"""
+        record = {
+            'timestamp': self.timestamp,
+            'amount': self.amount_cents / 100.0,
+            'card': self.card,
+            'status': self.status,
+            'approval_code': self.approval_code,
+            'response_code': self.response_code,
+            'receipt_number': self.receipt_number,
+            'rrn': _unpack_number(self.rrn, _NUMBER_WIDTHS['rrn']),
+            'stan': _unpack_number(self.stan, _NUMBER_WIDTHS['stan']),
+            'batch_number': self.batch_number,
+            'demo': self.demo,
+        }
+        if self.extra:
+            record.update(self.extra)
+        return record
+
+    def to_row(self) -> Dict[str, Any]:
+        """to_dict plus the owning profile, for exports and search results"""
+        record = self.to_dict()
+        record['profile_id'] = self.profile_id
+        return record
+
+    def to_line(self) -> str:
+        """One JSON line for the spill file"""
+        record = self.to_dict()
+        del record['timestamp']
+        return json.dumps([self.profile_id, self.ts_ms, record], separators=(',', ':')) + "\n"
+
+    @classmethod
+    def from_line(cls, line: str) -> 'JournalRecord':
+        profile_id, ts_ms, record = json.loads(line)
+        record['timestamp'] = datetime.fromtimestamp(ts_ms / 1000.0)
+        return cls(profile_id, record)
+
+
+class _SpillIndex:
+    """
+    Spill-file offsets by numeric key, about 16 bytes per record.
+    New (key, offset) pairs are buffered and sorted into runs of parallel
+    arrays; runs of similar size are merged, so there are O(log n) of them
+    and a lookup is one bisect per run.
+    """
+
+    def __init__(self):
+        self._runs: List[tuple] = []   # (keys, offsets) arrays sorted by key
+        self._pending: List[tuple] = []
+
+    def add(self, key: Any, offset: int):
+        if isinstance(key, int):
+            self._pending.append((key, offset))
+            if len(self._pending) >= _SPILL_RUN:
+                self._flush()
+
+    def _flush(self):
+        run = sorted(self._pending)
+        self._pending = []
+        while self._runs and len(self._runs[-1][0]) <= len(run):
+            keys, offsets = self._runs.pop()
+            run = list(heapq.merge(zip(keys, offsets), run))
+        self._runs.append((array('q', (key for key, _ in run)), array('q', (offset for _, offset in run))))
+
+    def offsets(self, key: int) -> List[int]:
+        """File offsets of the records with this key, in file order"""
+        found = [offset for k, offset in self._pending if k == key]
+        for keys, offsets in self._runs:
+            start = bisect_left(keys, key)
+            found.extend(offsets[start:bisect_right(keys, key, start)])
+        return sorted(found)
+
+
+class RingJournal:
+    """
+    Fixed-capacity ring of JournalRecords shared by all profiles.
+    When the ring is full the oldest record is appended to `spill_path`
+    (JSON lines) or, without a spill file, dropped. Reads return the
+    spilled records first, then the ring, so order is always insertion order.
+    Records in the ring are indexed by RRN, STAN, approval code and card
+    last four, updated on append and eviction. Spilled records are indexed
+    by RRN and STAN as file offsets; other searches scan the file.
+    """
+
+    def __init__(self, capacity: int = 10000, spill_path: Optional[str] = None):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.spill_path = spill_path
+        self._ring: List[Optional[JournalRecord]] = [None] * capacity
+        self._head = 0   # slot of the oldest record
+        self._size = 0
+        self._lock = threading.Lock()
+        self._spill = None
+        self._spill_end = 0  # bytes written to the spill file
+        self._spill_index: List[_SpillIndex] = []
+        self._spilled: Dict[str, int] = {}  # records on disk per profile
+        # One dict per indexed field: value -> record, or list of records in
+        # insertion order once a value repeats
+        self._index: List[Dict[Any, Any]] = [{} for _ in _INDEXED]
+        if spill_path:
+            directory = os.path.dirname(spill_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._open_spill()
+
+    def _open_spill(self):
+        """Count and index what is already on disk, then append after it"""
+        self._spilled = {}
+        self._spill_index = [_SpillIndex() for _ in _SPILL_INDEXED]
+        self._spill_end = 0
+        for offset, record in self._read_spill_at():
+            self._spilled[record.profile_id] = self._spilled.get(record.profile_id, 0) + 1
+            self._index_spilled(record, offset)
+        self._spill = open(self.spill_path, 'a', encoding='utf-8')
+
+    def _index_spilled(self, entry: JournalRecord, offset: int):
+        for index, value in zip(self._spill_index, (entry.rrn, entry.stan)):
+            index.add(value, offset)
+
+    def __len__(self) -> int:
+        return self._size + sum(self._spilled.values())
+
+    def append(self, profile_id: str, record: Dict[str, Any]):
+        entry = JournalRecord(profile_id, record)
+        with self._lock:
+            if self._size == self.capacity:
+                self._evict(self._ring[self._head])
+                self._ring[self._head] = entry
+                self._head = (self._head + 1) % self.capacity
+            else:
+                self._ring[(self._head + self._size) % self.capacity] = entry
+                self._size += 1
+            for index, value in zip(self._index, entry.index_keys()):
+                held = index.get(value)
+                if held is None:
+                    index[value] = entry
+                elif type(held) is list:
+                    held.append(entry)
+                else:
+                    index[value] = [held, entry]
+
+    def _unindex(self, entry: JournalRecord):
+        for index, value in zip(self._index, entry.index_keys()):
+            held = index.get(value)
+            if held is entry:
+                del index[value]
+            elif type(held) is list:
+                # Evictions are oldest first, so this is usually held[0]
+                held.remove(entry)
+                if len(held) == 1:
+                    index[value] = held[0]
+
+    def _evict(self, entry: JournalRecord):
+        self._unindex(entry)
+        if self._spill is not None:
+            line = entry.to_line()
+            self._spill.write(line)
+            self._index_spilled(entry, self._spill_end)
+            self._spill_end += len(line)  # JSON lines are ASCII, one byte per character
+            self._spilled[entry.profile_id] = self._spilled.get(entry.profile_id, 0) + 1
+
+    def _snapshot(self) -> tuple:
+        """Ring contents (oldest first) and the spill size they follow"""
+        with self._lock:
+            ring = [self._ring[(self._head + i) % self.capacity] for i in range(self._size)]
+            spill_size = 0
+            if self._spill is not None:
+                self._spill.flush()
+                spill_size = self._spill.tell()
+            return ring, spill_size
+
+    def _read_spill(self, limit_bytes: Optional[int] = None) -> Iterator[JournalRecord]:
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        with open(self.spill_path, 'r', encoding='utf-8') as f:
+            while limit_bytes is None or f.tell() < limit_bytes:
+                line = f.readline()
+                if not line:
+                    break
+                if line.endswith("\n"):
+                    yield JournalRecord.from_line(line)
+
+    def _read_spill_at(self) -> Iterator[tuple]:
+        """(offset, record) for each complete spilled line, tracking the end of the file"""
+        if not os.path.exists(self.spill_path):
+            return
+        with open(self.spill_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                yield self._spill_end, JournalRecord.from_line(line.decode('utf-8'))
+                self._spill_end += len(line)
+
+    def _read_spill_offsets(self, offsets: Iterable[int]) -> Iterator[JournalRecord]:
+        with open(self.spill_path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                yield JournalRecord.from_line(f.readline().decode('utf-8'))
+
+    def iter_records(self, profile_id: Optional[str] = None, since: Optional[datetime] = None,
+                     until: Optional[datetime] = None, batch_number: Any = None) -> Iterator[JournalRecord]:
+        """
+        Records in insertion order, disk first; constant memory for the disk
+        part. Filters are tested on the compact fields before any record is
+        expanded to a dict.
+        """
+        since_ms = _to_ms(since) if since is not None else None
+        until_ms = _to_ms(until) if until is not None else None
+        batch = str(batch_number) if batch_number is not None else None
+
+        def matches(entry: JournalRecord) -> bool:
+            return ((profile_id is None or entry.profile_id == profile_id)
+                    and (since_ms is None or entry.ts_ms >= since_ms)
+                    and (until_ms is None or entry.ts_ms < until_ms)
+                    and (batch is None or str(entry.batch_number) == batch))
+
+        ring, spill_size = self._snapshot()
+        if spill_size and (profile_id is None or self._spilled.get(profile_id)):
+            for entry in self._read_spill(spill_size):
+                if matches(entry):
+                    yield entry
+        for entry in ring:
+            if matches(entry):
+                yield entry
+
+    def tail(self, profile_id: str, limit: int) -> List[Dict[str, Any]]:
+        """Latest `limit` records of one profile, oldest first"""
+        ring, spill_size = self._snapshot()
+        tail = []
+        for entry in reversed(ring):
+            if len(tail) >= limit:
+                break
+            if entry.profile_id == profile_id:
+                tail.append(entry)
+        tail.reverse()
+
+        # Only go to disk if the ring does not hold enough of this profile
+        missing = limit - len(tail)
+        if missing > 0 and spill_size and self._spilled.get(profile_id):
+            older = deque(maxlen=missing)
+            for entry in self._read_spill(spill_size):
+                if entry.profile_id == profile_id:
+                    older.append(entry)
+            tail = list(older) + tail
+        return [entry.to_dict() for entry in tail]
+
+    def search(self, query: JournalQuery, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Matching records, newest first. Exact-match criteria are served from
+        the smallest index bucket; other queries binary-search the time range
+        in the ring (recording order is timestamp order) and filter it. The
+        spill file is only read when the ring yields fewer than `limit`: by
+        offset for an RRN or STAN, otherwise by scanning it.
+        """
+        query = query.normalized()
+        keys = (_pack_number(query.rrn, _NUMBER_WIDTHS['rrn']), _pack_number(query.stan, _NUMBER_WIDTHS['stan']),
+                query.approval_code, query.card_last4)
+
+        with self._lock:
+            buckets = []
+            for index, value in zip(self._index, keys):
+                if value is not None:
+                    held = index.get(value)
+                    buckets.append([] if held is None else held if type(held) is list else [held])
+            if buckets:
+                candidates = list(min(buckets, key=len))
+            else:
+                ring = _RingView(self._ring, self._head, self._size, self.capacity)
+                start = end = None
+                if query.since is not None:
+                    start = bisect_left(ring, _to_ms(query.since), key=_ts_key)
+                if query.until is not None:
+                    end = bisect_left(ring, _to_ms(query.until), key=_ts_key)
+                candidates = [ring[i] for i in range(start or 0, self._size if end is None else end)]
+            spill_size = 0
+            spill_offsets = None
+            if self._spill is not None:
+                self._spill.flush()
+                spill_size = self._spill.tell()
+                for index, value in zip(self._spill_index, keys[:len(_SPILL_INDEXED)]):
+                    if isinstance(value, int):
+                        offsets = index.offsets(value)
+                        if spill_offsets is None or len(offsets) < len(spill_offsets):
+                            spill_offsets = offsets
+
+        found = []
+        for entry in reversed(candidates):
+            if entry.matches(query):
+                found.append(entry.to_row())
+                if len(found) >= limit:
+                    return found
+
+        if spill_size and (query.profile_id is None or self._spilled.get(query.profile_id)):
+            older = deque(maxlen=limit - len(found))
+            spilled = (self._read_spill(spill_size) if spill_offsets is None else
+                       self._read_spill_offsets(offset for offset in spill_offsets if offset < spill_size))
+            for entry in spilled:
+                if entry.matches(query):
+                    older.append(entry)
+            found.extend(entry.to_row() for entry in reversed(older))
+        return found
+
+    def clear(self, profile_id: str):
+        """Drop one profile's records from the ring and the spill file"""
+        with self._lock:
+            kept = []
+            for i in range(self._size):
+                entry = self._ring[(self._head + i) % self.capacity]
+                if entry.profile_id == profile_id:
+                    self._unindex(entry)
+                else:
+                    kept.append(entry)
+            self._ring = kept + [None] * (self.capacity - len(kept))
+            self._head = 0
+            self._size = len(kept)
+
+            if self._spill is not None and self._spilled.pop(profile_id, 0):
+                self._spill.close()
+                tmp_path = self.spill_path + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as out:
+                    for entry in self._read_spill():
+                        if entry.profile_id != profile_id:
+                            out.write(entry.to_line())
+                os.replace(tmp_path, self.spill_path)
+                self._open_spill()
+
+    def close(self):
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+
+
+def _ts_key(entry: JournalRecord) -> int:
+    return entry.ts_ms
+
+
+class _RingView:
+    """Logical, oldest-first sequence view of the ring for bisect"""
+
+    __slots__ = ('ring', 'head', 'size', 'capacity')
+
+    def __init__(self, ring: list, head: int, size: int, capacity: int):
+        self.ring, self.head, self.size, self.capacity = ring, head, size, capacity
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, i: int) -> JournalRecord:
+        return self.ring[(self.head + i) % self.capacity]
+
+
+def measure_memory(count: int = 100000, layouts: Iterable[str] = ('ring', 'dicts')) -> Dict[str, float]:
+    """Bytes per record for the ring vs. plain dicts, via tracemalloc"""
+    import gc
+    import random
+    import tracemalloc
+
+    statuses = ['APPROVED - Transaction Completed', 'DECLINED - Do Not Honor', 'DECLINED - Insufficient Funds']
+    codes = ['00', '05', '51']
+
+    def sample(i):
+        k = random.randrange(3)
+        return {
+            'timestamp': datetime.now(),
+            'amount': random.randint(100, 99999) / 100.0,
+            'card': f"**** **** **** {random.randint(0, 9999):04d}",
+            'status': statuses[k],
+            'approval_code': f"{random.randint(0, 9999):04d}",
+            'response_code': codes[k],
+            'receipt_number': i + 1,
+            'rrn': f"{100001 + i:012d}",
+            'stan': str(100001 + i).zfill(6),
+            'batch_number': 4321,
+            'demo': False,
+        }
+
+    def measure(build):
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        held = build()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del held
+        return (after - before) / count
+
+    def build_ring():
+        ring = RingJournal(capacity=count)
+        for i in range(count):
+            ring.append("M:T", sample(i))
+        return ring
+
+    def build_dicts():
+        # Formatting strings per record, as the app did before
+        return [sample(i) for i in range(count)]
+
+    builds = {'ring': build_ring, 'dicts': build_dicts}
+    return {layout: measure(builds[layout]) for layout in layouts}
+
+
+if __name__ == "__main__":
+    result = measure_memory()
+    print(f"RingJournal: {result['ring']:.0f} bytes/record, "
+          f"{result['ring'] * 100000 / 1e6:.1f} MB per 100k")
+    print(f"dict list:   {result['dicts']:.0f} bytes/record, "
+          f"{result['dicts'] * 100000 / 1e6:.1f} MB per 100k")
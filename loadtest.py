@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Load Test
+Open-loop load against the authorization pipeline with latency histograms
+corrected for coordinated omission, and a sweep that finds saturation
+
+    python loadtest.py --standin --standin-latency-ms 80 --rate 50 --duration 30
+    python loadtest.py --host 10.0.0.5 --port 9090 --sweep 10:200:10 --slo-p99 2.0
+    python loadtest.py --api http://127.0.0.1:8081 --sweep 50:500:50
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+from authorizer import DEFAULT_AUTHORIZATION_BUDGET, HostClient, authorize_sale
+from connections import ConnectionPool, LatencyTracker, SSLContextCache
+from iso8583 import DIALECTS
+from profiles import TerminalProfile
+from state_backend import MemoryStateBackend
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of microsecond values in the HdrHistogram layout:
+    exact below 2**sub_bucket_bits, then each power of two split into
+    2**(sub_bucket_bits - 1) linear buckets, so every recorded value is kept
+    within 2**-(sub_bucket_bits - 1) relative error (0.8% by default) in
+    constant memory however many samples are recorded.
+    """
+
+    def __init__(self, sub_bucket_bits: int = 8):
+        self.bits = sub_bucket_bits
+        self.sub_count = 1 << sub_bucket_bits
+        self.half = self.sub_count >> 1
+        self.counts: List[int] = [0] * self.sub_count
+        self.total = 0
+        self.max_value = 0
+
+    def _index(self, value: int) -> int:
+        if value < self.sub_count:
+            return value
+        shift = value.bit_length() - self.bits
+        return self.sub_count + (shift - 1) * self.half + ((value >> shift) - self.half)
+
+    def _highest_equivalent(self, index: int) -> int:
+        if index < self.sub_count:
+            return index
+        shift = (index - self.sub_count) // self.half + 1
+        mantissa = (index - self.sub_count) % self.half + self.half
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds: float):
+        value = max(0, int(seconds * 1e6))
+        index = self._index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.total += 1
+        self.max_value = max(self.max_value, value)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Value in seconds at or below which `pct` percent of samples fall"""
+        if not self.total:
+            return None
+        rank = max(1, int(pct / 100.0 * self.total + 0.999999))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._highest_equivalent(index), self.max_value) / 1e6
+        return self.max_value / 1e6
+
+
+class StepResult(NamedTuple):
+    offered: float        # requests per second scheduled
+    achieved: float       # completions per second
+    sent: int
+    outcomes: Counter     # response code or error kind -> count
+    response: LatencyHistogram   # from scheduled start (corrected)
+    service: LatencyHistogram    # from actual start (what a closed loop would see)
+    backlog_max: int      # most requests waiting for a worker at once
+
+
+def arrival_times(rate: float, duration: float, schedule: str) -> Iterator[float]:
+    """Offsets (seconds) at which requests are due, independent of responses"""
+    if rate <= 0:
+        return
+    t = 0.0
+    while True:
+        t += random.expovariate(rate) if schedule == 'poisson' else 1.0 / rate
+        if t >= duration:
+            return
+        yield t
+
+
+def outcome_of(result: Dict) -> str:
+    """Bucket for the error mix: response code, or the kind of failure"""
+    if 'error' not in result:
+        return result.get('response_code', '??')
+    error = result['error'].lower()
+    if not result.get('connected', True):
+        return "connect failed"
+    if "timeout" in error or "deadline" in error:
+        return "timeout"
+    return "error"
+
+
+def random_sale() -> Dict:
+    """Sale parameters with a random card and amount"""
+    return {
+        'pan': "4" + "".join(random.choice("0123456789") for _ in range(15)),
+        'amount': random.randint(100, 20000) / 100.0,
+        'expiry': "1228",  # MMYY
+        'approval_code': f"{random.randint(0, 9999):04d}",
+        'merchant_name': "LOAD TEST",
+    }
+
+
+def api_sale(url: str, api_key: Optional[str] = None) -> Callable[[], Dict]:
+    """One POST /v1/authorize per call, on a keep-alive connection per worker thread"""
+    parts = urlsplit(url)
+    local = threading.local()
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+
+    def sale() -> Dict:
+        body = json.dumps(random_sale())
+        for attempt in (1, 2):  # a stale keep-alive connection is reopened once
+            conn = getattr(local, 'conn', None)
+            if conn is None:
+                conn = local.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+            try:
+                conn.request("POST", "/v1/authorize", body, headers)
+                response = conn.getresponse()
+                result = json.loads(response.read())
+                if response.status >= 400 and 'error' not in result:
+                    result['error'] = f"HTTP {response.status}: {result.get('errors')}"
+                return result
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                local.conn = None
+                if attempt == 2:
+                    return {"error": f"API request failed: {e}", "connected": False}
+        return {}
+
+    return sale
+
+
+def run_step(client: HostClient, profile: TerminalProfile, server_configs: Dict[str, Dict],
+             rate: float, duration: float, schedule: str = 'constant',
+             budget: float = DEFAULT_AUTHORIZATION_BUDGET, max_workers: int = 256,
+             sale: Optional[Callable[[], Dict]] = None) -> StepResult:
+    """
+    Offer `rate` authorizations per second for `duration` seconds.
+    Requests are dispatched by the clock; a request's latency counts from
+    when it was due, so time spent queued behind a slow host is included
+    instead of silently omitted. `sale` replaces the in-process pipeline,
+    e.g. with api_sale() to measure the HTTP API.
+    """
+    response = LatencyHistogram()
+    service = LatencyHistogram()
+    outcomes: Counter = Counter()
+    lock = threading.Lock()
+    state = {'waiting': 0, 'backlog_max': 0}
+
+    def run(due: float):
+        started = time.monotonic()
+        with lock:
+            state['waiting'] -= 1
+        if sale is not None:
+            result = sale()
+        else:
+            result = authorize_sale(client, profile, server_configs, 'primary', budget=budget, **random_sale())
+        finished = time.monotonic()
+        with lock:
+            response.record(finished - due)
+            service.record(finished - started)
+            outcomes[outcome_of(result)] += 1
+
+    sent = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for offset in arrival_times(rate, duration, schedule):
+            due = start + offset
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with lock:
+                state['waiting'] += 1
+                state['backlog_max'] = max(state['backlog_max'], state['waiting'])
+            pool.submit(run, due)
+            sent += 1
+    elapsed = time.monotonic() - start
+
+    return StepResult(rate, response.total / elapsed if elapsed > 0 else 0.0, sent,
+                      outcomes, response, service, state['backlog_max'])
+
+
+def sweep(client: HostClient, profile: TerminalProfile, server_configs: Dict[str, Dict],
+          rates: List[float], duration: float, schedule: str, slo_p99: float,
+          budget: float = DEFAULT_AUTHORIZATION_BUDGET, max_workers: int = 256,
+          on_step=None, sale: Optional[Callable[[], Dict]] = None) -> List[StepResult]:
+    """
+    Step through offered rates until the terminal saturates: achieved
+    throughput falls below 95% of offered, or corrected p99 breaks the SLO.
+    """
+    results = []
+    for rate in rates:
+        step = run_step(client, profile, server_configs, rate, duration, schedule, budget, max_workers, sale)
+        results.append(step)
+        if on_step:
+            on_step(step)
+        if saturated(step, slo_p99):
+            break
+    return results
+
+
+def saturated(step: StepResult, slo_p99: float) -> bool:
+    p99 = step.response.percentile(99)
+    return step.achieved < 0.95 * step.offered or (p99 is not None and p99 > slo_p99)
+
+
+def format_step(step: StepResult) -> str:
+    """Full report for one offered rate"""
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.1f} ms"
+
+    lines = [
+        f"Offered {step.offered:g} TPS: {step.sent} sent, {step.response.total} completed, "
+        f"{step.achieved:.1f} TPS achieved, worker backlog peak {step.backlog_max}",
+        "Outcomes: " + ", ".join(f"{name} x{count}" for name, count in step.outcomes.most_common()),
+        f"{'':10}{'response':>14}{'service':>14}",
+    ]
+    for label, pct in (("p50", 50), ("p90", 90), ("p99", 99), ("p99.9", 99.9), ("p99.99", 99.99), ("max", 100)):
+        lines.append(f"{label:10}{ms(step.response.percentile(pct)):>14}{ms(step.service.percentile(pct)):>14}")
+    lines.append("(response counts from the scheduled send time; service from when a worker started it)")
+    return "\n".join(lines)
+
+
+def format_sweep(results: List[StepResult], slo_p99: float) -> str:
+    """One line per offered rate, then the saturation point"""
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}"
+
+    lines = [f"{'offered':>8}{'achieved':>10}{'p50 ms':>9}{'p99 ms':>9}{'p99.9 ms':>10}{'errors':>8}"]
+    for step in results:
+        errors = sum(count for name, count in step.outcomes.items() if name != '00')
+        lines.append(f"{step.offered:>8g}{step.achieved:>10.1f}{ms(step.response.percentile(50)):>9}"
+                     f"{ms(step.response.percentile(99)):>9}{ms(step.response.percentile(99.9)):>10}{errors:>8}")
+
+    sustainable = [step for step in results if not saturated(step, slo_p99)]
+    if sustainable:
+        best = sustainable[-1]
+        lines.append(f"Sustains {best.achieved:.1f} TPS at p99 {best.response.percentile(99) * 1000:.0f} ms "
+                     f"(SLO {slo_p99 * 1000:.0f} ms)")
+    else:
+        lines.append(f"No tested rate met the p99 SLO of {slo_p99 * 1000:.0f} ms")
+    if results and saturated(results[-1], slo_p99):
+        lines.append(f"Saturated at {results[-1].offered:g} TPS offered")
+    return "\n".join(lines)
+
+
+def parse_sweep(spec: str) -> List[float]:
+    """start:stop:step -> offered rates"""
+    start, stop, step = (float(part) for part in spec.split(":"))
+    rates = []
+    rate = start
+    while rate <= stop + 1e-9:
+        rates.append(rate)
+        rate += step
+    return rates
+
+
+def start_local_api(client: HostClient, server_configs: Dict[str, Dict], budget: float) -> str:
+    """Serve the HTTP API in-process over a throwaway backend; returns its URL"""
+    from api import APIServer, TerminalAPI
+    from idempotency import SubmissionCache
+    from profiles import ProfileRegistry
+
+    registry = ProfileRegistry(MemoryStateBackend(journal_capacity=1000))
+    registry.config.set('authorization_budget', budget)
+    registry.config.set('idempotency_window', 0)
+    api = TerminalAPI(registry, client, SubmissionCache(), lambda: server_configs, "LOADTEST:LT000001")
+    server = APIServer(("127.0.0.1", 0), api, workers=64)
+    threading.Thread(target=server.serve_forever, name="api", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open-loop load test of the authorization pipeline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--protocol", choices=["HTTP", "HTTPS"], default="HTTP")
+    parser.add_argument("--dialect", choices=sorted(DIALECTS), default="ascii")
+    parser.add_argument("--keep-alive", action="store_true", help="Pool connections to the host")
+    parser.add_argument("--cert", default="./certs/cad.crt", help="Client certificate for HTTPS")
+    parser.add_argument("--key", default="./certs/client.key", help="Client key for HTTPS")
+    parser.add_argument("--standin", action="store_true", help="Start a local stand-in host and target it")
+    parser.add_argument("--api", help="Drive the HTTP API at this URL instead of the pipeline "
+                                      "(with --standin, an in-process API in front of the stand-in)")
+    parser.add_argument("--standin-latency-ms", type=float, default=50.0)
+    parser.add_argument("--standin-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--rate", type=float, default=20.0, help="Offered authorizations per second")
+    parser.add_argument("--sweep", help="Offered rates start:stop:step; stops at saturation")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per rate")
+    parser.add_argument("--schedule", choices=["constant", "poisson"], default="poisson")
+    parser.add_argument("--slo-p99", type=float, default=2.0, help="p99 latency target in seconds")
+    parser.add_argument("--budget", type=float, default=DEFAULT_AUTHORIZATION_BUDGET)
+    parser.add_argument("--workers", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.standin:
+        from standin_host import StandInHost
+        server = StandInHost(("127.0.0.1", 0), args.standin_latency_ms, args.standin_jitter_ms)
+        threading.Thread(target=server.serve_forever, name="standin", daemon=True).start()
+        args.host, args.port, args.protocol = "127.0.0.1", server.server_address[1], "HTTP"
+
+    server_configs = {
+        'primary': {
+            'host': args.host,
+            'port': args.port,
+            'protocol': args.protocol,
+            'keep_alive': args.keep_alive,
+            'dialect': args.dialect,
+        }
+    }
+    client = HostClient(SSLContextCache(), ConnectionPool(max_idle_per_server=args.workers),
+                        LatencyTracker(), args.cert, args.key)
+    profile = TerminalProfile("LOADTEST", "LT000001", MemoryStateBackend(journal_capacity=1))
+
+    sale = None
+    if args.api:
+        if args.standin:
+            args.api = start_local_api(client, server_configs, args.budget)
+        sale = api_sale(args.api, os.environ.get('TERMINAL_API_KEY'))
+        print(f"Target API {args.api}, {args.schedule} arrivals")
+    else:
+        print(f"Target {args.protocol}://{args.host}:{args.port} ({args.dialect}, "
+              f"{'keep-alive' if args.keep_alive else 'connection per sale'}), {args.schedule} arrivals")
+    if args.sweep:
+        results = sweep(client, profile, server_configs, parse_sweep(args.sweep), args.duration,
+                        args.schedule, args.slo_p99, args.budget, args.workers,
+                        on_step=lambda step: print(format_step(step) + "\n"), sale=sale)
+        print(format_sweep(results, args.slo_p99))
+    else:
+        print(format_step(run_step(client, profile, server_configs, args.rate, args.duration,
+                                   args.schedule, args.budget, args.workers, sale)))
+
+
+if __name__ == "__main__":
+    main()
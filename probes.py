@@ -0,0 +1,151 @@
+"""
+Host Health Probes
+Concurrent connect/handshake/echo probes of every configured endpoint,
+on a schedule and on demand, with recent per-phase latency
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional
+
+from authorizer import HostClient
+from connections import Deadline
+
+# Phases a probe times, in the order they happen
+PROBE_PHASES = ('resolve', 'connect', 'handshake', 'echo')
+
+# Seconds one probe may take for connection setup, and again for the echo
+DEFAULT_PROBE_TIMEOUT = 5.0
+
+
+class ProbeResult(NamedTuple):
+    at: float                 # wall-clock time the probe finished
+    ok: bool
+    phases: Dict[str, float]  # phase -> seconds, for the phases reached
+    error: str = ""
+
+
+def parse_endpoints(text: str) -> List[Dict]:
+    """
+    Extra probe endpoints, one per line as [https://]host:port; returns
+    server-config dicts named by their address. Blank lines are skipped.
+    """
+    endpoints = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        protocol = "HTTP"
+        for scheme in ("https://", "http://"):
+            if line.lower().startswith(scheme):
+                protocol = scheme[:-3].upper()
+                line = line[len(scheme):]
+        host, _, port = line.rpartition(":")
+        if not host or not port.isdigit() or not 0 < int(port) < 65536:
+            raise ValueError(f"Expected host:port, got {line!r}")
+        endpoints.append({'name': f"{host}:{port}", 'host': host, 'port': int(port), 'protocol': protocol})
+    return endpoints
+
+
+class HealthProber:
+    """
+    Probes every endpoint in parallel: resolve, TCP connect, TLS handshake
+    (HTTPS) and, when `echo` is given and the endpoint speaks ISO-8583, an
+    0800 round trip. Each endpoint has at most one probe in flight; asking
+    again while it runs joins that probe. The last `history` results per
+    endpoint are kept for the dashboard.
+    """
+
+    def __init__(self, client: HostClient, endpoints: Callable[[], Dict[str, Dict]],
+                 interval: Callable[[], float], echo: Optional[Callable] = None,
+                 timeout: float = DEFAULT_PROBE_TIMEOUT, history: int = 60, max_workers: int = 8):
+        self.client = client
+        self.endpoints = endpoints
+        self.interval = interval
+        self.echo = echo
+        self.timeout = timeout
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="probe")
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self._results: Dict[str, Deque[ProbeResult]] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="prober", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            interval = self.interval()
+            if interval > 0:
+                try:
+                    self.probe_all()
+                except Exception:
+                    pass  # never let one bad round kill the thread
+            self._stop.wait(interval if interval > 0 else 5.0)
+
+    def probe_all(self) -> Dict[str, ProbeResult]:
+        """Probe every endpoint at once and wait for all of them"""
+        futures = {name: self.submit(name, server_config) for name, server_config in self.endpoints().items()}
+        wait(futures.values())
+        return {name: future.result() for name, future in futures.items()}
+
+    def submit(self, name: str, server_config: Dict) -> Future:
+        """Start a probe of one endpoint, or join the one already running"""
+        with self._lock:
+            future = self._in_flight.get(name)
+            if future is None:
+                future = self._in_flight[name] = self._executor.submit(self._probe, name, server_config)
+            return future
+
+    def _probe(self, name: str, server_config: Dict) -> ProbeResult:
+        try:
+            result = self.probe(server_config)
+        except Exception as e:
+            result = ProbeResult(time.time(), False, {}, str(e) or type(e).__name__)
+        with self._lock:
+            self._in_flight.pop(name, None)
+            self._results.setdefault(name, deque(maxlen=self.history)).append(result)
+        return result
+
+    def probe(self, server_config: Dict) -> ProbeResult:
+        """Time connection setup and an optional echo on a fresh connection"""
+        timings: Dict[str, float] = {}
+        try:
+            conn, _ = self.client.connect(server_config, Deadline(self.timeout), pooled=False, timings=timings)
+        except Exception as e:
+            return ProbeResult(time.time(), False, timings, str(e) or type(e).__name__)
+
+        ok, error = True, ""
+        if self.echo is not None and server_config.get('echo', True):
+            start = time.perf_counter()
+            ok = self.echo(conn, server_config, self.timeout)
+            timings['echo'] = time.perf_counter() - start
+            error = "" if ok else "No 0810 to echo test"
+        # A verified connection to a keep-alive server warms its pool
+        self.client.release(server_config, conn, reusable=ok and self.echo is not None)
+        return ProbeResult(time.time(), ok, timings, error)
+
+    def latest(self) -> Dict[str, ProbeResult]:
+        with self._lock:
+            return {name: results[-1] for name, results in self._results.items() if results}
+
+    def recent(self, name: str) -> List[ProbeResult]:
+        with self._lock:
+            return list(self._results.get(name, ()))
+
+    def forget(self, keep: List[str]):
+        """Drop history of endpoints no longer configured"""
+        with self._lock:
+            for name in list(self._results):
+                if name not in keep:
+                    del self._results[name]
@@ -0,0 +1,132 @@
+"""
+Terminal Profiles
+Many merchant/terminal lanes hosted in one process
+"""
+
+import random
+import threading
+from typing import Any, Dict, List, Optional
+
+from state_backend import CounterBlock, ConfigCache, MemoryStateBackend, StateBackend
+
+PROFILE_CONFIG_PREFIX = "profile:"
+
+
+class TerminalProfile:
+    """
+    One terminal lane: identity, sequence counters, batch and history.
+    Kept small (slots, no per-profile sockets) so each extra lane costs
+    kilobytes rather than a whole process. Counters and history live in the
+    state backend so replicas sharing it stay consistent.
+    """
+
+    __slots__ = ('merchant_id', 'terminal_id', 'batch_number', 'backend', '_stan', '_receipt')
+
+    def __init__(self, merchant_id: str, terminal_id: str, backend: StateBackend):
+        self.merchant_id = merchant_id
+        self.terminal_id = terminal_id
+        self.backend = backend
+        pid = self.profile_id
+        self.batch_number = backend.setdefault_config(f"batch:{pid}", random.randint(1000, 9999))
+        self._stan = CounterBlock(backend, f"stan:{pid}", start=100001)
+        self._receipt = CounterBlock(backend, f"receipt:{pid}", start=1)
+
+    @property
+    def profile_id(self) -> str:
+        """Registry key for this lane"""
+        return profile_key(self.merchant_id, self.terminal_id)
+
+    @property
+    def stan_counter(self) -> int:
+        """Next STAN this replica would issue"""
+        return self._stan.peek()
+
+    @property
+    def receipt_counter(self) -> int:
+        """Next receipt number this replica would issue"""
+        return self._receipt.peek()
+
+    def next_sequence(self) -> Dict[str, Any]:
+        """Reserve STAN, RRN and receipt number for one transaction"""
+        stan_value = self._stan.next()
+        return {
+            'stan': str(stan_value).zfill(6),
+            'rrn': f"{stan_value:012d}",  # 12-digit RRN
+            'receipt_number': self._receipt.next(),
+            'batch_number': self.batch_number
+        }
+
+    def record_transaction(self, transaction_record: Dict[str, Any]):
+        """Append a transaction to this lane's journal"""
+        self.backend.append_journal(self.profile_id, transaction_record)
+
+    def recent_transactions(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """Latest transactions, oldest first"""
+        return self.backend.journal_tail(self.profile_id, limit)
+
+    def clear_history(self):
+        """Drop this lane's history"""
+        self.backend.clear_journal(self.profile_id)
+
+
+def profile_key(merchant_id: str, terminal_id: str) -> str:
+    """Key a profile by merchant and terminal ID"""
+    return f"{merchant_id}:{terminal_id}"
+
+
+class ProfileRegistry:
+    """
+    Set of terminal profiles shared by all sessions in the process.
+    Each lane is registered under its own backend config key, so a terminal
+    added on one replica shows up on the others.
+    """
+
+    def __init__(self, backend: Optional[StateBackend] = None):
+        self.backend = backend if backend is not None else MemoryStateBackend()
+        self.config = ConfigCache(self.backend)
+        self._profiles: Dict[str, TerminalProfile] = {}
+        self._lock = threading.Lock()
+
+    def _known_ids(self) -> List[str]:
+        prefix = len(PROFILE_CONFIG_PREFIX)
+        return [key[prefix:] for key in self.config.keys() if key.startswith(PROFILE_CONFIG_PREFIX)]
+
+    def get(self, profile_id: str) -> Optional[TerminalProfile]:
+        """Look up a profile by key"""
+        if profile_id not in self._known_ids():
+            return None
+        profile = self._profiles.get(profile_id)
+        if profile is None:
+            merchant_id, terminal_id = profile_id.split(":", 1)
+            profile = self._load(merchant_id, terminal_id)
+        return profile
+
+    def _load(self, merchant_id: str, terminal_id: str) -> TerminalProfile:
+        key = profile_key(merchant_id, terminal_id)
+        with self._lock:
+            profile = self._profiles.get(key)
+            if profile is None:
+                profile = TerminalProfile(merchant_id, terminal_id, self.backend)
+                self._profiles[key] = profile
+        return profile
+
+    def get_or_create(self, merchant_id: str, terminal_id: str) -> TerminalProfile:
+        """Return the profile for these IDs, creating it on first use"""
+        key = profile_key(merchant_id, terminal_id)
+        profile = self._profiles.get(key) or self._load(merchant_id, terminal_id)
+        if key not in self._known_ids():
+            self.config.set(PROFILE_CONFIG_PREFIX + key, [merchant_id, terminal_id])
+        return profile
+
+    def remove(self, profile_id: str) -> bool:
+        """Remove a profile; returns False if it did not exist"""
+        with self._lock:
+            self._profiles.pop(profile_id, None)
+        return self.config.delete(PROFILE_CONFIG_PREFIX + profile_id)
+
+    def profile_ids(self) -> List[str]:
+        """All profile keys, sorted for stable display"""
+        return sorted(self._known_ids())
+
+    def __len__(self) -> int:
+        return len(self.profile_ids())
@@ -0,0 +1,200 @@
+"""
+Receipt Cache
+Receipts rendered once per sale (text and fields) and kept in a bounded
+LRU by receipt number and RRN, with copies on disk for older ones
+"""
+
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+Fields = List[Tuple[str, str]]
+
+# Receipts held in memory; older ones are read back from disk
+DEFAULT_RECEIPT_CAPACITY = 256
+
+
+class Receipt(NamedTuple):
+    profile_id: str
+    receipt_number: str
+    rrn: str
+    approved: bool
+    issued: str                          # sale time as printed
+    sections: List[Tuple[str, Fields]]   # (title, [(label, value), ...])
+    text: str                            # plain-text copy for download and print
+
+
+def render_receipt(profile_id: str, terminal_id: str, merchant_id: str, merchant_name: str,
+                   amount: float, card: str, expiry: str, result: Dict[str, Any], issued: datetime) -> Receipt:
+    """Lay out a receipt; `card` and `expiry` must already be formatted for printing"""
+    stamp = issued.strftime('%Y-%m-%d %H:%M:%S')
+    receipt_number = str(result.get('receipt_number', 'N/A'))
+    batch_number = str(result.get('batch_number', 'N/A'))
+    rrn = result.get('rrn', 'N/A')
+    stan = result.get('stan', 'N/A')
+    status = result.get('response_message', 'Unknown')
+    approval_code = result.get('approval_code', 'N/A')
+    response_code = result.get('response_code', 'N/A')
+    auth_code = result.get('full_auth_code', 'N/A')
+
+    sections = [
+        ("Merchant Information", [
+            ("Merchant Name", merchant_name),
+            ("Terminal ID", terminal_id),
+            ("Merchant ID", merchant_id),
+            ("Transaction Type", "Online Authorization"),
+        ]),
+        ("Transaction Details", [
+            ("Receipt Number", receipt_number),
+            ("Batch Number", batch_number),
+            ("Amount", f"${amount:.2f}"),
+            ("RRN", rrn),
+            ("STAN", stan),
+            ("Date/Time", stamp),
+        ]),
+        ("Card Information", [
+            ("Card Number", card),
+            ("Expiry Date", expiry),
+        ]),
+        ("Authorization Details", [
+            ("Status", status),
+            ("Approval Code", approval_code),
+            ("Response Code", response_code),
+            ("Auth Code", auth_code),
+        ]),
+    ]
+
+    text = f"""
+{'=' * 50}
+         PAYMENT RECEIPT
+        ISO-8583 Base I Terminal
+{'=' * 50}
+
+MERCHANT INFORMATION:
+{'-' * 50}
+Merchant: {merchant_name}
+Terminal ID: {terminal_id}
+Merchant ID: {merchant_id}
+Transaction: Online Authorization (Protocol 101.1)
+
+TRANSACTION DETAILS:
+{'-' * 50}
+Receipt Number: {receipt_number}
+Batch Number: {batch_number}
+RRN: {rrn}
+STAN: {stan}
+Card: {card}
+Expiry: {expiry}
+Amount: ${amount:.2f}
+Date: {stamp}
+
+AUTHORIZATION INFORMATION:
+{'-' * 50}
+Status: {status}
+Approval Code: {approval_code}
+Auth Code: {auth_code}
+Response Code: {response_code}
+
+{'-' * 50}
+      THANK YOU FOR YOUR BUSINESS
+{'=' * 50}
+"""
+    return Receipt(profile_id, receipt_number, rrn, response_code == '00', stamp, sections, text)
+
+
+class ReceiptCache:
+    """
+    Rendered receipts by (profile, receipt number), with an RRN index.
+    The newest `capacity` stay in memory. With a `directory`, every receipt
+    is also written there on put (under its number, hard-linked under its
+    RRN) so older ones and those from before a restart are one file read
+    away.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_RECEIPT_CAPACITY, directory: Optional[str] = None):
+        self.capacity = capacity
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._receipts: "OrderedDict[Tuple[str, str], Receipt]" = OrderedDict()
+        self._by_rrn: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        self.hits = 0
+        self.disk_reads = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, profile_id: str, name: str) -> str:
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', f"{profile_id}-{name}") + ".json")
+
+    def put(self, receipt: Receipt) -> Receipt:
+        key = (receipt.profile_id, receipt.receipt_number)
+        with self._lock:
+            self._remember(key, receipt)
+        if self.directory:
+            path = self._path(receipt.profile_id, f"receipt-{receipt.receipt_number}")
+            tmp = path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(receipt._asdict(), f)
+            os.replace(tmp, path)
+            rrn_path = self._path(receipt.profile_id, f"rrn-{receipt.rrn}")
+            try:
+                if os.path.exists(rrn_path):
+                    os.remove(rrn_path)
+                os.link(path, rrn_path)
+            except OSError:
+                with open(rrn_path, 'w', encoding='utf-8') as f:
+                    json.dump(receipt._asdict(), f)
+        return receipt
+
+    def _remember(self, key: Tuple[str, str], receipt: Receipt):
+        self._receipts[key] = receipt
+        self._receipts.move_to_end(key)
+        self._by_rrn[(receipt.profile_id, receipt.rrn)] = key
+        while len(self._receipts) > self.capacity:
+            _, evicted = self._receipts.popitem(last=False)
+            rrn_key = (evicted.profile_id, evicted.rrn)
+            if self._by_rrn.get(rrn_key) == (evicted.profile_id, evicted.receipt_number):
+                del self._by_rrn[rrn_key]
+
+    def get(self, profile_id: str, receipt_number: Any = None, rrn: Optional[str] = None) -> Optional[Receipt]:
+        """Receipt by number or, failing that, RRN; None if it was never rendered"""
+        with self._lock:
+            key = (profile_id, str(receipt_number)) if receipt_number is not None else None
+            if key not in self._receipts and rrn is not None:
+                key = self._by_rrn.get((profile_id, rrn), key)
+            receipt = self._receipts.get(key) if key else None
+            if receipt is not None:
+                self._receipts.move_to_end(key)
+                self.hits += 1
+                return receipt
+
+        receipt = self._load(profile_id, receipt_number, rrn)
+        with self._lock:
+            if receipt is None:
+                self.misses += 1
+                return None
+            self.disk_reads += 1
+            self._remember((receipt.profile_id, receipt.receipt_number), receipt)
+        return receipt
+
+    def _load(self, profile_id: str, receipt_number: Any, rrn: Optional[str]) -> Optional[Receipt]:
+        if not self.directory:
+            return None
+        names = ([f"receipt-{receipt_number}"] if receipt_number is not None else []) + \
+                ([f"rrn-{rrn}"] if rrn is not None else [])
+        for name in names:
+            try:
+                with open(self._path(profile_id, name), 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            data['sections'] = [(title, [tuple(field) for field in fields]) for title, fields in data['sections']]
+            return Receipt(**data)
+        return None
+
+    def __len__(self) -> int:
+        return len(self._receipts)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Capture Replay
+Drive a captured session against a host at original pacing or N× faster,
+then compare latency and response codes with what was captured
+
+    python replay.py captures/host.cap --host 127.0.0.1 --port 9090 --speed 4
+"""
+
+import argparse
+import math
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from capture import ERROR, REQUEST, RESPONSE, capture_files, read_capture
+from connections import recv_frame
+from iso8583 import parse_response
+
+
+class Exchange(NamedTuple):
+    exchange_id: int
+    sent_at: float
+    request: bytes
+    response: Optional[bytes]
+    latency: Optional[float]      # seconds, None if the host never answered
+    response_code: Optional[str]
+
+
+class ReplayResult(NamedTuple):
+    exchange: Exchange
+    latency: Optional[float]
+    response_code: Optional[str]
+    error: Optional[str]
+
+
+def load_exchanges(paths: Sequence[str]) -> List[Exchange]:
+    """Pair captured requests with their responses, in send order"""
+    pending: Dict[int, tuple] = {}
+    exchanges = []
+    for path in paths:
+        for record in read_capture(path):
+            if record.kind == REQUEST:
+                pending[record.exchange_id] = (record.timestamp, record.frame)
+            elif record.exchange_id in pending:
+                sent_at, request = pending.pop(record.exchange_id)
+                if record.kind == RESPONSE:
+                    code = parse_response(record.frame).get('response_code')
+                    exchanges.append(Exchange(record.exchange_id, sent_at, request, record.frame,
+                                              record.timestamp - sent_at, code))
+                elif record.kind == ERROR:
+                    exchanges.append(Exchange(record.exchange_id, sent_at, request, None, None, None))
+
+    # Requests whose response was never written (crash, rotation cut)
+    for exchange_id, (sent_at, request) in pending.items():
+        exchanges.append(Exchange(exchange_id, sent_at, request, None, None, None))
+
+    exchanges.sort(key=lambda e: e.sent_at)
+    return exchanges
+
+
+def send_one(exchange: Exchange, host: str, port: int, ssl_context: Optional[ssl.SSLContext],
+             timeout: float) -> ReplayResult:
+    """Replay one request on its own connection"""
+    try:
+        start = time.perf_counter()
+        conn = socket.create_connection((host, port), timeout=timeout)
+        try:
+            if ssl_context is not None:
+                conn = ssl_context.wrap_socket(conn, server_hostname=host)
+            conn.sendall(exchange.request)
+            response = recv_frame(conn)
+        finally:
+            conn.close()
+        latency = time.perf_counter() - start
+        return ReplayResult(exchange, latency, parse_response(response).get('response_code'), None)
+    except Exception as e:
+        return ReplayResult(exchange, None, None, str(e))
+
+
+def replay(exchanges: List[Exchange], host: str, port: int, speed: float = 1.0,
+           ssl_context: Optional[ssl.SSLContext] = None, timeout: float = 30.0,
+           max_workers: int = 64) -> List[ReplayResult]:
+    """
+    Send every captured request on the original schedule divided by `speed`.
+    Requests are dispatched by the clock, not by the previous reply, so a
+    slow host sees the same overlapping load it saw in production.
+    speed=0 sends everything as fast as the workers allow.
+    """
+    if not exchanges:
+        return []
+
+    results: List[Optional[ReplayResult]] = [None] * len(exchanges)
+    origin = exchanges[0].sent_at
+    start = time.monotonic()
+    lock = threading.Lock()
+
+    def run(index: int, exchange: Exchange):
+        result = send_one(exchange, host, port, ssl_context, timeout)
+        with lock:
+            results[index] = result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for index, exchange in enumerate(exchanges):
+            if speed > 0:
+                due = start + (exchange.sent_at - origin) / speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(run, index, exchange)
+
+    return results
+
+
+def percentile(values: Sequence[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of unsorted values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def format_report(results: List[ReplayResult], speed: float, elapsed: float) -> str:
+    """Text report of latency and response-code differences"""
+    if not results:
+        return "No exchanges found in capture"
+
+    original = [r.exchange.latency for r in results if r.exchange.latency is not None]
+    replayed = [r.latency for r in results if r.latency is not None]
+    span = results[-1].exchange.sent_at - results[0].exchange.sent_at
+
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f} ms"
+
+    pacing = "unpaced" if speed <= 0 else f"{speed:g}x"
+    lines = [
+        f"Replayed {len(results)} exchanges {pacing} in {elapsed:.1f} s (captured span {span:.1f} s)",
+        f"{'':16}{'captured':>12}{'replay':>12}",
+    ]
+    for label, pct in (("p50 latency", 50), ("p95 latency", 95), ("p99 latency", 99), ("max latency", 100)):
+        lines.append(f"{label:16}{ms(percentile(original, pct)):>12}{ms(percentile(replayed, pct)):>12}")
+    lines.append(f"{'no response':16}{len(results) - len(original):>12}{len(results) - len(replayed):>12}")
+
+    differences = [r for r in results if r.response_code != r.exchange.response_code]
+    lines.append(f"Response code differences: {len(differences)}")
+    for r in differences[:50]:
+        replay_code = r.response_code or f"ERROR ({r.error})"
+        lines.append(f"  exchange {r.exchange.exchange_id}: {r.exchange.response_code or 'none'} -> {replay_code}")
+    if len(differences) > 50:
+        lines.append(f"  ... {len(differences) - 50} more")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a wire capture against a host")
+    parser.add_argument("capture", help="Capture file (rotated backups are included)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--speed", type=float, default=1.0, help="Pacing multiplier (0 = unpaced)")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--tls", action="store_true", help="Wrap connections in TLS")
+    parser.add_argument("--cert", help="Client certificate for TLS")
+    parser.add_argument("--key", help="Client key for TLS")
+    args = parser.parse_args()
+
+    ssl_context = None
+    if args.tls:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        if args.cert:
+            ssl_context.load_cert_chain(args.cert, args.key)
+
+    exchanges = load_exchanges(capture_files(args.capture))
+    start = time.monotonic()
+    results = replay(exchanges, args.host, args.port, args.speed, ssl_context, args.timeout)
+    print(format_report(results, args.speed, time.monotonic() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Automatic Reversals
+0400s for sales sent without a usable answer, queued in the state backend
+and delivered in the background with retry and backoff
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from authorizer import DEFAULT_AUTHORIZATION_BUDGET, HostClient
+from connections import Deadline
+from iso8583 import (
+    REVERSAL_FIELDS, VISA_RESPONSE_CODES, build_reversal_fields, encode_message, match_response, parse_response
+)
+from journal import safe_card
+from state_backend import CounterBlock, StateBackend
+
+# Where earlier versions kept reversals, as config entries
+LEGACY_CONFIG_PREFIX = "reversal:"
+
+# Reversal states
+PENDING = "pending"
+REVERSED = "reversed"
+ABANDONED = "abandoned"
+
+# 0410 response codes that settle a reversal; anything else (96, 91, ...) is retried
+ACCEPTED_CODES = ("00",)
+
+# Seconds before the first attempt (a late 0210 may still be on its way),
+# then between attempts doubling up to MAX_BACKOFF
+FIRST_ATTEMPT_DELAY = 2.0
+RETRY_DELAY = 10.0
+MAX_BACKOFF = 600.0
+
+# Attempts before a reversal is left for manual follow-up
+MAX_ATTEMPTS = 12
+
+# Finished reversals kept for display
+KEEP_FINISHED = 200
+
+# Longest sleep between scans, so reversals queued by other replicas are picked up
+POLL_INTERVAL = 30.0
+
+# A claim outlives the send it covers by this much before another replica may retry
+CLAIM_MARGIN = 30.0
+
+
+def retry_delay(attempts: int) -> float:
+    """Seconds to wait after the given number of failed attempts"""
+    return min(MAX_BACKOFF, RETRY_DELAY * (2 ** (attempts - 1)))
+
+
+class ReversalQueue:
+    """
+    Unconfirmed sales waiting to be reversed, one row each in the backend's
+    reversal table so they survive restarts and are visible on every replica.
+
+    A background thread claims each due reversal (a lease, so two replicas
+    never send the same 0400 at once) and sends it to the server that got
+    the original sale. A 0410 with an approval code settles it; declines,
+    errors and silence are retried with exponential backoff until
+    MAX_ATTEMPTS, then left as abandoned. No card data is stored: the
+    reversal carries DE 90 and the RRN instead of PAN and expiry.
+
+    `dispatch`, when set, runs each round for the thread, e.g. on one of the
+    host-link daemon's workers so reversals stay within its connection limit.
+    """
+
+    def __init__(self, client: HostClient, backend: StateBackend,
+                 server_configs: Callable[[], Dict[str, Dict]],
+                 timeout: float = DEFAULT_AUTHORIZATION_BUDGET, max_attempts: int = MAX_ATTEMPTS,
+                 keep: int = KEEP_FINISHED,
+                 dispatch: Optional[Callable[[Callable[[], int]], int]] = None):
+        self.client = client
+        self.backend = backend
+        self.server_configs = server_configs
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.keep = keep
+        self.dispatch = dispatch
+        self._stan = CounterBlock(backend, "stan:reversal", start=1)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._migrate()
+
+    def _migrate(self):
+        """Move reversals kept as config entries into the table, without their card data"""
+        for key, record in self.backend.all_config().items():
+            if key.startswith(LEGACY_CONFIG_PREFIX) and isinstance(record, dict):
+                record['original'] = {num: value for num, value in record.get('original', {}).items()
+                                      if int(num) in REVERSAL_FIELDS + (7, 11)}
+                self.backend.put_reversal(dict(record, lease_until=0.0))
+                self.backend.delete_config(key)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="reversals", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def retry_now(self):
+        """Make every pending reversal due and wake the scheduler"""
+        self.backend.reschedule_reversals(time.time())
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.dispatch is not None:
+                    self.dispatch(self.run_once)
+                else:
+                    self.run_once()
+            except Exception:
+                pass  # never let one bad round kill the thread
+            due = [max(record['next_attempt'], record['lease_until']) for record in self.pending()]
+            wait = min([POLL_INTERVAL] + [max(0.0, at - time.time()) for at in due])
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def enqueue(self, profile_id: str, server: str, fields: Dict[int, Any]) -> Dict[str, Any]:
+        """Queue a reversal of the 0200 built from `fields`, sent to `server`"""
+        now = time.time()
+        original = {str(num): fields[num] for num in REVERSAL_FIELDS + (7, 11) if num in fields}
+        record = {
+            'id': f"{profile_id}:{fields[37]}",
+            'profile_id': profile_id,
+            'server': server,
+            'rrn': fields[37],
+            'stan': fields[11],
+            'amount': int(fields[4]) / 100.0,
+            'card': safe_card(fields[2]),
+            'original': original,
+            'status': PENDING,
+            'attempts': 0,
+            'created': now,
+            'updated': now,
+            'next_attempt': now + FIRST_ATTEMPT_DELAY,
+            'lease_until': 0.0,
+            'last_error': "",
+            'response_code': "",
+        }
+        self.backend.put_reversal(record)
+        self._wake.set()
+        return record
+
+    def records(self) -> List[Dict[str, Any]]:
+        """Every stored reversal, newest first"""
+        return self.backend.list_reversals()
+
+    def pending(self) -> List[Dict[str, Any]]:
+        return self.backend.list_reversals(PENDING)
+
+    def run_once(self, now: Optional[float] = None) -> int:
+        """Claim and attempt every due reversal, oldest first; returns how many were tried"""
+        now = time.time() if now is None else now
+        tried = 0
+        for record in reversed(self.pending()):
+            if record['next_attempt'] > now:
+                continue
+            claimed = self.backend.claim_reversal(record['id'], now, self.timeout + CLAIM_MARGIN)
+            if claimed is None:
+                continue  # another replica has it
+            self.attempt(claimed)
+            tried += 1
+        return tried
+
+    def attempt(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """Send one claimed reversal and store the outcome, releasing the claim"""
+        record = dict(record)
+        result = self._send(record)
+        record['attempts'] += 1
+        record['updated'] = time.time()
+        record['lease_until'] = 0.0
+        code = result.get('response_code', "")
+
+        if 'error' not in result and result.get('mti') == "0410" and code in ACCEPTED_CODES:
+            record['status'] = REVERSED
+            record['response_code'] = code
+            record['last_error'] = ""
+        else:
+            if 'error' in result:
+                record['last_error'] = result['error']
+            elif result.get('mti') != "0410":
+                record['last_error'] = f"Unexpected reply {result.get('mti') or ''}".strip()
+            else:
+                record['last_error'] = f"Reversal not accepted: {code} {VISA_RESPONSE_CODES.get(code, '')}".strip()
+            record['response_code'] = code
+            if record['attempts'] >= self.max_attempts:
+                record['status'] = ABANDONED
+            else:
+                record['next_attempt'] = record['updated'] + retry_delay(record['attempts'])
+
+        self.backend.put_reversal(record)
+        if record['status'] != PENDING:
+            self.backend.purge_reversals(self.keep)
+        return record
+
+    def _send(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        server_config = self.server_configs().get(record['server'])
+        if server_config is None:
+            return {"error": f"Server '{record['server']}' is no longer configured"}
+
+        original = {int(num): value for num, value in record['original'].items()}
+        stan = str(self._stan.next() % 1000000).zfill(6)
+        dialect = server_config.get('dialect')
+        fields = build_reversal_fields(original, stan)
+        frame = encode_message("0400", fields, dialect)
+        deadline = Deadline(self.timeout)
+        try:
+            conn, _ = self.client.connect(server_config, deadline)
+        except Exception as e:
+            return {"error": f"Connect failed: {e}"}
+
+        reusable = False
+        try:
+            response = self.client.exchange(conn, server_config, frame, deadline, phase='reversal')
+            # Only a 0410 echoing this 0400's STAN and the sale's RRN settles it
+            result = match_response(parse_response(response, dialect), "0400", fields)
+            reusable = 'error' not in result
+        except Exception as e:
+            result = {"error": f"Send failed: {e}"}
+        finally:
+            self.client.release(server_config, conn, reusable)
+        return result
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Local Stand-in Host
+Answers 0200/0400/0800 requests like the acquirer would, for replay and load tests
+
+    python standin_host.py --port 9090 --latency-ms 120 --jitter-ms 40
+"""
+
+import argparse
+import os
+import random
+import socketserver
+import ssl
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from connections import recv_frame
+from emv import encode_tlv
+from iso8583 import detect_dialect, encode_message, response_mti, strip_length_prefix
+
+# Fields copied from the request into the response
+ECHO_FIELDS = (3, 4, 7, 11, 12, 13, 37, 41, 42, 49, 70, 90)
+
+
+class StandInHost(socketserver.ThreadingTCPServer):
+    """Threaded TCP server speaking length-prefixed ISO-8583 in any supported dialect"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 decline_rate: float = 0.0, ssl_context: Optional[ssl.SSLContext] = None):
+        super().__init__(address, StandInHandler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.decline_rate = decline_rate
+        self.ssl_context = ssl_context
+        self.requests_served = 0
+        self._count_lock = threading.Lock()
+
+    def respond(self, frame: bytes) -> bytes:
+        """Build the reply for one request frame, in the request's dialect"""
+        body = strip_length_prefix(frame)
+        dialect = detect_dialect(body)
+        mti, fields = dialect.decode(body)
+        reply: Dict[int, Any] = {num: fields[num] for num in ECHO_FIELDS if num in fields}
+
+        if mti in ("0800", "0400"):
+            reply[39] = "00"
+        elif random.random() < self.decline_rate:
+            reply[39] = "05"
+        else:
+            reply[38] = fields.get(38, f"{random.randint(0, 999999):06d}")
+            reply[39] = "00"
+
+        if 55 in fields:
+            # Chip sale: answer with the response code and issuer authentication data
+            reply[55] = encode_tlv([(0x8A, reply[39].encode('ascii')), (0x91, os.urandom(10))])
+
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+        with self._count_lock:
+            self.requests_served += 1
+        return encode_message(response_mti(mti), reply, dialect.name)
+
+
+class StandInHandler(socketserver.BaseRequestHandler):
+    """Serve frames on one connection until the client closes it"""
+
+    def setup(self):
+        # TLS handshake runs on the handler thread, not the accept loop
+        if self.server.ssl_context is not None:
+            self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True)
+
+    def handle(self):
+        while True:
+            try:
+                frame = recv_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                reply = self.server.respond(frame)
+            except (ValueError, IndexError):
+                return
+            self.request.sendall(reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the acquirer host")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Mean processing delay")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Uniform +/- delay")
+    parser.add_argument("--decline-rate", type=float, default=0.0, help="Share of sales answered 05")
+    parser.add_argument("--cert", help="Server certificate (enables TLS)")
+    parser.add_argument("--key", help="Server private key")
+    args = parser.parse_args()
+
+    ssl_context = None
+    if args.cert:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(args.cert, args.key)
+
+    server = StandInHost((args.host, args.port), args.latency_ms, args.jitter_ms,
+                         args.decline_rate, ssl_context)
+    print(f"Stand-in host listening on {args.host}:{args.port}"
+          f"{' (TLS)' if ssl_context else ''}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
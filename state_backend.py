@@ -0,0 +1,686 @@
+"""
+State Backend
+Configuration, sequence counters, certificates, the transaction journal and
+the reversal queue, shared by every replica of the terminal on a host
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from connections import SSLContextCache
+from journal import JournalQuery, RingJournal, safe_card
+
+
+class StateBackend:
+    """
+    Storage interface for terminal state.
+    Every write bumps a generation number so caches can tell, with one cheap
+    read, whether anything changed since they last looked.
+    """
+
+    def generation(self) -> int:
+        """Change counter for config and certificates"""
+        raise NotImplementedError
+
+    def get_config(self, key: str, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def set_config(self, key: str, value: Any):
+        raise NotImplementedError
+
+    def setdefault_config(self, key: str, value: Any) -> Any:
+        """Store value unless key exists; return the stored value either way"""
+        raise NotImplementedError
+
+    def delete_config(self, key: str) -> bool:
+        """Remove a key; returns False if it did not exist"""
+        raise NotImplementedError
+
+    def all_config(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def reserve_counter(self, name: str, count: int, start: int = 1) -> int:
+        """Atomically reserve count values; returns the first one"""
+        raise NotImplementedError
+
+    def peek_counter(self, name: str, start: int = 1) -> int:
+        """Next value that would be reserved (informational only)"""
+        raise NotImplementedError
+
+    def put_certificate(self, name: str, data: bytes):
+        raise NotImplementedError
+
+    def get_certificate(self, name: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def append_journal(self, profile_id: str, record: Dict[str, Any]):
+        raise NotImplementedError
+
+    def journal_tail(self, profile_id: str, limit: int) -> List[Dict[str, Any]]:
+        """Last `limit` records for a profile, oldest first"""
+        raise NotImplementedError
+
+    def iter_journal(self, profile_id: Optional[str] = None, since: Optional[datetime] = None,
+                     until: Optional[datetime] = None, batch_number: Any = None) -> Iterator[Dict[str, Any]]:
+        """
+        Journal records in insertion order, each with its 'profile_id'.
+        Filters are applied while reading: since <= timestamp < until and
+        batch number compared as text.
+        """
+        raise NotImplementedError
+
+    def search_journal(self, query: JournalQuery, limit: int = 100) -> List[Dict[str, Any]]:
+        """Records matching every set criterion, newest first, each with its 'profile_id'"""
+        raise NotImplementedError
+
+    def clear_journal(self, profile_id: str):
+        raise NotImplementedError
+
+    # Reversals are operational records, not config: writing them leaves the
+    # generation alone so config caches are not reloaded on every retry.
+
+    def put_reversal(self, record: Dict[str, Any]):
+        """Insert or replace a reversal by its 'id'"""
+        raise NotImplementedError
+
+    def list_reversals(self, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Stored reversals, newest first"""
+        raise NotImplementedError
+
+    def claim_reversal(self, reversal_id: str, now: float, lease: float) -> Optional[Dict[str, Any]]:
+        """
+        Atomically lease a pending reversal that is due at `now` and not
+        leased by anyone else; returns it, or None if it cannot be claimed
+        """
+        raise NotImplementedError
+
+    def reschedule_reversals(self, at: float) -> int:
+        """Bring every pending reversal due after `at` forward to `at`"""
+        raise NotImplementedError
+
+    def purge_reversals(self, keep: int) -> int:
+        """Drop all but the newest `keep` finished reversals"""
+        raise NotImplementedError
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    Single-process backend (the default when no database is configured).
+    History is a bounded RingJournal; records beyond `journal_capacity` go
+    to `journal_spill` if set, otherwise they are dropped.
+    """
+
+    def __init__(self, journal_capacity: int = 10000, journal_spill: Optional[str] = None):
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._config: Dict[str, Any] = {}
+        self._counters: Dict[str, int] = {}
+        self._certificates: Dict[str, bytes] = {}
+        self._journal = RingJournal(journal_capacity, journal_spill)
+        self._reversals: Dict[str, Dict[str, Any]] = {}
+
+    def generation(self) -> int:
+        return self._generation
+
+    def get_config(self, key: str, default: Any = None) -> Any:
+        return self._config.get(key, default)
+
+    def set_config(self, key: str, value: Any):
+        with self._lock:
+            self._config[key] = value
+            self._generation += 1
+
+    def setdefault_config(self, key: str, value: Any) -> Any:
+        with self._lock:
+            if key not in self._config:
+                self._config[key] = value
+                self._generation += 1
+            return self._config[key]
+
+    def delete_config(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._config:
+                return False
+            del self._config[key]
+            self._generation += 1
+            return True
+
+    def all_config(self) -> Dict[str, Any]:
+        return dict(self._config)
+
+    def reserve_counter(self, name: str, count: int, start: int = 1) -> int:
+        with self._lock:
+            first = self._counters.get(name, start)
+            self._counters[name] = first + count
+            return first
+
+    def peek_counter(self, name: str, start: int = 1) -> int:
+        return self._counters.get(name, start)
+
+    def put_certificate(self, name: str, data: bytes):
+        with self._lock:
+            self._certificates[name] = bytes(data)
+            self._generation += 1
+
+    def get_certificate(self, name: str) -> Optional[bytes]:
+        return self._certificates.get(name)
+
+    def append_journal(self, profile_id: str, record: Dict[str, Any]):
+        self._journal.append(profile_id, record)
+
+    def journal_tail(self, profile_id: str, limit: int) -> List[Dict[str, Any]]:
+        return self._journal.tail(profile_id, limit)
+
+    def iter_journal(self, profile_id: Optional[str] = None, since: Optional[datetime] = None,
+                     until: Optional[datetime] = None, batch_number: Any = None) -> Iterator[Dict[str, Any]]:
+        for entry in self._journal.iter_records(profile_id, since, until, batch_number):
+            yield entry.to_row()
+
+    def search_journal(self, query: JournalQuery, limit: int = 100) -> List[Dict[str, Any]]:
+        return self._journal.search(query, limit)
+
+    def clear_journal(self, profile_id: str):
+        self._journal.clear(profile_id)
+
+    def put_reversal(self, record: Dict[str, Any]):
+        with self._lock:
+            self._reversals[record['id']] = dict(record)
+
+    def list_reversals(self, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            records = [dict(record) for record in self._reversals.values()
+                       if status is None or record['status'] == status]
+        return sorted(records, key=lambda record: record['created'], reverse=True)
+
+    def claim_reversal(self, reversal_id: str, now: float, lease: float) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            record = self._reversals.get(reversal_id)
+            if record is None or not _claimable(record, now):
+                return None
+            record['lease_until'] = now + lease
+            return dict(record)
+
+    def reschedule_reversals(self, at: float) -> int:
+        with self._lock:
+            due = [record for record in self._reversals.values()
+                   if record['status'] == 'pending' and record['next_attempt'] > at]
+            for record in due:
+                record['next_attempt'] = at
+            return len(due)
+
+    def purge_reversals(self, keep: int) -> int:
+        with self._lock:
+            finished = sorted((record for record in self._reversals.values() if record['status'] != 'pending'),
+                              key=lambda record: record['created'], reverse=True)
+            for record in finished[keep:]:
+                del self._reversals[record['id']]
+            return len(finished[keep:])
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    Backend in a local SQLite file that several processes can share.
+    WAL mode lets readers run alongside a writer; writes that must be atomic
+    across processes (counters, config, reversal claims) use BEGIN IMMEDIATE.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS certificates (name TEXT PRIMARY KEY, data BLOB NOT NULL);
+    CREATE TABLE IF NOT EXISTS journal (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        profile_id TEXT NOT NULL,
+        ts REAL NOT NULL,
+        record TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS journal_profile ON journal (profile_id, id);
+    CREATE INDEX IF NOT EXISTS journal_ts ON journal (ts);
+    CREATE INDEX IF NOT EXISTS journal_rrn ON journal (json_extract(record, '$.rrn'));
+    CREATE INDEX IF NOT EXISTS journal_stan ON journal (json_extract(record, '$.stan'));
+    CREATE INDEX IF NOT EXISTS journal_approval ON journal (json_extract(record, '$.approval_code'));
+    CREATE INDEX IF NOT EXISTS journal_card ON journal (substr(json_extract(record, '$.card'), -4));
+    CREATE INDEX IF NOT EXISTS journal_response ON journal (json_extract(record, '$.response_code'));
+    CREATE INDEX IF NOT EXISTS journal_amount ON journal (json_extract(record, '$.amount'));
+    CREATE TABLE IF NOT EXISTS reversals (
+        id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        created REAL NOT NULL,
+        next_attempt REAL NOT NULL,
+        lease_until REAL NOT NULL DEFAULT 0,
+        record TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS reversals_due ON reversals (status, next_attempt);
+    INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 30.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        """One connection per thread; sqlite3 connections are not thread-safe"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, statements: List[tuple]):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def generation(self) -> int:
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def get_config(self, key: str, default: Any = None) -> Any:
+        row = self._conn().execute("SELECT value FROM config WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_config(self, key: str, value: Any):
+        self._write([(
+            "INSERT INTO config (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value))
+        )])
+
+    def setdefault_config(self, key: str, value: Any) -> Any:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM config WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO config (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+                stored = value
+            else:
+                stored = json.loads(row[0])
+            conn.execute("COMMIT")
+            return stored
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete_config(self, key: str) -> bool:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = conn.execute("DELETE FROM config WHERE key = ?", (key,)).rowcount > 0
+            if deleted:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+            conn.execute("COMMIT")
+            return deleted
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def all_config(self) -> Dict[str, Any]:
+        rows = self._conn().execute("SELECT key, value FROM config").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def reserve_counter(self, name: str, count: int, start: int = 1) -> int:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, ?)", (name, start))
+            first = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = ?", (count, name))
+            conn.execute("COMMIT")
+            return first
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def peek_counter(self, name: str, start: int = 1) -> int:
+        row = self._conn().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else start
+
+    def put_certificate(self, name: str, data: bytes):
+        self._write([(
+            "INSERT INTO certificates (name, data) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET data = excluded.data",
+            (name, sqlite3.Binary(data))
+        )])
+
+    def get_certificate(self, name: str) -> Optional[bytes]:
+        row = self._conn().execute("SELECT data FROM certificates WHERE name = ?", (name,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def append_journal(self, profile_id: str, record: Dict[str, Any]):
+        ts, payload = _encode_record(record)
+        self._conn().execute(
+            "INSERT INTO journal (profile_id, ts, record) VALUES (?, ?, ?)",
+            (profile_id, ts, payload)
+        )
+
+    def journal_tail(self, profile_id: str, limit: int) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(
+            "SELECT ts, record FROM journal WHERE profile_id = ? ORDER BY id DESC LIMIT ?",
+            (profile_id, limit)
+        ).fetchall()
+        return [_decode_record(ts, payload) for ts, payload in reversed(rows)]
+
+    def iter_journal(self, profile_id: Optional[str] = None, since: Optional[datetime] = None,
+                     until: Optional[datetime] = None, batch_number: Any = None) -> Iterator[Dict[str, Any]]:
+        clauses, params = [], []
+        if profile_id is not None:
+            clauses.append("profile_id = ?")
+            params.append(profile_id)
+        if since is not None:
+            clauses.append("ts >= ?")
+            params.append(since.timestamp())
+        if until is not None:
+            clauses.append("ts < ?")
+            params.append(until.timestamp())
+        if batch_number is not None:
+            clauses.append("CAST(json_extract(record, '$.batch_number') AS TEXT) = ?")
+            params.append(str(batch_number))
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        # A separate connection keeps a long read from pinning this thread's one
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+        try:
+            cursor = conn.execute(f"SELECT profile_id, ts, record FROM journal{where} ORDER BY id", params)
+            for pid, ts, payload in cursor:
+                record = _decode_record(ts, payload)
+                record['profile_id'] = pid
+                yield record
+        finally:
+            conn.close()
+
+    def search_journal(self, query: JournalQuery, limit: int = 100) -> List[Dict[str, Any]]:
+        # Each criterion uses the same expression as its index. Response
+        # codes have a handful of values, so their index is only used when
+        # nothing more selective is given (unary + hides it from the planner).
+        query = query.normalized()
+        selective = query.rrn or query.stan or query.approval_code or query.card_last4
+        response_expression = "json_extract(record, '$.response_code')"
+        clauses, params = [], []
+        for expression, value in (
+            ("profile_id", query.profile_id),
+            ("json_extract(record, '$.rrn')", query.rrn),
+            ("json_extract(record, '$.stan')", query.stan),
+            ("json_extract(record, '$.approval_code')", query.approval_code),
+            ("substr(json_extract(record, '$.card'), -4)", query.card_last4),
+            ("+" + response_expression if selective else response_expression, query.response_code),
+        ):
+            if value is not None:
+                clauses.append(f"{expression} = ?")
+                params.append(value)
+        if query.min_amount is not None:
+            clauses.append("json_extract(record, '$.amount') >= ?")
+            params.append(query.min_amount)
+        if query.max_amount is not None:
+            clauses.append("json_extract(record, '$.amount') <= ?")
+            params.append(query.max_amount)
+        if query.since is not None:
+            clauses.append("ts >= ?")
+            params.append(query.since.timestamp())
+        if query.until is not None:
+            clauses.append("ts < ?")
+            params.append(query.until.timestamp())
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        rows = self._conn().execute(
+            f"SELECT profile_id, ts, record FROM journal{where} ORDER BY id DESC LIMIT ?",
+            params + [limit]
+        ).fetchall()
+        results = []
+        for pid, ts, payload in rows:
+            record = _decode_record(ts, payload)
+            record['profile_id'] = pid
+            results.append(record)
+        return results
+
+    def clear_journal(self, profile_id: str):
+        self._conn().execute("DELETE FROM journal WHERE profile_id = ?", (profile_id,))
+
+    # The status, schedule and lease columns are authoritative; the JSON
+    # copy of them is refreshed on every put
+
+    def put_reversal(self, record: Dict[str, Any]):
+        self._conn().execute(
+            "INSERT INTO reversals (id, status, created, next_attempt, lease_until, record) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET status = excluded.status, "
+            "next_attempt = excluded.next_attempt, lease_until = excluded.lease_until, record = excluded.record",
+            (record['id'], record['status'], record['created'], record['next_attempt'],
+             record.get('lease_until', 0.0), json.dumps(record))
+        )
+
+    def list_reversals(self, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        sql = "SELECT status, next_attempt, lease_until, record FROM reversals"
+        params: tuple = ()
+        if status is not None:
+            sql += " WHERE status = ?"
+            params = (status,)
+        rows = self._conn().execute(sql + " ORDER BY created DESC", params).fetchall()
+        return [_decode_reversal(*row) for row in rows]
+
+    def claim_reversal(self, reversal_id: str, now: float, lease: float) -> Optional[Dict[str, Any]]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT status, next_attempt, lease_until, record FROM reversals "
+                "WHERE id = ? AND status = 'pending' AND next_attempt <= ? AND lease_until <= ?",
+                (reversal_id, now, now)
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE reversals SET lease_until = ? WHERE id = ?", (now + lease, reversal_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        record = _decode_reversal(*row)
+        record['lease_until'] = now + lease
+        return record
+
+    def reschedule_reversals(self, at: float) -> int:
+        return self._conn().execute(
+            "UPDATE reversals SET next_attempt = ? WHERE status = 'pending' AND next_attempt > ?", (at, at)
+        ).rowcount
+
+    def purge_reversals(self, keep: int) -> int:
+        return self._conn().execute(
+            "DELETE FROM reversals WHERE status != 'pending' AND id NOT IN "
+            "(SELECT id FROM reversals WHERE status != 'pending' ORDER BY created DESC LIMIT ?)", (keep,)
+        ).rowcount
+
+
+def _encode_record(record: Dict[str, Any]):
+    record = dict(record)
+    record['card'] = safe_card(record.get('card', ''))
+    timestamp = record.pop('timestamp', None) or datetime.now()
+    return timestamp.timestamp(), json.dumps(record)
+
+
+def _decode_record(ts: float, payload: str) -> Dict[str, Any]:
+    record = json.loads(payload)
+    record['timestamp'] = datetime.fromtimestamp(ts)
+    return record
+
+
+def _decode_reversal(status: str, next_attempt: float, lease_until: float, payload: str) -> Dict[str, Any]:
+    record = json.loads(payload)
+    record.update(status=status, next_attempt=next_attempt, lease_until=lease_until)
+    return record
+
+
+def _claimable(record: Dict[str, Any], now: float) -> bool:
+    return record['status'] == 'pending' and record['next_attempt'] <= now and record.get('lease_until', 0.0) <= now
+
+
+class CounterBlock:
+    """
+    Sequence numbers handed out from blocks reserved in the backend.
+    Replicas never issue the same number, yet only one in `block_size`
+    calls touches the shared store.
+    """
+
+    def __init__(self, backend: StateBackend, name: str, start: int = 1, block_size: int = 50):
+        self.backend = backend
+        self.name = name
+        self.start = start
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def next(self) -> int:
+        with self._lock:
+            if self._next >= self._end:
+                self._next = self.backend.reserve_counter(self.name, self.block_size, self.start)
+                self._end = self._next + self.block_size
+            value = self._next
+            self._next += 1
+            return value
+
+    def peek(self) -> int:
+        """Next number this replica would issue"""
+        if self._next < self._end:
+            return self._next
+        return self.backend.peek_counter(self.name, self.start)
+
+
+class ConfigCache:
+    """
+    Read-mostly view of backend config.
+    Reads are plain dict lookups; the backend generation is polled at most
+    once per `refresh_interval`, so a change made by another replica shows
+    up within that interval without locking each request.
+    """
+
+    def __init__(self, backend: StateBackend, refresh_interval: float = 1.0):
+        self.backend = backend
+        self.refresh_interval = refresh_interval
+        self._generation = -1
+        self._next_check = 0.0
+        self._values: Dict[str, Any] = {}
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.refresh_interval
+        generation = self.backend.generation()
+        if generation != self._generation:
+            self._values = self.backend.all_config()
+            self._generation = generation
+
+    @property
+    def generation(self) -> int:
+        self._refresh()
+        return self._generation
+
+    def get(self, key: str, default: Any = None) -> Any:
+        self._refresh()
+        return self._values.get(key, default)
+
+    def keys(self) -> List[str]:
+        self._refresh()
+        return list(self._values)
+
+    def set(self, key: str, value: Any):
+        self.backend.set_config(key, value)
+        self._next_check = 0.0
+
+    def delete(self, key: str) -> bool:
+        deleted = self.backend.delete_config(key)
+        self._next_check = 0.0
+        return deleted
+
+
+class CertificateStore:
+    """
+    Client certificate and key held in the backend.
+    The ssl module needs files, so each process writes its own copy under
+    the local certs directory whenever the stored version changes, and
+    drops the contexts and validation results `ssl_contexts` cached for
+    the old files.
+    """
+
+    VERSION_KEY = "certificate_version"
+
+    def __init__(self, config: ConfigCache, cert_path: str, key_path: str,
+                 ssl_contexts: Optional[SSLContextCache] = None):
+        self.config = config
+        self.backend = config.backend
+        self.cert_path = cert_path
+        self.key_path = key_path
+        self.ssl_contexts = ssl_contexts
+        self._written_version = 0
+
+    @property
+    def uploaded(self) -> bool:
+        """Whether any replica has stored certificates"""
+        return self.config.get(self.VERSION_KEY, 0) > 0
+
+    def save(self, cert_data: bytes, key_data: bytes) -> bool:
+        """Store a new certificate/key pair for every replica; True once written here"""
+        self.backend.put_certificate("client_cert", cert_data)
+        self.backend.put_certificate("client_key", key_data)
+        self.config.set(self.VERSION_KEY, self.backend.generation())
+        return self.sync()
+
+    def sync(self) -> bool:
+        """Write the stored pair to local files if they are out of date"""
+        version = self.config.get(self.VERSION_KEY, 0)
+        if not version or version == self._written_version:
+            return False
+
+        cert_data = self.backend.get_certificate("client_cert")
+        key_data = self.backend.get_certificate("client_key")
+        if cert_data is None or key_data is None:
+            return False
+
+        for path, data in ((self.cert_path, cert_data), (self.key_path, key_data)):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, path)
+        self._written_version = version
+        if self.ssl_contexts is not None:
+            self.ssl_contexts.invalidate()
+        return True
+
+
+def open_state_backend(url: Optional[str] = None) -> StateBackend:
+    """
+    Open the backend named by `url` or $TERMINAL_STATE_DB.
+    Accepts a SQLite file path (optionally prefixed sqlite:///) or "memory".
+    The memory backend keeps the last $TERMINAL_JOURNAL_CAPACITY records
+    and spills older ones to $TERMINAL_JOURNAL_SPILL when it is set.
+    """
+    url = url if url is not None else os.environ.get('TERMINAL_STATE_DB', 'memory')
+    if not url or url == 'memory':
+        return MemoryStateBackend(int(os.environ.get('TERMINAL_JOURNAL_CAPACITY', 10000)),
+                                  os.environ.get('TERMINAL_JOURNAL_SPILL') or None)
+    if url.startswith('sqlite:///'):
+        url = url[len('sqlite:///'):]
+    return SQLiteStateBackend(url)
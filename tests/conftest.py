@@ -0,0 +1,43 @@
+import socket
+import threading
+
+import pytest
+
+from authorizer import HostClient
+from connections import ConnectionPool, LatencyTracker, SSLContextCache
+from standin_host import StandInHost
+
+
+@pytest.fixture
+def standin():
+    """Local stand-in host; yields a factory taking StandInHost options"""
+    servers = []
+
+    def start(**options):
+        server = StandInHost(("127.0.0.1", 0), **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def server_config(port, **extra):
+    return dict({'host': "127.0.0.1", 'port': port, 'protocol': 'HTTP', 'keep_alive': False}, **extra)
+
+
+def closed_port():
+    """A local port with nothing listening"""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture
+def host_client():
+    return HostClient(SSLContextCache(), ConnectionPool(), LatencyTracker(), "unused.crt", "unused.key")
@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+from connections import Deadline
+
+
+def server(**rate_limit):
+    return {'host': "127.0.0.1", 'port': 9090, 'protocol': 'HTTP', 'rate_limit': rate_limit}
+
+
+def test_unlimited_server_admits_at_once():
+    assert AdmissionController().admit(server(), "M:T", Deadline(1.0)) == 0.0
+
+
+def test_zero_queue_admits_while_tokens_last():
+    controller = AdmissionController()
+    config = server(tps=10, burst=3, queue=0)
+    for _ in range(3):
+        assert controller.admit(config, "M:T", Deadline(1.0)) == 0.0
+    with pytest.raises(AdmissionRejected, match="queue full"):
+        controller.admit(config, "M:T", Deadline(1.0))
+    stats = controller.summary(("HTTP", "127.0.0.1", 9090))
+    assert (stats['admitted'], stats['rejected']) == (3, 1)
+
+
+def test_caller_waits_for_the_next_token():
+    controller = AdmissionController()
+    config = server(tps=20, burst=1)
+    controller.admit(config, "M:T", Deadline(1.0))
+    waited = controller.admit(config, "M:T", Deadline(1.0))
+    assert 0.03 < waited <= 0.06
+
+
+def test_wait_past_the_deadline_is_rejected_and_refunded():
+    controller = AdmissionController()
+    config = server(tps=1, burst=1)
+    controller.admit(config, "M:T", Deadline(5.0))
+    with pytest.raises(AdmissionRejected, match="rate limited"):
+        controller.admit(config, "M:T", Deadline(0.1))
+    # The refused caller's token went back: the next wait is still about 1 s, not 2
+    with pytest.raises(AdmissionRejected, match=r"next slot in 1\.0s"):
+        controller.admit(config, "M:T", Deadline(0.1))
+
+
+def test_terminal_limit_is_per_profile():
+    controller = AdmissionController()
+    config = server(terminal_tps=1)
+    controller.admit(config, "M:A", Deadline(0.1))
+    controller.admit(config, "M:B", Deadline(0.1))
+    with pytest.raises(AdmissionRejected):
+        controller.admit(config, "M:A", Deadline(0.1))
+
+
+def test_idle_terminal_buckets_are_dropped():
+    controller = AdmissionController(sweep_interval=0.0)
+    config = server(terminal_tps=100)
+    for n in range(50):
+        controller.admit(config, f"M:{n}", Deadline(0.1))
+    assert len(controller._buckets) == 50
+    time.sleep(0.02)  # every bucket refills in 10 ms
+    controller.admit(config, "M:new", Deadline(0.1))
+    assert list(controller._buckets) == [('terminal', ("HTTP", "127.0.0.1", 9090), "M:new")]
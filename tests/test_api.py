@@ -0,0 +1,102 @@
+import http.client
+import json
+import threading
+
+import pytest
+
+from api import APIServer, TerminalAPI, validate_sale
+from conftest import closed_port, server_config
+from idempotency import SubmissionCache
+from profiles import ProfileRegistry
+
+SALE = {'pan': "4111 1111 1111 1111", 'expiry': "12/28", 'approval_code': "1234", 'amount': "12.34"}
+
+
+def make_api(host_client, servers, budget=2.0):
+    registry = ProfileRegistry()
+    registry.config.set('authorization_budget', budget)
+    return TerminalAPI(registry, host_client, SubmissionCache(), lambda: servers, "M:T")
+
+
+def test_validate_sale_cleans_and_rejects():
+    errors, sale = validate_sale(SALE)
+    assert errors == []
+    assert (sale['pan'], sale['expiry'], sale['amount']) == ("4111111111111111", "1228", 12.34)
+    errors, _ = validate_sale({'pan': "4111", 'expiry': "1328", 'approval_code': "12", 'amount': "x",
+                               'chip_data': "zz"})
+    assert len(errors) == 5
+
+
+def test_authorize_rejects_bad_input_with_400(host_client):
+    api = make_api(host_client, {'primary': server_config(1)})
+    status, payload = api.authorize(dict(SALE, pan="1234"))
+    assert status == 400 and payload['errors']
+    status, payload = api.authorize(dict(SALE, server="tertiary"))
+    assert status == 400
+    assert make_api(host_client, {}).authorize(SALE)[0] == 503
+    assert api.authorize(dict(SALE, terminal="nobody"))[0] == 404
+
+
+def test_authorize_approves_and_replays(host_client, standin):
+    host = standin()
+    api = make_api(host_client, {'primary': server_config(host.server_address[1])})
+    status, payload = api.authorize(SALE)
+    assert status == 200
+    assert payload['approved'] and payload['response_code'] == "00" and not payload['replayed']
+    status, payload = api.authorize(SALE)
+    assert status == 200 and payload['replayed']
+    assert host.requests_served == 1
+
+
+def test_unreachable_host_is_503(host_client):
+    api = make_api(host_client, {'primary': server_config(closed_port())})
+    status, payload = api.authorize(SALE)
+    assert status == 503
+    assert payload['connected'] is False
+
+
+def test_timeout_after_send_is_502(host_client, standin):
+    host = standin(latency_ms=1500)
+    api = make_api(host_client, {'primary': server_config(host.server_address[1])}, budget=0.5)
+    status, payload = api.authorize(SALE)
+    assert status == 502
+    assert payload['connected'] is True and "timeout" in payload['error'].lower()
+
+
+@pytest.fixture
+def http_server(host_client):
+    servers = []
+
+    def start(**options):
+        server = APIServer(("127.0.0.1", 0), make_api(host_client, {}), **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server.server_address[1]
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def get(port, path, headers=None, conn=None):
+    conn = conn or http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", path, headers=headers or {})
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_api_key_is_required(http_server):
+    port = http_server(api_key="secret")
+    assert get(port, "/v1/health")[0] == 401
+    assert get(port, "/v1/health", {"Authorization": "Bearer secret"})[0] == 200
+
+
+def test_full_queue_answers_503(http_server):
+    port = http_server(workers=1, queue=0)
+    # A keep-alive client holds the only worker
+    held = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    assert get(port, "/v1/health", conn=held)[0] == 200
+    status, payload = get(port, "/v1/health")
+    assert status == 503 and "busy" in payload['error']
+    held.close()
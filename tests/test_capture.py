@@ -0,0 +1,68 @@
+import pytest
+
+from capture import ERROR, REQUEST, RESPONSE, CaptureWriter, capture_files, read_capture, tokenize_pan
+from iso8583 import DIALECTS, build_sale_fields, decode_message, encode_message
+from replay import load_exchanges, replay
+
+PAN = "4111111111111111"
+KEY = b"k" * 32
+
+
+def sale(dialect=None, stan="000123"):
+    fields = build_sale_fields(pan=PAN, amount=12.34, expiry="1228", approval_code="1234",
+                               merchant_name="Test Shop", terminal_id="72000716",
+                               merchant_id="000000000009020", stan=stan, rrn="000000000456")
+    return encode_message("0200", fields, dialect)
+
+
+def test_token_keeps_bin_last_four_and_length():
+    token = tokenize_pan(PAN, KEY)
+    assert token[:6] == PAN[:6] and token[-4:] == PAN[-4:] and len(token) == len(PAN)
+    assert token != PAN and token == tokenize_pan(PAN, KEY)
+
+
+@pytest.mark.parametrize("dialect", sorted(DIALECTS))
+def test_capture_never_holds_the_pan(tmp_path, dialect):
+    writer = CaptureWriter(str(tmp_path / "host.cap"), token_key=KEY)
+    exchange = writer.next_exchange_id()
+    writer.write(REQUEST, exchange, sale(dialect), PAN)
+    writer.record_error(exchange, "timeout")
+    writer.close()
+
+    request, error = read_capture(str(tmp_path / "host.cap"))
+    assert (request.kind, error.kind) == (REQUEST, ERROR)
+    assert request.exchange_id == error.exchange_id == exchange
+    _, fields = decode_message(request.frame, dialect)
+    assert fields[2] == tokenize_pan(PAN, KEY)
+    assert PAN not in fields[35]
+    assert error.frame == b"timeout"
+
+
+def test_rotation_keeps_backups_in_order(tmp_path):
+    path = str(tmp_path / "host.cap")
+    writer = CaptureWriter(path, max_bytes=600, backup_count=2, token_key=KEY)
+    for _ in range(6):
+        writer.write(REQUEST, writer.next_exchange_id(), sale(), PAN)
+    writer.close()
+    files = capture_files(path)
+    assert files == [path + ".2", path + ".1", path]
+    ids = [record.exchange_id for name in files for record in read_capture(name)]
+    assert ids == sorted(ids)
+
+
+def test_replay_against_the_stand_in(tmp_path, standin):
+    host = standin()
+    path = str(tmp_path / "host.cap")
+    writer = CaptureWriter(path, token_key=KEY)
+    for stan in ("000001", "000002"):
+        exchange = writer.next_exchange_id()
+        writer.write(REQUEST, exchange, sale(stan=stan), PAN)
+        writer.write(RESPONSE, exchange, encode_message("0210", {11: stan, 39: "05"}))
+    writer.write(REQUEST, writer.next_exchange_id(), sale(stan="000003"), PAN)  # never answered
+    writer.close()
+
+    exchanges = load_exchanges(capture_files(path))
+    assert [e.response_code for e in exchanges] == ["05", "05", None]
+    results = replay(exchanges, "127.0.0.1", host.server_address[1], speed=0, timeout=5.0)
+    assert [r.response_code for r in results] == ["00", "00", "00"]
+    assert host.requests_served == 3
@@ -0,0 +1,50 @@
+import pytest
+
+from emv import ChipData, encode_tlv, is_constructed, iter_tlv, tag_hex
+from iso8583 import DIALECTS, decode_message, encode_message, parse_response
+
+ARQC = bytes.fromhex("1122334455667788")
+SCRIPT = encode_tlv([(0x9F18, b"\x00\x00\x00\x01"), (0x86, bytes.fromhex("84DA00000A"))])
+CHIP = encode_tlv([(0x9F26, ARQC), (0x9F27, b"\x80"), (0x95, bytes(5)), (0x71, SCRIPT)])
+
+
+def test_tags_are_written_as_usual():
+    assert [tag_hex(tag) for tag in (0x95, 0x9F26, 0x5F2A)] == ["95", "9F26", "5F2A"]
+    assert is_constructed(0x71) and is_constructed(0x72) and not is_constructed(0x9F26)
+
+
+def test_tlv_round_trip_with_long_lengths_and_padding():
+    long_value = bytes(range(200))
+    data = b"\x00" + encode_tlv([(0x9F10, long_value), (0x8A, b"00")]) + b"\xff"
+    assert [(tag, bytes(value)) for tag, value in iter_tlv(data)] == [(0x9F10, long_value), (0x8A, b"00")]
+    assert data[1:4] == bytes.fromhex("9F1081")
+
+
+@pytest.mark.parametrize("data", [bytes.fromhex("9F"), bytes.fromhex("9F26"), bytes.fromhex("9F2608112233")],
+                         ids=["tag", "length", "value"])
+def test_truncated_tlv_is_rejected(data):
+    with pytest.raises(ValueError, match="truncated|missing"):
+        list(iter_tlv(data))
+
+
+def test_chip_data_lookups_and_scripts():
+    chip = ChipData(CHIP)
+    assert chip.get(0x9F26) == ARQC and chip.hex(0x9F27) == "80"
+    assert 0x86 not in chip and len(chip) == 4
+    assert [bytes(value) for value in chip.find_all(0x86)] == [bytes.fromhex("84DA00000A")]
+    assert chip.issuer_scripts() == [encode_tlv([(0x71, SCRIPT)])]
+    assert chip.describe()[0][0] == "9F26"
+
+
+def test_chip_data_is_parsed_only_when_asked():
+    chip = ChipData(b"\x9F\x26\x08\x11")  # truncated, but nobody looked yet
+    with pytest.raises(ValueError):
+        chip.get(0x9F26)
+
+
+@pytest.mark.parametrize("dialect", sorted(DIALECTS))
+def test_de_55_travels_in_every_dialect(dialect):
+    frame = encode_message("0210", {11: "000123", 39: "00", 55: CHIP}, dialect)
+    assert decode_message(frame, dialect)[1][55] == CHIP
+    result = parse_response(frame, dialect)
+    assert result['emv'].get(0x9F26) == ARQC
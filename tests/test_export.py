@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from state_backend import SQLiteStateBackend
+
+EXPORT = str(Path(__file__).resolve().parent.parent / "export.py")
+
+
+def run_export(*args, env=None):
+    return subprocess.run([sys.executable, EXPORT, *args], capture_output=True, text=True, env=env)
+
+
+def test_cli_refuses_the_memory_backend():
+    env = {key: value for key, value in os.environ.items() if key != 'TERMINAL_STATE_DB'}
+    result = run_export("--format", "csv", env=env)
+    assert result.returncode == 2
+    assert "--db" in result.stderr
+
+
+def test_cli_exports_sqlite_history(tmp_path):
+    db = tmp_path / "terminal.db"
+    backend = SQLiteStateBackend(str(db))
+    backend.append_journal("M:T", {
+        'timestamp': datetime(2026, 10, 19, 12, 0, 0), 'amount': 12.5, 'card': "**** **** **** 1111",
+        'status': 'APPROVED - Transaction Completed', 'approval_code': '1234', 'response_code': '00',
+        'receipt_number': 1, 'rrn': "000000000001", 'stan': "000001", 'batch_number': 7, 'demo': False,
+    })
+    out = tmp_path / "history.csv"
+    result = run_export("--db", str(db), "--format", "csv", "-o", str(out))
+    assert result.returncode == 0, result.stderr
+    lines = out.read_text().splitlines()
+    assert len(lines) == 2
+    assert "000000000001" in lines[1]
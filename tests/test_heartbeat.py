@@ -0,0 +1,49 @@
+import time
+
+from conftest import closed_port, server_config
+from connections import server_key
+from heartbeat import MAX_BACKOFF, Heartbeat
+from state_backend import MemoryStateBackend
+
+
+def make_heartbeat(host_client, config):
+    return Heartbeat(host_client, MemoryStateBackend(), lambda: {'primary': config}, lambda: 30.0)
+
+
+def test_opens_and_echoes_a_warm_connection(host_client, standin):
+    host = standin()
+    config = server_config(host.server_address[1], keep_alive=True)
+    heartbeat = make_heartbeat(host_client, config)
+    key = server_key(config)
+
+    heartbeat.run_once(30.0)
+    assert heartbeat.last_round[key] == "1 connection(s) alive"
+    assert host_client.pool.idle_count(key) == 1
+    # The pooled link is echoed, not replaced
+    heartbeat.run_once(30.0)
+    assert host_client.pool.idle_count(key) == 1
+    assert host.requests_served == 2
+
+
+def test_skips_links_with_recent_traffic_and_non_keep_alive(host_client, standin):
+    host = standin()
+    config = server_config(host.server_address[1], keep_alive=True)
+    heartbeat = make_heartbeat(host_client, config)
+    host_client.last_traffic[server_key(config)] = time.monotonic()
+    heartbeat.run_once(30.0)
+    assert heartbeat.last_round[server_key(config)] == "skipped (recent traffic)"
+
+    heartbeat = make_heartbeat(host_client, server_config(host.server_address[1]))
+    heartbeat.run_once(30.0)
+    assert heartbeat.last_round == {} and host.requests_served == 0
+
+
+def test_unreachable_host_backs_off(host_client):
+    config = server_config(closed_port(), keep_alive=True)
+    heartbeat = make_heartbeat(host_client, config)
+    key = server_key(config)
+    heartbeat.run_once(30.0)
+    assert heartbeat.last_round[key] == "unreachable (1 failed round(s))"
+    heartbeat.run_once(30.0)
+    assert heartbeat.last_round[key] == "backing off"
+    assert 0 < heartbeat._retry_at[key] - time.monotonic() <= min(MAX_BACKOFF, 30.0)
@@ -0,0 +1,112 @@
+import socket
+import threading
+
+import pytest
+
+from conftest import server_config
+from hostlink import HostLinkClient, HostLinkServer, decode_status, encode_status
+from profiles import ProfileRegistry
+from reversals import ReversalQueue
+from state_backend import CertificateStore
+
+SALE = dict(session="s1", profile_id="M:T", server="primary", pan="4111111111111111", amount=12.34,
+            expiry="1228", approval_code="1234", merchant_name="Shop")
+
+
+@pytest.fixture
+def daemon(tmp_path, host_client, standin):
+    servers = []
+
+    def start(window, certificates=None, reversals=None):
+        host = standin()
+        registry = ProfileRegistry()
+        registry.config.set('server_config', {'primary': server_config(host.server_address[1])})
+        registry.config.set('idempotency_window', window)
+        path = str(tmp_path / f"hostlink-{len(servers)}.sock")
+        server = HostLinkServer(path, registry, host_client, connections=2,
+                                reversals=reversals(registry) if reversals else None,
+                                certificates=certificates(registry.config) if certificates else None)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, host, HostLinkClient(path)
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.drain(1.0)
+        server.server_close()
+
+
+def test_resend_is_replayed_inside_the_window(daemon):
+    _, host, client = daemon(60)
+    first, replayed = client.authorize(key="k1", **SALE)
+    assert first['response_code'] == "00" and not replayed
+    again, replayed = client.authorize(key="k1", **SALE)
+    assert replayed and again['rrn'] == first['rrn']
+    assert host.requests_served == 1
+
+
+def test_zero_window_turns_dedup_off(daemon):
+    _, host, client = daemon(0)
+    client.authorize(key="k1", **SALE)
+    _, replayed = client.authorize(key="k1", **SALE)
+    assert not replayed
+    assert host.requests_served == 2
+
+
+def test_certificates_come_from_the_backend(daemon, tmp_path):
+    stores = []
+
+    def mirror(config):
+        stores.append(CertificateStore(config, str(tmp_path / "d/cad.crt"), str(tmp_path / "d/client.key")))
+        return stores[0]
+
+    server, _, client = daemon(60, mirror)
+    # Uploaded through a UI replica sharing the backend
+    CertificateStore(server.registry.config, str(tmp_path / "ui/cad.crt"), str(tmp_path / "ui/client.key")) \
+        .save(b"CERT", b"KEY")
+    client.authorize(key="k1", **SALE)
+    assert (tmp_path / "d/cad.crt").read_bytes() == b"CERT"
+    assert (tmp_path / "d/client.key").read_bytes() == b"KEY"
+
+
+def test_silent_daemon_is_not_resent(tmp_path):
+    path = str(tmp_path / "silent.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    accepted = []
+    threading.Thread(target=lambda: accepted.append(listener.accept()), daemon=True).start()
+
+    result, replayed = HostLinkClient(path).authorize(key="k1", budget=0.1, **SALE)
+    assert result == {"error": "No reply from host link", "connected": False} and not replayed
+    assert len(accepted) == 1
+    listener.close()
+
+
+def test_status_is_binary_encoded(daemon):
+    _, _, client = daemon(60)
+    client.authorize(key="k1", **SALE)
+    status = client.status()
+    assert status['served'] == 1 and status['in_flight'] == 0 and status['queued'] == {}
+    assert status['pending_reversals'] == 0
+
+    status = dict(status, queued={"s1": 3, "ünïcode": 70000})
+    assert decode_status(memoryview(encode_status(status))) == status
+
+
+def test_reversal_rounds_take_a_worker_slot(daemon, host_client):
+    queues = []
+
+    def reversals(registry):
+        queues.append(ReversalQueue(host_client, registry.config.backend, lambda: {}))
+        return queues[0]
+
+    server, _, _ = daemon(60, reversals=reversals)
+    assert queues[0].dispatch == server.run_in_worker
+    seen = []
+    assert server.run_in_worker(lambda: seen.append((threading.current_thread().name, server.in_flight))) is None
+    (name, in_flight), = seen
+    assert name.startswith("hostlink-") and in_flight == 1
+    with pytest.raises(ValueError):
+        server.run_in_worker(lambda: int("x"))
@@ -0,0 +1,83 @@
+import threading
+import time
+
+from idempotency import SubmissionCache, idempotency_key
+
+APPROVED = {'response_code': '00', 'connected': True}
+
+
+def counting(result, delay=0.0):
+    calls = []
+
+    def submit():
+        calls.append(1)
+        time.sleep(delay)
+        return dict(result)
+    return submit, calls
+
+
+def test_key_ignores_formatting_but_not_the_sale():
+    key = idempotency_key("4111111111111111", 12.34, "1234", "M:T")
+    assert key == idempotency_key("4111111111111111", 12.340000001, "1234", "M:T")
+    assert key != idempotency_key("4111111111111111", 12.35, "1234", "M:T")
+    assert key != idempotency_key("4111111111111111", 12.34, "1234", "M:U")
+
+
+def test_identical_submission_replays_the_stored_result():
+    cache = SubmissionCache()
+    submit, calls = counting(APPROVED)
+    first = cache.run("k", 60.0, submit)
+    second = cache.run("k", 60.0, submit)
+    assert first == (APPROVED, False)
+    assert second == (APPROVED, True)
+    assert len(calls) == 1 and cache.replayed == 1
+
+
+def test_concurrent_duplicates_join_the_request_in_flight():
+    cache = SubmissionCache()
+    submit, calls = counting(APPROVED, delay=0.2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.run("k", 60.0, submit))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert sorted(replayed for _, replayed in results) == [False, True, True, True, True]
+
+
+def test_errors_are_not_kept_so_a_retry_is_sent():
+    for failure in ({'error': "Connection timeout - no response from server", 'connected': True},
+                    {'error': "Malformed ASCII response: DE 48 truncated", 'connected': True},
+                    {'error': "primary: refused", 'connected': False}):
+        cache = SubmissionCache()
+        submit, calls = counting(failure)
+        cache.run("k", 60.0, submit)
+        _, replayed = cache.run("k", 60.0, submit)
+        assert not replayed and len(calls) == 2
+
+
+def test_window_expiry_and_zero_window():
+    cache = SubmissionCache()
+    submit, calls = counting(APPROVED)
+    cache.run("k", 0.05, submit)
+    time.sleep(0.1)
+    assert cache.run("k", 0.05, submit)[1] is False
+    cache.run("z", 0, submit)
+    assert cache.run("z", 0, submit)[1] is False
+    assert len(calls) == 4
+
+
+def test_expired_entries_behind_an_in_flight_one_are_purged():
+    cache = SubmissionCache()
+    slow, _ = counting(APPROVED, delay=0.3)
+    worker = threading.Thread(target=cache.run, args=("slow", 60.0, slow))
+    worker.start()
+    time.sleep(0.05)
+    for n in range(5):
+        cache.run(f"k{n}", 0.01, counting(APPROVED)[0])
+    time.sleep(0.02)
+    cache.run("last", 60.0, counting(APPROVED)[0])
+    # Only the in-flight sale and the newest result are left
+    assert set(cache._entries) == {"slow", "last"}
+    worker.join()
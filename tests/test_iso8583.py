@@ -0,0 +1,68 @@
+from datetime import datetime
+
+import pytest
+
+from iso8583 import (
+    DIALECTS, FIELD_SPECS, FieldError, build_sale_fields, decode_message, encode_message, parse_response
+)
+
+NOW = datetime(2026, 10, 19, 12, 30, 45)
+
+
+def sale_fields(**overrides):
+    fields = build_sale_fields(
+        pan="4111111111111111", amount=12.34, expiry="1228", approval_code="1234",
+        merchant_name="Test Shop", terminal_id="72000716", merchant_id="000000000009020",
+        stan="000123", rrn="000000000456", now=NOW
+    )
+    fields.update(overrides)
+    return fields
+
+
+def test_every_data_element_has_a_format():
+    assert set(FIELD_SPECS) == set(range(2, 129))
+
+
+@pytest.mark.parametrize("dialect", sorted(DIALECTS))
+def test_sale_round_trip(dialect):
+    fields = sale_fields()
+    mti, decoded = decode_message(encode_message("0200", fields, dialect), dialect)
+    assert mti == "0200"
+    assert decoded[2] == fields[2]
+    assert decoded[4] == "000000001234"
+    assert decoded[35] == fields[35]
+    assert decoded[43] == fields[43]
+    assert set(decoded) == set(fields)
+
+
+@pytest.mark.parametrize("dialect", sorted(DIALECTS))
+def test_secondary_bitmap_and_de_128_round_trip(dialect):
+    mac = bytes(range(8))
+    fields = {11: "000123", 39: "00", 70: "301", 90: "0" * 42, 102: "ACCT1", 128: mac}
+    frame = encode_message("0810", fields, dialect)
+    mti, decoded = decode_message(frame, dialect)
+    assert mti == "0810"
+    assert decoded[70] == "301"
+    assert decoded[102] == "ACCT1"
+    assert decoded[128] == mac
+    assert 1 not in decoded and 65 not in decoded
+
+
+@pytest.mark.parametrize("dialect", sorted(DIALECTS))
+def test_decline_with_private_fields_is_not_an_approval(dialect):
+    fields = {11: "000123", 37: "000000000456", 39: "05", 44: "R", 48: "PRIVATE DATA",
+              54: "1001840C000000001000", 62: "XYZ", 63: "REPLY 63", 128: b"\x01" * 8}
+    result = parse_response(encode_message("0210", fields, dialect), dialect)
+    assert 'error' not in result
+    assert result['response_code'] == "05"
+    assert result['fields'][63] == "REPLY 63"
+
+
+def test_field_error_after_bitmap_is_reported_not_guessed():
+    body = DIALECTS["ascii"].encode("0210", {11: "000123", 39: "00", 48: "X" * 50})
+    truncated = body[:-20]
+    with pytest.raises(FieldError):
+        DIALECTS["ascii"].decode(truncated)
+    result = parse_response(truncated, "ascii")
+    assert result["error"] == "Malformed ASCII response: DE 48 truncated"
+    assert "response_code" not in result
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+from journal import JournalQuery, RingJournal, measure_memory
+
+# Budget for 100k records in the ring (measured at about 463 B/record)
+MAX_BYTES_PER_RECORD = 600
+
+
+def record(i, **overrides):
+    entry = {
+        'timestamp': datetime(2026, 10, 19, 12, 0, i % 60),
+        'amount': 10.0 + i,
+        'card': f"**** **** **** {i:04d}",
+        'status': 'APPROVED - Transaction Completed',
+        'approval_code': '1234',
+        'response_code': '00',
+        'receipt_number': i,
+        'rrn': f"{i:012d}",
+        'stan': f"{i:06d}",
+        'batch_number': 1,
+        'demo': False,
+    }
+    entry.update(overrides)
+    return entry
+
+
+def test_memory_per_100k_records_is_bounded():
+    result = measure_memory(100000, layouts=('ring',))
+    assert result['ring'] < MAX_BYTES_PER_RECORD
+
+
+def test_full_ring_evicts_oldest_and_unindexes_it():
+    ring = RingJournal(capacity=3)
+    for i in range(1, 6):
+        ring.append("M:T", record(i))
+    assert len(ring) == 3
+    assert [entry['receipt_number'] for entry in ring.tail("M:T", 10)] == [3, 4, 5]
+    assert ring.search(JournalQuery(rrn=f"{1:012d}")) == []
+    assert [entry['rrn'] for entry in ring.search(JournalQuery(rrn=f"{4:012d}"))] == [f"{4:012d}"]
+
+
+def test_spilled_records_stay_searchable(tmp_path):
+    ring = RingJournal(capacity=2, spill_path=str(tmp_path / "spill.jsonl"))
+    for i in range(1, 5):
+        ring.append("M:T", record(i))
+    assert len(ring) == 4
+    assert [entry['receipt_number'] for entry in ring.search(JournalQuery(rrn=f"{1:012d}"))] == [1]
+    ring.close()
+
+
+def test_spilled_rrn_and_stan_lookups_use_the_index(tmp_path, monkeypatch):
+    path = str(tmp_path / "spill.jsonl")
+    ring = RingJournal(capacity=10, spill_path=path)
+    for i in range(1, 5001):
+        ring.append("M:A" if i % 2 else "M:B", record(i, stan=f"{i % 1000:06d}"))
+    ring.close()
+
+    # Reopened: the index is rebuilt from the file
+    ring = RingJournal(capacity=10, spill_path=path)
+    monkeypatch.setattr(ring, "_read_spill", lambda *args: iter(()))  # no scans allowed
+    assert [entry['receipt_number'] for entry in ring.search(JournalQuery(rrn=f"{1234:012d}"))] == [1234]
+    # A STAN that wrapped matches every record carrying it, newest first
+    found = ring.search(JournalQuery(stan="000234"))
+    assert [entry['receipt_number'] for entry in found] == [4234, 3234, 2234, 1234, 234]
+    assert [entry['receipt_number'] for entry in ring.search(JournalQuery(stan="000234", profile_id="M:B"))] \
+        == [4234, 3234, 2234, 1234, 234]
+    assert ring.search(JournalQuery(stan="000234", profile_id="M:A")) == []
+    monkeypatch.undo()
+
+    # Clearing a profile rewrites the file and its index
+    ring.clear("M:B")
+    assert ring.search(JournalQuery(rrn=f"{1234:012d}")) == []
+    assert [entry['receipt_number'] for entry in ring.search(JournalQuery(rrn=f"{1235:012d}"))] == [1235]
+    ring.close()
@@ -0,0 +1,69 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from conftest import closed_port, server_config
+from heartbeat import Heartbeat
+from probes import HealthProber, parse_endpoints
+from state_backend import MemoryStateBackend
+
+
+def test_parse_endpoints():
+    assert parse_endpoints("\n https://host.example:443\n10.0.0.1:9090\n") == [
+        {'name': "host.example:443", 'host': "host.example", 'port': 443, 'protocol': "HTTPS"},
+        {'name': "10.0.0.1:9090", 'host': "10.0.0.1", 'port': 9090, 'protocol': "HTTP"},
+    ]
+    with pytest.raises(ValueError, match="host:port"):
+        parse_endpoints("host.example:99999")
+
+
+def make_prober(host_client, endpoints, echo=True):
+    heartbeat = Heartbeat(host_client, MemoryStateBackend(), dict, lambda: 0.0)
+    return HealthProber(host_client, lambda: endpoints, lambda: 0.0,
+                        echo=heartbeat.echo if echo else None, timeout=1.0)
+
+
+def test_probes_every_endpoint_and_times_each_phase(host_client, standin):
+    host = standin()
+    up = server_config(host.server_address[1])
+    prober = make_prober(host_client, {'primary': up, 'down': server_config(closed_port(), echo=False)})
+    results = prober.probe_all()
+
+    assert results['primary'].ok and set(results['primary'].phases) >= {'resolve', 'connect', 'echo'}
+    assert not results['down'].ok and results['down'].error
+    assert host.requests_served == 1  # the 0800
+    assert prober.latest() == results and len(prober.recent('primary')) == 1
+
+    prober.forget(['primary'])
+    assert list(prober.latest()) == ['primary']
+
+
+def test_concurrent_requests_join_one_probe(host_client):
+    started, release = threading.Event(), threading.Event()
+
+    def slow_echo(conn, config, timeout):
+        started.set()
+        release.wait(2.0)
+        return True
+
+    listener = socket.create_server(("127.0.0.1", 0))
+    prober = HealthProber(host_client, dict, lambda: 0.0, echo=slow_echo)
+    config = server_config(listener.getsockname()[1])
+    first = prober.submit('primary', config)
+    started.wait(2.0)
+    assert prober.submit('primary', config) is first
+    release.set()
+    assert first.result(2.0).ok
+    assert prober.submit('primary', config) is not first
+    listener.close()
+
+
+def test_endpoints_are_probed_in_parallel(host_client, standin):
+    hosts = [standin(latency_ms=300) for _ in range(4)]
+    prober = make_prober(host_client, {str(n): server_config(host.server_address[1])
+                                       for n, host in enumerate(hosts)})
+    start = time.monotonic()
+    assert all(result.ok for result in prober.probe_all().values())
+    assert time.monotonic() - start < 0.9  # four 300 ms echoes, not 1.2 s
@@ -0,0 +1,59 @@
+import os
+from datetime import datetime
+
+from receipts import ReceiptCache, render_receipt
+
+RESULT = {'receipt_number': 7, 'batch_number': 1, 'rrn': "000000000007", 'stan': "000007",
+          'response_code': "00", 'response_message': "APPROVED", 'approval_code': "1234",
+          'full_auth_code': "123456"}
+
+
+def receipt(number, rrn=None, profile_id="M:T", **result):
+    return render_receipt(profile_id, "T", "M", "Shop", 12.34, "411111******1111", "12/28",
+                          dict(RESULT, receipt_number=number, rrn=rrn or f"{number:012d}", **result),
+                          datetime(2026, 10, 19, 12, 0, 0))
+
+
+def test_render_receipt():
+    rendered = receipt(7)
+    assert rendered.receipt_number == "7" and rendered.rrn == "000000000007" and rendered.approved
+    assert rendered.issued == "2026-10-19 12:00:00"
+    details = dict(rendered.sections[1][1])
+    assert details['Amount'] == "$12.34" and details['STAN'] == "000007"
+    assert "Receipt Number: 7" in rendered.text and "Approval Code: 1234" in rendered.text
+    assert "4111111111111111" not in rendered.text
+    assert not receipt(8, response_code="05", response_message="DO NOT HONOR").approved
+
+
+def test_lru_eviction_and_rrn_index():
+    cache = ReceiptCache(capacity=2)
+    for number in (1, 2):
+        cache.put(receipt(number))
+    assert cache.get("M:T", 1) is not None  # 1 is now the most recent
+    cache.put(receipt(3))
+    assert len(cache) == 2
+    assert cache.get("M:T", 2) is None and cache.misses == 1
+    assert cache.get("M:T", rrn="000000000003").receipt_number == "3"
+    # A number that was never issued falls back to the RRN
+    assert cache.get("M:T", 99, rrn="000000000001").receipt_number == "1"
+    assert cache.get("OTHER:T", 1) is None
+    assert (cache.hits, cache.misses, cache.disk_reads) == (3, 2, 0)
+
+
+def test_evicted_and_restarted_receipts_come_from_disk(tmp_path):
+    directory = str(tmp_path / "receipts")
+    cache = ReceiptCache(capacity=1, directory=directory)
+    first = cache.put(receipt(1))
+    cache.put(receipt(2))
+    number_file = os.path.join(directory, "M_T-receipt-1.json")
+    rrn_file = os.path.join(directory, "M_T-rrn-000000000001.json")
+    assert os.path.samefile(number_file, rrn_file)
+
+    assert cache.get("M:T", 1) == first and cache.disk_reads == 1
+    # Read back into memory, so the next lookup is a hit
+    assert cache.get("M:T", 1) == first and cache.hits == 1
+
+    restarted = ReceiptCache(capacity=1, directory=directory)
+    assert restarted.get("M:T", rrn="000000000002") == receipt(2)
+    assert restarted.get("M:T", 3) is None
+    assert (restarted.hits, restarted.misses, restarted.disk_reads) == (0, 1, 1)
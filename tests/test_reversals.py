@@ -0,0 +1,189 @@
+import threading
+import time
+
+import pytest
+
+from authorizer import authorize_sale
+from conftest import closed_port, server_config
+from iso8583 import LENGTH_PREFIX, decode_message, encode_message, parse_response
+from profiles import ProfileRegistry
+from reversals import ABANDONED, FIRST_ATTEMPT_DELAY, PENDING, REVERSED, ReversalQueue, retry_delay
+from standin_host import StandInHost
+from state_backend import MemoryStateBackend, SQLiteStateBackend
+
+SALE = dict(pan="4111111111111111", amount=12.34, expiry="1228", approval_code="1234", merchant_name="Shop")
+
+
+class ScriptedHost(StandInHost):
+    """Stand-in whose replies come from `script(mti, fields)`; None falls back to the usual answer"""
+
+    def __init__(self, address, script):
+        super().__init__(address)
+        self.script = script
+        self.seen = []
+
+    def respond(self, frame):
+        mti, fields = decode_message(frame)
+        self.seen.append((mti, fields))
+        return self.script(mti, fields) or super().respond(frame)
+
+
+@pytest.fixture
+def scripted():
+    servers = []
+
+    def start(script):
+        server = ScriptedHost(("127.0.0.1", 0), script)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def reply(mti, **fields):
+    return encode_message(mti, {int(num[2:]): value for num, value in fields.items()})
+
+
+def framed(body):
+    return LENGTH_PREFIX.pack(len(body)) + body
+
+
+GARBLED = {
+    'no DE 39': lambda mti, fields: reply("0210", de11=fields[11], de37=fields[37]),
+    'bad DE 39': lambda mti, fields: reply("0210", de11=fields[11], de39="?!"),
+    'garbage': lambda mti, fields: LENGTH_PREFIX.pack(14) + b"0210\xff\xfe garbage",
+    # Looks like DE 39 = 00 and DE 38 to a text scan, but does not decode
+    'garbage with 3900': lambda mti, fields: framed(b"0210 garbage 390038ABCD"),
+    'other MTI': lambda mti, fields: reply("0410", de11=fields[11], de37=fields[37], de39="00"),
+    'other STAN': lambda mti, fields: reply("0210", de11="999999", de37=fields[37], de38="123456", de39="00"),
+    'other RRN': lambda mti, fields: reply("0210", de11=fields[11], de37="999999999999", de39="00"),
+    'no RRN': lambda mti, fields: reply("0210", de11=fields[11], de39="00"),
+}
+
+
+@pytest.mark.parametrize("garble", GARBLED.values(), ids=GARBLED.keys())
+def test_garbled_reply_queues_a_reversal(scripted, host_client, garble):
+    host = scripted(lambda mti, fields: garble(mti, fields) if mti == "0200" else None)
+    registry = ProfileRegistry()
+    queue = ReversalQueue(host_client, registry.config.backend, lambda: servers)
+    servers = {'primary': server_config(host.server_address[1])}
+
+    result = authorize_sale(host_client, registry.get_or_create("M", "T"), servers, 'primary',
+                            on_unconfirmed=queue.enqueue, **SALE)
+    assert 'error' in result and 'response_code' not in result and 'approval_code' not in result
+    assert result['connected'] is True and result['reversal'] == "queued"
+
+    (record,) = queue.pending()
+    assert record['rrn'] == result['rrn'] and record['card'].endswith("1111")
+    # No cardholder data is kept for the reversal
+    assert '2' not in record['original'] and '14' not in record['original']
+    assert "4111111111111111" not in str(record) and "1228" not in str(record['original'])
+
+    assert queue.run_once(time.time() + FIRST_ATTEMPT_DELAY) == 1
+    assert queue.records()[0]['status'] == REVERSED
+    mti, fields = host.seen[-1]
+    assert mti == "0400" and 2 not in fields and fields[37] == result['rrn']
+    assert fields[90][:10] == "0200" + result['stan']
+
+
+def test_only_approval_codes_settle(scripted, host_client):
+    codes = ["96", "91", "00"]
+    host = scripted(lambda mti, fields: reply("0410", de11=fields[11], de37=fields[37], de39=codes.pop(0)))
+    backend = MemoryStateBackend()
+    queue = ReversalQueue(host_client, backend, lambda: {'primary': server_config(host.server_address[1])})
+    queue.enqueue("M:T", 'primary', {2: "4111111111111111", 4: "000000001234", 7: "1019120000",
+                                     11: "000001", 37: "000000000001"})
+    generation = backend.generation()
+
+    now = time.time() + FIRST_ATTEMPT_DELAY
+    for attempt, code in enumerate(("96", "91"), 1):
+        assert queue.run_once(now) == 1
+        (record,) = queue.pending()
+        assert record['attempts'] == attempt and record['response_code'] == code
+        assert record['next_attempt'] == pytest.approx(record['updated'] + retry_delay(attempt))
+        # Not due again until the backoff has passed
+        assert queue.run_once(now) == 0
+        now = record['next_attempt']
+
+    assert queue.run_once(now) == 1
+    assert queue.records()[0]['status'] == REVERSED and not queue.pending()
+    # Retries are table writes; config caches never see them
+    assert backend.generation() == generation
+
+
+@pytest.mark.parametrize("answer", [
+    lambda fields: framed(b"0410 garbage 390038ABCD"),
+    lambda fields: reply("0410", de11="999999", de37=fields[37], de39="00"),
+    lambda fields: reply("0410", de11=fields[11], de37="999999999999", de39="00"),
+], ids=["garbage with 3900", "other STAN", "other RRN"])
+def test_reversal_needs_a_matching_0410(scripted, host_client, answer):
+    host = scripted(lambda mti, fields: answer(fields))
+    queue = ReversalQueue(host_client, MemoryStateBackend(), lambda: {'primary': server_config(host.server_address[1])})
+    queue.enqueue("M:T", 'primary', {2: "4111111111111111", 4: "000000001234", 7: "1019120000",
+                                     11: "000001", 37: "000000000001"})
+    assert queue.run_once(time.time() + FIRST_ATTEMPT_DELAY) == 1
+    (record,) = queue.pending()
+    assert record['attempts'] == 1 and record['last_error'] and record['response_code'] == ""
+
+
+def test_deadline_before_send_queues_no_reversal(scripted, host_client):
+    host = scripted(lambda mti, fields: None)
+    registry = ProfileRegistry()
+    queue = ReversalQueue(host_client, registry.config.backend, dict)
+    servers = {'primary': server_config(host.server_address[1])}
+
+    # Connected, then the budget runs out before the 0200 is written
+    result = authorize_sale(host_client, registry.get_or_create("M", "T"), servers, 'primary', budget=0.2,
+                            on_message=lambda *args: time.sleep(0.3), on_unconfirmed=queue.enqueue, **SALE)
+    assert "deadline" in result['error'] and result['connected'] is False and 'reversal' not in result
+    assert not queue.pending() and not host.seen
+
+
+def test_backoff_and_abandon(host_client):
+    assert [retry_delay(n) for n in (1, 2, 3, 10)] == [10.0, 20.0, 40.0, 600.0]
+    queue = ReversalQueue(host_client, MemoryStateBackend(), lambda: {'primary': server_config(closed_port())},
+                          timeout=1.0, max_attempts=2)
+    queue.enqueue("M:T", 'primary', {2: "4111111111111111", 4: "000000001234", 7: "1019120000",
+                                     11: "000001", 37: "000000000001"})
+    queue.run_once(time.time() + 3600)
+    assert queue.pending()[0]['last_error'].startswith("Connect failed")
+    queue.retry_now()
+    queue.run_once()
+    assert queue.records()[0]['status'] == ABANDONED
+
+
+def test_claims_are_exclusive_across_replicas(tmp_path, host_client):
+    path = str(tmp_path / "state.db")
+    first, second = SQLiteStateBackend(path), SQLiteStateBackend(path)
+    ReversalQueue(host_client, first, dict).enqueue(
+        "M:T", 'primary', {2: "4111111111111111", 4: "000000001234", 7: "1019120000", 11: "000001",
+                           37: "000000000001"})
+    now = time.time() + FIRST_ATTEMPT_DELAY
+    claimed = first.claim_reversal("M:T:000000000001", now, 30.0)
+    assert claimed is not None and claimed['lease_until'] == now + 30.0
+    assert second.claim_reversal("M:T:000000000001", now, 30.0) is None
+    # A replica that died mid-send loses the claim when the lease runs out
+    assert second.claim_reversal("M:T:000000000001", now + 31.0, 30.0) is not None
+    assert second.list_reversals(PENDING)[0]['lease_until'] == now + 61.0
+
+
+def test_legacy_config_entries_are_moved_without_card_data(host_client):
+    backend = MemoryStateBackend()
+    backend.set_config("reversal:M:T:000000000001", {
+        'id': "M:T:000000000001", 'profile_id': "M:T", 'server': 'primary', 'rrn': "000000000001",
+        'stan': "000001", 'amount': 12.34, 'card': "411111******1111", 'status': PENDING, 'attempts': 0,
+        'created': 1.0, 'updated': 1.0, 'next_attempt': 3.0, 'last_error': "", 'response_code': "",
+        'original': {'2': "4111111111111111", '14': "1228", '11': "000001", '37': "000000000001"},
+    })
+    queue = ReversalQueue(host_client, backend, dict)
+    assert backend.get_config("reversal:M:T:000000000001") is None
+    assert queue.pending()[0]['original'] == {'11': "000001", '37': "000000000001"}
+
+
+def test_parse_response_rejects_missing_response_code():
+    assert parse_response(reply("0210", de11="000001"))['error'].startswith("No response code")
+    assert parse_response(reply("0810", de11="000001"))['mti'] == "0810"
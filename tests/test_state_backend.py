@@ -0,0 +1,72 @@
+import shutil
+import subprocess
+
+import pytest
+
+from connections import SSLContextCache
+from state_backend import CertificateStore, ConfigCache, CounterBlock, MemoryStateBackend, SQLiteStateBackend
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStateBackend()
+    return SQLiteStateBackend(str(tmp_path / "state.db"))
+
+
+def test_config_round_trip_and_generation(backend):
+    start = backend.generation()
+    backend.set_config("server_config", {'primary': {'port': 9090}})
+    assert backend.get_config("server_config") == {'primary': {'port': 9090}}
+    assert backend.generation() == start + 1
+    assert backend.setdefault_config("server_config", {}) == {'primary': {'port': 9090}}
+    assert backend.generation() == start + 1
+
+
+def test_delete_config_finds_keys_holding_none(backend):
+    backend.set_config("note", None)
+    assert backend.delete_config("note") is True
+    assert backend.delete_config("note") is False
+    assert "note" not in backend.all_config()
+
+
+def test_counters_are_reserved_in_blocks(backend):
+    first = CounterBlock(backend, "stan", start=1, block_size=10)
+    second = CounterBlock(backend, "stan", start=1, block_size=10)
+    assert [first.next(), first.next(), second.next()] == [1, 2, 11]
+    assert backend.peek_counter("stan") == 21
+
+
+def test_config_cache_sees_other_writers(backend):
+    cache = ConfigCache(backend, refresh_interval=0.0)
+    assert cache.get("idempotency_window", 60) == 60
+    backend.set_config("idempotency_window", 0)
+    assert cache.get("idempotency_window", 60) == 0
+
+
+@pytest.fixture
+def client_pair(tmp_path):
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl not available")
+    cert, key = tmp_path / "new.crt", tmp_path / "new.key"
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=test",
+                    "-keyout", str(key), "-out", str(cert)], check=True, capture_output=True)
+    return cert.read_bytes(), key.read_bytes()
+
+
+def test_upload_revalidates_in_the_uploading_process(backend, tmp_path, client_pair):
+    ssl_contexts = SSLContextCache()
+    cert_path, key_path = str(tmp_path / "certs/cad.crt"), str(tmp_path / "certs/client.key")
+    store = CertificateStore(ConfigCache(backend, refresh_interval=0.0), cert_path, key_path, ssl_contexts)
+    assert ssl_contexts.check(cert_path, key_path) == (False, "Certificate files missing")
+
+    assert store.save(*client_pair) is True
+    assert ssl_contexts.check(cert_path, key_path) == (True, "Certificates are valid")
+
+    # Another replica sharing the backend picks the pair up on its next sync
+    other_contexts = SSLContextCache()
+    other_cert, other_key = str(tmp_path / "other/cad.crt"), str(tmp_path / "other/client.key")
+    other = CertificateStore(ConfigCache(backend, refresh_interval=0.0), other_cert, other_key, other_contexts)
+    assert other_contexts.check(other_cert, other_key)[0] is False
+    assert other.sync() is True and other.sync() is False
+    assert other_contexts.check(other_cert, other_key) == (True, "Certificates are valid")